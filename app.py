@@ -1,9 +1,14 @@
 import time
-from flask import Flask, send_from_directory
+import json
+import zlib
+import datetime
+import threading
+from flask import Flask, request, send_from_directory
 app = Flask(__name__, static_folder="templates", static_url_path="")
 
 import os
-from pathlib import PurePath
+import configparser
+from pathlib import Path, PurePath
 import logging
 import logging.handlers
 logger = logging.getLogger(__name__)
@@ -11,16 +16,173 @@ logger = logging.getLogger(__name__)
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = '[%(levelname)s] %(asctime)s : %(name)s(%(lineno)s) %(message)s'
 logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+import logutil
+logutil.set_logger_format(logging.getLogger().handlers, LOG_FORMAT)
 logpath = PurePath(os.path.dirname(os.path.abspath(__file__)), 'log', 'backup_app.log')
+# log/ はリポジトリに含めないので無ければ作る
+os.makedirs(str(logpath.parent), exist_ok=True)
 handler = logging.handlers.TimedRotatingFileHandler(str(logpath), when='D', backupCount=7)
 handler.setLevel(LOG_LEVEL)
-handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+handler.setFormatter(logutil.RawAwareFormatter(fmt=LOG_FORMAT))
 logging.getLogger().addHandler(handler)
 
 from settings import Settings
 from process import Process
 from processpool import ProcessPool
-import logutil
+from jobstore import JobStore
+from watcher import Journal, Watcher
+import rsyncstat
+import verify
+import joblock
+import mountutil
+from scheduler import Scheduler
+from coalesce import Coalescer
+import batch
+import resusage
+import jobstats
+import logbuffer
+import promexport
+import remover
+from workerpool import WorkerPool, WorkerProcess
+
+# config.iniの場所(backup.pyの既定値と同じ)
+INIDIR = '/mnt/backup'
+INIPATH = './config.ini'
+# 常駐ワーカー数(0 はジョブごとに python3 backup.py を起動する)
+BACKUP_WORKERS = int(os.environ.get('BACKUP_WORKERS', '0'))
+# 終了・エラーの履歴を残す件数と時間(h)(0 は無制限)
+HISTORY_SIZE = int(os.environ.get('BACKUP_HISTORY_SIZE', '100'))
+HISTORY_HOURS = float(os.environ.get('BACKUP_HISTORY_HOURS', '168'))
+# ジョブの状態を保存するDB
+# ジョブごとの出力ファイルの置き場所
+JOB_LOG_DIR = os.environ.get('BACKUP_JOB_LOG_DIR', str(PurePath(os.path.dirname(os.path.abspath(__file__)), 'log', 'jobs')))
+JOB_DB = os.environ.get('BACKUP_JOB_DB', str(PurePath(os.path.dirname(os.path.abspath(__file__)), 'state', 'jobs.sqlite')))
+# 完了したジョブの履歴を保存するDB
+HISTORY_DB = os.environ.get('BACKUP_HISTORY_DB', str(PurePath(os.path.dirname(os.path.abspath(__file__)), 'state', 'history.sqlite')))
+# GET /api/jobs/<id>?wait= で待つ時間の上限(s)
+MAX_WAIT = 300
+# /api/events で変化がなくても送る間隔(s)
+SSE_KEEPALIVE = 15
+# ETag をサーバの起動ごとに変える(版数は起動時に0に戻る)
+BOOT_ID = '%x' % int(time.time())
+# シリアライズ済みのステータス
+status_cache = {'pool': None, 'version': None, 'body': None}
+status_cache_lock = threading.Lock()
+# ジョブの出力を1回に読む上限(バイト)
+MAX_LOG_READ = 1024 * 1024
+# 起動中のウォッチャー(セクション名: Watcher)
+watchers = {}
+# ジョブの実行順とデバイスごとの同時実行数を決めるスケジューラ
+scheduler = Scheduler()
+# 完了したジョブの統計
+job_stats = jobstats.JobStats()
+# Prometheus のメトリクス
+job_metrics = promexport.JobMetrics()
+# 同じジョブの重複した実行要求をまとめる
+coalescer = Coalescer()
+# まとめて登録したジョブ
+batches = batch.BatchRegistry()
+# 常駐ワーカーのプール(BACKUP_WORKERS が0ならNone)
+workers = None
+
+def load_config():
+    """
+    config.iniを読み込む
+
+    Returns
+    -------
+    config : configparser.ConfigParser
+        パース結果
+    """
+    config = configparser.ConfigParser()
+    config.read(str(Path(INIDIR, INIPATH).resolve()), 'UTF-8')
+    return config
+
+def start_watchers(config):
+    """
+    watch = true のセクションの変更監視を開始する
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        config.iniのパース結果
+
+    Returns
+    -------
+    watchers : dict of {str: watcher.Watcher}
+        セクション名とウォッチャー
+    """
+    started = {}
+    for section in config.sections():
+        values = config[section]
+        if not values.getboolean('watch', False):
+            continue
+        journal = Journal(Settings.create_statedir(values['dest']), section,
+                          max_bytes=values.getint('journal_max_mb', 16)*1024*1024)
+        started[section] = Watcher(values['source'], journal)
+        started[section].start()
+    return started
+
+def get_journal_status():
+    """
+    変更ジャーナルの状態を取得する
+
+    Returns
+    -------
+    dict of {str: dict}
+        セクション名とジャーナルの状態
+    """
+    return {section: w.journal.status() for section, w in watchers.items()}
+
+def get_verify_report(user, target):
+    """
+    セクションの最後の検証結果を取得する
+
+    Parameters
+    ----------
+    user : str
+        対象ユーザ
+    target : str
+        対象区分
+
+    Returns
+    -------
+    dict or None
+        検証結果
+    """
+    section = user + '_' + target
+    config = load_config()
+    if not config.has_section(section):
+        return None
+    return verify.load_report(os.path.join(Settings.create_statedir(config[section]['dest']), target + '_verify.json'))
+
+def get_job_lock(section):
+    """
+    セクションのジョブを実行する前に取るロック(スケジューラの実行権)を作成する
+
+    同じセクションはロックで排他し、source, dest の物理デバイスごとの同時実行数は
+    スケジューラで制限する。max_parallel が1なら、backup.py を直接実行したジョブとも
+    lock_key のロックで排他する。
+
+    Parameters
+    ----------
+    section : str
+        セクション名
+
+    Returns
+    -------
+    ticket : scheduler.Ticket
+    """
+    config = load_config()
+    if not config.has_section(section):
+        return scheduler.ticket(section, [], lock=joblock.ResourceLock(section))
+    values = config[section]
+    limit = values.getint('max_parallel', 1)
+    key = joblock.resource_key(section, values['dest'], values.get('lock_key', 'device'))
+    device_lock = joblock.ResourceLock(key) if limit <= 1 and key != section else None
+    return scheduler.ticket(section, mountutil.devices_of([values['source'], values['dest']]),
+                            priority=values.getint('priority', 0), limit=limit,
+                            lock=joblock.ResourceLock(section), device_lock=device_lock)
 
 def to_section_name(proc):
     """
@@ -49,37 +211,115 @@ def get_status(pool):
 
     Returns
     -------
-    message : str
-        ステータスメッセージ
+    dict of {str: list of dict}
+        状態ごとのジョブ
     """
     return pool.get_section(to_section_name)
 
-    # メッセージ作成
-    message = 'error : ' + procs_sections[ProcessPool.ERROR] + '\n'+ \
-              'finished : ' + procs_sections[ProcessPool.FINISHED] + '\n' + \
-              'running : ' + procs_sections[ProcessPool.RUNNING] + '\n' + \
-              'pending : ' + procs_sections[ProcessPool.PENDING] + '\n'
+def get_status_body(pool):
+    """
+    版数とシリアライズ済みのバックアップ実行状況を取得する
 
-    # プロセス辞書をフラッシュ
-    pool.clear_procs([ProcessPool.FINISHED])
+    プールの版数が変わったときだけシリアライズし直す。
 
-    return message
+    Parameters
+    ----------
+    pool : processpool.ProcessPool
+        ProcessPoolインスタンス
 
-def deco_exec_backup(func):
-    def exec_backup_wrapper(*args, **kwargs):
-        format_before = logging.getLogger().handlers[0].formatter._fmt
-        try:
-            logutil.set_logger_format(logging.getLogger().handlers, '%(message)s')
-            res = func(*args, **kwargs)
-        finally:
-            logutil.set_logger_format(logging.getLogger().handlers, format_before)
-        return res
-    return exec_backup_wrapper
+    Returns
+    -------
+    version : int
+        版数
+    body : str
+        get_status の JSON
+    """
+    with status_cache_lock:
+        if status_cache['pool'] is not pool or status_cache['version'] != pool.version:
+            version, sections = pool.snapshot(to_section_name)
+            status_cache.update(pool=pool, version=version, body=json.dumps(sections))
+        return status_cache['version'], status_cache['body']
+
+def diff_sections(old, new):
+    """
+    状態ごとのジョブの差分を求める
+
+    ProcessPool.snapshot は変わっていないジョブに同じ辞書を返すので、同一性で比べる。
+
+    Parameters
+    ----------
+    old : dict of {str: list of dict}
+        前回の状態
+    new : dict of {str: list of dict}
+        今回の状態
+
+    Returns
+    -------
+    changed : list of dict
+        追加・変更されたジョブ(state に状態を入れる)
+    removed : list of int
+        なくなったジョブのID
+    """
+    previous = {entry['id']: (state, entry) for state, entries in old.items() for entry in entries}
+    changed = []
+    for state, entries in new.items():
+        for entry in entries:
+            prev = previous.pop(entry['id'], None)
+            if prev is None or prev[0] != state or prev[1] is not entry:
+                changed.append(dict(entry, state=state))
+    return changed, list(previous)
+
+def to_event(event, data):
+    """
+    Server-Sent Events の1イベントを作成する
+    """
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
 
-@deco_exec_backup
-def exec_backup(cmd, pool):
+def stream_status(pool, keepalive=None):
     """
-    バックアップを実行する
+    バックアップ実行状況の変化を Server-Sent Events で送る
+
+    最初に全体(snapshot)を送り、以降はプールの版数が変わるたびに変わったジョブだけ(update)を送る。
+    変更ジャーナルの状態(journal)は変わったときだけ送る。
+
+    Parameters
+    ----------
+    pool : processpool.ProcessPool
+        ProcessPoolインスタンス
+    keepalive : float, default None
+        変化がなくても送る間隔(s)(None は SSE_KEEPALIVE)
+
+    Yields
+    ------
+    str
+        イベント
+    """
+    keepalive = SSE_KEEPALIVE if keepalive is None else keepalive
+    version, sections = pool.snapshot(to_section_name)
+    journal = get_journal_status()
+    yield to_event('snapshot', {'version': version, 'status': dict(sections, journal=journal)})
+    while True:
+        current = pool.wait_change(version, keepalive)
+        sent = False
+        if current != version:
+            version, latest = pool.snapshot(to_section_name)
+            changed, removed = diff_sections(sections, latest)
+            sections = latest
+            if len(changed) > 0 or len(removed) > 0:
+                yield to_event('update', {'version': version, 'changed': changed, 'removed': removed})
+                sent = True
+        latest_journal = get_journal_status()
+        if latest_journal != journal:
+            journal = latest_journal
+            yield to_event('journal', journal)
+            sent = True
+        if not sent:
+            # 切断を検知するために送る
+            yield ': keepalive\n\n'
+
+def create_job(cmd, pool, lock=None):
+    """
+    バックアップのジョブを作成して実行待ちに登録する
 
     Parameters
     ----------
@@ -87,29 +327,588 @@ def exec_backup(cmd, pool):
         実行するバックアップコマンド
     pool : processpool.ProcessPool
         プロセスプールインスタンス
+    lock : scheduler.Ticket or joblock.ResourceLock, default None
+        実行前に取るロック
+
+    Returns
+    -------
+    proc : process.Process
+        登録したプロセス(job_id にジョブIDが入る)
+    """
+    # サブプロセス作成(常駐ワーカーが残っていればそちらで実行する)
+    # 出力はルートロガーに流さず(他のジョブの出力と混ざる)、ジョブごとのリングバッファにだけ書く。
+    # ログファイルには子プロセス(ワーカー)が自分で書き込む
+    if workers is None or workers.degraded:
+        proc = Process(cmd=cmd)
+    else:
+        proc = WorkerProcess(cmd, workers)
+    proc.handlers.append(rsyncstat.MetricsCollector(proc.metrics, on_update=lambda: pool.touch(proc)))
+    proc.handlers.append(jobstats.PhaseTimer(proc.phases))
+    proc.log = logbuffer.LogBuffer()
+    proc.handlers.append(proc.log)
+    if '--user' in cmd and '--target' in cmd:
+        proc.handlers.append(count_removed(proc))
+    proc.lock = lock
+    pool.register(proc, ProcessPool.PENDING)
+    return proc
+
+def count_removed(proc):
+    """
+    保持ポリシーで削除した世代数をメトリクスに記録するハンドラを作成する
+
+    Parameters
+    ----------
+    proc : process.Process
+        バックアップのプロセス
+
+    Returns
+    -------
+    function
+        出力1行を受け取るハンドラ
+    """
+    def handle(line):
+        removed = remover.parse_removed(line)
+        if removed is not None:
+            job_metrics.retention_removed(to_section_name(proc), *removed)
+        return False
+    return handle
+
+def ensure_mounts(proc):
+    """
+    ジョブが使うファイルシステムがマウントされていることを保証する
+
+    マウントポイント一覧はサーバ全体で1つの mountutil.checker でキャッシュするので、
+    ジョブごとに mountinfo, fstab をパースしない。--no_mount を付けていないジョブは backup.py が確認する。
+
+    Parameters
+    ----------
+    proc : process.Process
+        実行するプロセス
+
+    Returns
+    -------
+    returncode : int
+        終了コード
+    """
+    if '--no_mount' not in proc.cmd:
+        return 0
+    config = load_config()
+    section = to_section_name(proc)
+    if not config.has_section(section):
+        return 0
+    values = config[section]
+    return mountutil.checker.ensure([values['source'], values['dest']],
+                                    Settings.parse_mounts(values.get('mounts', '')))
+
+def run_job(proc, pool, on_start=None):
+    """
+    登録したジョブを実行する
+
+    Parameters
+    ----------
+    proc : process.Process
+        create_job で登録したプロセス
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+    on_start : function, default None
+        実行待ちを抜けたときに呼ぶ関数
 
     Returns
     -------
     int
         終了コード
     """
-    # サブプロセス作成
-    proc = Process(cmd=cmd, out_to_log=True)
-    pool.register(proc, ProcessPool.PENDING)
-    # 他のサブプロセスを待つ
+    # 同じリソースを使う他のジョブを待つ
+    waited_at = time.monotonic()
     rcode = proc.wait_other_process()
+    if '--user' in proc.cmd and '--target' in proc.cmd:
+        job_metrics.queue_waited(to_section_name(proc), time.monotonic() - waited_at)
+    if rcode == 0:
+        # マウントの確認に失敗したら取ったロックを返してエラーにする
+        try:
+            mounted = ensure_mounts(proc) == 0
+        except Exception as e:
+            logger.error('could not check mounts (%s): %s', ' '.join(proc.cmd), e)
+            mounted = False
+        if not mounted:
+            proc.release_lock()
+            rcode = 1
     if rcode == 1:
+        if on_start is not None:
+            on_start()
         rcode = max([rcode, pool.move_proc(proc, ProcessPool.ERROR)])
         return rcode
     # 実行
-    rcode = pool.move_proc(proc, ProcessPool.RUNNING)
-    if rcode == 0:
-        logger.info('')
-        proc.execute(wait=True)
-        target = ProcessPool.FINISHED if proc.returncode == 0 else ProcessPool.ERROR
-        rcode = pool.move_proc(proc, target)
+    try:
+        rcode = pool.move_proc(proc, ProcessPool.RUNNING)
+        if on_start is not None:
+            on_start()
+        if rcode == 0:
+            logger.info('')
+            proc.log_file = open_job_log(proc, pool)
+            started_at = time.monotonic()
+            proc.execute()
+            pool.update_proc(proc)
+            # 実行中はプロセスツリーの資源使用量を集計する
+            sampler = resusage.ResourceSampler(proc, baseline=isinstance(proc, WorkerProcess),
+                                               on_sample=lambda: pool.touch(proc))
+            sampler.start()
+            try:
+                proc.returncode
+            finally:
+                sampler.stop()
+            logger.info('resources (%s): %s', ' '.join(proc.cmd), proc.resources)
+            record_stats(proc, time.monotonic() - started_at, proc.phases)
+            close_log(proc)
+            target = ProcessPool.FINISHED if proc.returncode == 0 else ProcessPool.ERROR
+            rcode = pool.move_proc(proc, target)
+    finally:
+        proc.release_lock()
+        if proc.log is not None:
+            proc.log.close()
     return max([proc.returncode, rcode])
 
+def exec_backup(cmd, pool, lock=None, on_start=None):
+    """
+    バックアップを実行する(終了まで待つ)
+
+    Parameters
+    ----------
+    cmd : list
+        実行するバックアップコマンド
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+    lock : scheduler.Ticket or joblock.ResourceLock, default None
+        実行前に取るロック
+    on_start : function, default None
+        実行待ちを抜けたときに呼ぶ関数
+
+    Returns
+    -------
+    int
+        終了コード
+    """
+    return run_job(create_job(cmd, pool, lock), pool, on_start)
+
+def open_job_log(proc, pool):
+    """
+    ジョブの出力をジョブごとのファイルにも書き込む
+
+    バックアップのログファイルは他のプロセス(削除、アーカイブ、検証)も書き込み、日付で名前が変わるので、
+    リングバッファと同じバイト列を JOB_LOG_DIR/<ジョブID>.log に書き、捨てたところは同じ位置から読む。
+
+    Parameters
+    ----------
+    proc : process.Process
+        実行するプロセス(ジョブID、リングバッファがあること)
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス(履歴から消えたジョブのファイルを消す)
+
+    Returns
+    -------
+    log_file : dict of {path: str, start: int, end: int} or None
+        出力ファイルとファイル内の範囲(書き込めなければNone)
+    """
+    if proc.log is None or proc.job_id is None:
+        return None
+    path = os.path.join(JOB_LOG_DIR, '%d.log' % proc.job_id)
+    try:
+        os.makedirs(JOB_LOG_DIR, exist_ok=True)
+        prune_job_logs(pool)
+        proc.log.spool(path)
+    except OSError as e:
+        logger.warning('could not open job log %s: %s', path, e)
+        return None
+    return {'path': path, 'start': 0, 'end': None}
+
+def prune_job_logs(pool):
+    """
+    履歴から消えたジョブの出力ファイルを消す
+
+    Parameters
+    ----------
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+    """
+    for name in os.listdir(JOB_LOG_DIR):
+        job_id, ext = os.path.splitext(name)
+        if ext != '.log' or not job_id.isdigit() or pool.get(int(job_id)) is not None:
+            continue
+        try:
+            os.remove(os.path.join(JOB_LOG_DIR, name))
+        except OSError as e:
+            logger.warning('could not remove job log %s: %s', name, e)
+
+def close_log(proc):
+    """
+    終了したジョブの出力ファイル内の範囲を確定する
+
+    出力を全てファイルに書き込めていれば、以降はファイルから読むのでリングバッファを手放す。
+
+    Parameters
+    ----------
+    proc : process.Process
+        終了したプロセス
+    """
+    if proc.log is not None:
+        proc.log.close()
+    if proc.log_file is None:
+        return
+    proc.log_file['end'] = logbuffer.file_size(proc.log_file['path'])
+    if proc.log is not None and proc.log.spooled:
+        proc.log = None
+
+def read_job_log(proc, offset, limit):
+    """
+    ジョブの出力を位置から読む
+
+    実行中はリングバッファから、バッファにない(捨てられた、終了した)ところは出力ファイルから読む。
+
+    Parameters
+    ----------
+    proc : process.Process
+        ジョブのプロセス
+    offset : int
+        ジョブの出力の先頭からの位置(バイト)
+    limit : int
+        読む上限(バイト)
+
+    Returns
+    -------
+    start : int
+        読んだ先頭の位置
+    data : bytes
+        読んだ出力
+    complete : bool
+        ジョブが終了し、末尾まで読んだか？
+    """
+    buf = proc.log
+    log_file = proc.log_file
+    if buf is not None and (log_file is None or offset >= buf.start):
+        start, data = buf.read(offset, limit)
+        return start, data, buf.closed and start + len(data) >= buf.end
+    if log_file is None:
+        return offset, b'', True
+    end = log_file['end']
+    if buf is not None:
+        # バッファから捨てられたところだけをファイルから読む
+        limit = min(limit, buf.start - offset)
+    data = logbuffer.read_file(log_file['path'], log_file['start'], offset, limit,
+                               None if end is None else end)
+    complete = buf is None and end is not None and offset + len(data) >= end - log_file['start']
+    return offset, data, complete
+
+def stream_job_log(proc, offset):
+    """
+    ジョブの出力を位置から終了まで送る
+
+    Parameters
+    ----------
+    proc : process.Process
+        ジョブのプロセス
+    offset : int
+        読み始める位置
+
+    Yields
+    ------
+    bytes
+        出力
+    """
+    while True:
+        start, data, complete = read_job_log(proc, offset, MAX_LOG_READ)
+        if len(data) > 0:
+            offset = start + len(data)
+            yield data
+            continue
+        if complete:
+            return
+        buf = proc.log
+        if buf is not None:
+            buf.wait(offset, SSE_KEEPALIVE)
+        else:
+            # ログファイルしかない(再起動前から動いている)ジョブは書き込みを通知されない
+            time.sleep(1)
+
+def record_stats(proc, duration, phases):
+    """
+    完了したバックアップの所要時間などを統計に記録する
+
+    Parameters
+    ----------
+    proc : process.Process
+        完了したプロセス
+    duration : float
+        実行時間(s)
+    phases : dict of {str: float}
+        フェーズごとの所要時間(s)
+    """
+    if '--user' not in proc.cmd or '--target' not in proc.cmd:
+        return
+    entry = {'section': to_section_name(proc),
+             'kind': 'verify' if '--verify' in proc.cmd else 'backup',
+             'finished_at': datetime.datetime.now().isoformat(),
+             'duration': round(duration, 3),
+             'returncode': proc.returncode,
+             'bytes': proc.metrics.get('bytes'),
+             'phases': dict(phases)}
+    job_stats.record(entry)
+    job_metrics.job_finished(entry)
+
+def watch_attached(proc, pool):
+    """
+    サーバ再起動前から動いているジョブの終了を待って状態を更新する
+
+    Parameters
+    ----------
+    proc : process.AttachedProcess
+        動いているジョブのプロセス
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+    """
+    # 子プロセスはロックを取らないので、終わるまでサーバが代わりに取っておく
+    proc.lock = get_job_lock(to_section_name(proc))
+    proc.wait_other_process()
+    try:
+        sampler = resusage.ResourceSampler(proc, on_sample=lambda: pool.touch(proc))
+        sampler.start()
+        try:
+            proc.returncode
+        finally:
+            sampler.stop()
+        close_log(proc)
+        # 終了コードは分からないのでエラーとして残す
+        logger.warning('re-attached job (pid %d) exited with unknown status : %s', proc.pid, ' '.join(proc.cmd))
+        pool.move_proc(proc, ProcessPool.ERROR)
+    finally:
+        proc.release_lock()
+
+def reconcile_jobs(pool, procs):
+    """
+    前回終了時に実行中・待機中だったジョブを照合する
+
+    PIDと起動時刻が一致するプロセスが動いていれば終了を待ち、
+    それ以外(待機中だったもの、サーバと一緒に終了したもの)はエラーにする。
+
+    Parameters
+    ----------
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+    procs : list of process.AttachedProcess
+        ProcessPool.restore の戻り値
+
+    Returns
+    -------
+    threads : list of threading.Thread
+        終了を待つスレッド
+    """
+    threads = []
+    for proc in procs:
+        if proc.is_alive():
+            logger.info('re-attach running job (pid %d) : %s', proc.pid, ' '.join(proc.cmd))
+            thread = threading.Thread(target=watch_attached, args=(proc, pool), daemon=True)
+            thread.start()
+            threads.append(thread)
+        else:
+            logger.warning('job interrupted by server restart : %s', ' '.join(proc.cmd))
+            pool.move_proc(proc, ProcessPool.ERROR)
+    return threads
+
+def submit_job(cmd, section, pool, enqueue=False):
+    """
+    ジョブを登録し、別スレッドで実行する
+
+    同じコマンドが実行待ちならそのジョブにまとめる。
+    セクションに min_interval(分)があれば、その時間内に成功していれば登録しない。
+
+    Parameters
+    ----------
+    cmd : list
+        実行するバックアップコマンド
+    section : str
+        セクション名
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+    enqueue : bool, default False
+        スレッドを起動する前にスケジューラの実行待ちの順番を取るか？(登録順に実行させるとき)
+
+    Returns
+    -------
+    job_id : int
+        ジョブID
+    how : str
+        coalesce.Coalescer.submit の登録結果
+    """
+    config = load_config()
+    min_interval = config[section].getfloat('min_interval', 0) * 60 if config.has_section(section) else 0
+    key = tuple(cmd)
+    created = []
+
+    def create():
+        lock = get_job_lock(section)
+        if enqueue:
+            lock.enqueue()
+        try:
+            created.append(create_job(cmd, pool, lock))
+        except Exception:
+            lock.cancel()
+            raise
+        return created[0].job_id
+
+    job_id, how = coalescer.submit(key, create, min_interval)
+    if how == Coalescer.SUBMITTED:
+        def run():
+            rcode = 1
+            try:
+                rcode = run_job(created[0], pool, on_start=lambda: coalescer.started(key, job_id))
+            except Exception:
+                logger.exception('job %d failed', job_id)
+                pool.move_proc(created[0], ProcessPool.ERROR)
+            finally:
+                # 実行権を取らずに終わったら、enqueue で取った順番を返す
+                created[0].lock.cancel()
+                coalescer.finished(key, job_id, rcode)
+
+        threading.Thread(target=run, name='job-%d' % job_id, daemon=True).start()
+    return job_id, how
+
+def create_backup_cmd(user, target, verify=False):
+    """
+    バックアップ(検証)のコマンドを作成する
+
+    Parameters
+    ----------
+    user : str
+        対象ユーザ
+    target : str
+        対象区分
+    verify : bool, default False
+        検証か？
+
+    Returns
+    -------
+    cmd : list of str
+    """
+    exec_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup.py')
+    # ロックとマウントの確認はサーバで行うので子プロセスでは行わない
+    return (['python3', exec_path, '--user', user, '--target', target]
+            + (['--verify'] if verify else []) + ['--no_lock', '--no_mount'])
+
+def plan_batch(sections):
+    """
+    セクションのバックアップの実行順を決める
+
+    物理デバイスと、統計の所要時間の中央値から batch.plan で並べる。
+    統計のないセクションは、他のセクションの中央値で見積もる。
+
+    Parameters
+    ----------
+    sections : dict of {str: tuple of (str, str)}
+        対象セクションと、そのユーザー・ターゲット
+
+    Returns
+    -------
+    list of dict
+        batch.plan の戻り値
+    """
+    config = load_config()
+    stats = job_stats.get()
+    items = []
+    for section in sections:
+        values = config[section]
+        duration = stats.get(section, {}).get('backup', {}).get('duration', {}).get('p50')
+        items.append({'section': section, 'user': sections[section][0], 'target': sections[section][1],
+                      'devices': sorted(mountutil.devices_of([values['source'], values['dest']])),
+                      'priority': values.getint('priority', 0), 'duration': duration})
+    known = sorted(item['duration'] for item in items if item['duration'] is not None)
+    default = jobstats.percentile(known, 50) or 0.0
+    for item in items:
+        if item['duration'] is None:
+            item['duration'] = default
+    return batch.plan(items)
+
+def submit_batch(sections, pool):
+    """
+    セクションのバックアップを実行順にまとめて登録する
+
+    スケジューラの実行待ちの順番は、ジョブのスレッドを起動する前に実行順で取る。
+
+    Parameters
+    ----------
+    sections : dict of {str: tuple of (str, str)}
+        対象セクションと、そのユーザー・ターゲット
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+
+    Returns
+    -------
+    job_batch : batch.Batch
+    """
+    jobs = []
+    for item in plan_batch(sections):
+        job_id, how = submit_job(create_backup_cmd(item['user'], item['target']), item['section'], pool,
+                                 enqueue=True)
+        jobs.append({'section': item['section'], 'job_id': job_id, 'how': how, 'devices': item['devices'],
+                     'start': item['start'], 'finish': item['finish']})
+    return batches.add(jobs)
+
+def get_batch_status(job_batch, pool):
+    """
+    バッチの進捗を作成する
+
+    Parameters
+    ----------
+    job_batch : batch.Batch
+        バッチ
+    pool : processpool.ProcessPool
+        プロセスプールインスタンス
+
+    Returns
+    -------
+    dict
+    """
+    def get_state(job_id):
+        job = pool.get(job_id)
+        return 'unknown' if job is None else job['state']
+
+    return job_batch.progress(get_state)
+
+def wait_batch(job_batch, pool, timeout=None):
+    """
+    バッチの全ジョブが終了するか timeout 秒経つまで待つ
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for job in job_batch.jobs:
+        pool.wait(job['job_id'], None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+def get_job_status(job):
+    """
+    ジョブの状態を作成する
+
+    Parameters
+    ----------
+    job : dict
+        processpool.ProcessPool.get の戻り値
+
+    Returns
+    -------
+    dict
+    """
+    proc = job['proc']
+    done = job['state'] in ProcessPool.HISTORY_KEYS
+    return {'id': job['id'], 'name': to_section_name(proc), 'state': job['state'],
+            'updated_at': job['updated_at'], 'returncode': proc.returncode if done else None,
+            'metrics': dict(proc.metrics), 'resources': dict(proc.resources)}
+
+def is_blocking():
+    """
+    終了まで待つ(従来どおりの)要求か？
+
+    Returns
+    -------
+    bool
+    """
+    return request.args.get('blocking', '').lower() in ('1', 'true', 'yes')
+
 @app.route("/")
 def index():
     return send_from_directory(app.static_folder, 'index.html')
@@ -118,13 +917,49 @@ def index():
 def status():
     """
     ステータス取得
+
+    ETag はプールの版数と変更ジャーナルの状態から作り、変わっていなければ 304 を返す。
     """
     try:
-        return get_status(ppool)
+        version, body = get_status_body(ppool)
+        journal = json.dumps(get_journal_status(), sort_keys=True)
+        etag = '%s-%d-%08x' % (BOOT_ID, version, zlib.crc32(journal.encode()))
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            # 変更ジャーナルはプールと別に変わるので、シリアライズ済みの JSON の末尾に足す
+            response = app.response_class(body[:-1] + ', "journal": ' + journal + '}', mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         logger.warn('Exception raised. Return warning')
         return {'message': 'something occured. check pi3!\n%s' % e}, 500
 
+@app.route("/api/events", methods=["GET"])
+def events():
+    """
+    ステータスの変化を Server-Sent Events で受け取る
+    """
+    return app.response_class(stream_status(ppool), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """
+    Prometheus のメトリクス取得
+
+    値はイベントのたびに更新しているので、ここでは書き出すだけ(履歴の件数によらない)
+    """
+    return app.response_class(job_metrics.expose(), mimetype=None, content_type=promexport.CONTENT_TYPE)
+
+@app.route("/api/stats", methods=["GET"])
+def stats():
+    """
+    セクションごとの所要時間・転送速度の統計取得
+    """
+    return job_stats.get(request.args.get('section'))
+
 @app.route("/api/clear_error", methods=["POST"])
 def clear_error():
     """
@@ -141,6 +976,139 @@ def clear_finished():
     ppool.clear_procs([ProcessPool.FINISHED])
     return {'message': 'cleared.'}
 
+@app.route("/api/jobs/<int:job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    ジョブの状態取得
+
+    Parameters
+    ----------
+    job_id : int
+        ジョブID
+    """
+    wait = request.args.get('wait', type=float)
+    if wait is None:
+        job = ppool.get(job_id)
+    else:
+        # 終了するか wait 秒経つまで待つ
+        job = ppool.wait(job_id, min(max(wait, 0.0), MAX_WAIT))
+    if job is None:
+        return {'message': 'job not found.'}, 404
+    return get_job_status(job)
+
+def get_log_args():
+    """
+    ログ取得の offset, limit を取得する
+    """
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(max(1, request.args.get('limit', MAX_LOG_READ, type=int)), MAX_LOG_READ)
+    return offset, limit
+
+@app.route("/api/jobs/<int:job_id>/log", methods=["GET"])
+def job_log(job_id):
+    """
+    ジョブの出力取得
+
+    ?offset=N から最大 ?limit= バイトを返す。続きは X-Log-Next-Offset から読む。
+
+    Parameters
+    ----------
+    job_id : int
+        ジョブID
+    """
+    job = ppool.get(job_id)
+    if job is None:
+        return {'message': 'job not found.'}, 404
+    offset, limit = get_log_args()
+    start, data, complete = read_job_log(job['proc'], offset, limit)
+    response = app.response_class(data, mimetype='text/plain')
+    response.headers['X-Log-Offset'] = str(start)
+    response.headers['X-Log-Next-Offset'] = str(start + len(data))
+    response.headers['X-Log-Complete'] = 'true' if complete else 'false'
+    return response
+
+@app.route("/api/jobs/<int:job_id>/log/stream", methods=["GET"])
+def job_log_stream(job_id):
+    """
+    ジョブの出力を ?offset=N から終了まで送り続ける
+
+    Parameters
+    ----------
+    job_id : int
+        ジョブID
+    """
+    job = ppool.get(job_id)
+    if job is None:
+        return {'message': 'job not found.'}, 404
+    offset, _ = get_log_args()
+    return app.response_class(stream_job_log(job['proc'], offset), mimetype='text/plain',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/api/batch", methods=["POST"])
+def post_batch():
+    """
+    複数セクションのバックアップをまとめて登録する
+
+    JSON の sections(セクション名か {user, target} のリスト)か pattern(グロブ)で指定する。
+    物理デバイスと過去の所要時間から決めた順にスケジューラへ登録し、バッチIDを返す。
+    """
+    body = request.get_json(silent=True) or {}
+    entries = body.get('sections', [])
+    pattern = body.get('pattern', request.args.get('pattern'))
+    if not isinstance(entries, list) or not (pattern is None or isinstance(pattern, str)):
+        return {'message': 'sections must be a list and pattern a string.'}, 400
+    names = []
+    pairs = {}
+    for entry in entries:
+        if isinstance(entry, dict) and isinstance(entry.get('user'), str) and isinstance(entry.get('target'), str):
+            names.append(entry['user'] + '_' + entry['target'])
+            pairs[names[-1]] = (entry['user'], entry['target'])
+        elif isinstance(entry, str):
+            names.append(entry)
+        else:
+            return {'message': 'sections must be section names or {"user", "target"}.'}, 400
+    selected, unknown = batch.match_sections(load_config().sections(), names, pattern)
+    if len(unknown) > 0:
+        return {'message': 'unknown sections.', 'unknown': unknown}, 400
+    if len(selected) == 0:
+        return {'message': 'no section matched.'}, 400
+    for section in selected:
+        if section not in pairs and batch.split_section(section) is not None:
+            pairs[section] = batch.split_section(section)
+    # ユーザー・ターゲットが名前から決まらないセクションは {user, target} で指定してもらう
+    ambiguous = [section for section in selected if section not in pairs]
+    if len(ambiguous) > 0:
+        return {'message': 'specify {"user", "target"} for sections with more than one "_".',
+                'ambiguous': ambiguous}, 400
+    logger.info('execute batch (%s)', ' '.join(selected))
+    new_batch = submit_batch({section: pairs[section] for section in selected}, ppool)
+    if not is_blocking():
+        return dict(get_batch_status(new_batch, ppool), message='accepted.'), 202
+    wait_batch(new_batch, ppool)
+    status = get_batch_status(new_batch, ppool)
+    if status['counts'].get(ProcessPool.ERROR, 0) > 0:
+        return dict(status, message='failed...'), 500
+    return dict(status, message='success!')
+
+@app.route("/api/batch/<int:batch_id>", methods=["GET"])
+def batch_status(batch_id):
+    """
+    バッチの進捗取得
+
+    Parameters
+    ----------
+    batch_id : int
+        バッチID
+    """
+    found = batches.get(batch_id)
+    if found is None:
+        return {'message': 'batch not found.'}, 404
+    wait = request.args.get('wait', type=float)
+    if wait is not None:
+        # 全て終了するか wait 秒経つまで待つ
+        wait_batch(found, ppool, min(max(wait, 0.0), MAX_WAIT))
+    return get_batch_status(found, ppool)
+
 @app.route("/api/<user>/<target>", methods=["POST"])
 def backup(user, target):
     """
@@ -153,18 +1121,77 @@ def backup(user, target):
     target : str
         対象区分
     """
-    exec_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup.py')
-    cmd = ['python3', exec_path, '--user', user, '--target', target]
+    cmd = create_backup_cmd(user, target)
     logger.info('execute backup (%s)', ' '.join(cmd))
-    returncode = exec_backup(cmd, ppool)
-    if returncode == 0:
+    job_id, how = submit_job(cmd, user + '_' + target, ppool)
+    if how == Coalescer.SKIPPED:
+        return {'message': 'success!', 'job_id': job_id, 'skipped': True}
+    if not is_blocking():
+        return {'message': 'accepted.', 'job_id': job_id, 'coalesced': how == Coalescer.ATTACHED}, 202
+    job = ppool.wait(job_id)
+    if job is not None and job['state'] == ProcessPool.FINISHED:
         logger.info('Return success')
-        return {'message': 'success!'}
+        return {'message': 'success!', 'job_id': job_id}
     else:
         logger.info('Return failed')
         # TODO:存在しないキー指定時に400を返す
-        return {'message': 'failed...'}, 500
+        return {'message': 'failed...', 'job_id': job_id}, 500
+
+@app.route("/api/<user>/<target>/verify", methods=["POST"])
+def verify_backup(user, target):
+    """
+    バックアップ世代の検証実行
+
+    Parameters
+    ----------
+    user : str
+        対象ユーザ
+    target : str
+        対象区分
+    """
+    cmd = create_backup_cmd(user, target, verify=True)
+    logger.info('execute verify (%s)', ' '.join(cmd))
+    job_id, how = submit_job(cmd, user + '_' + target, ppool)
+    if how == Coalescer.SKIPPED:
+        return {'message': 'success!', 'job_id': job_id, 'skipped': True, 'report': get_verify_report(user, target)}
+    if not is_blocking():
+        return {'message': 'accepted.', 'job_id': job_id, 'coalesced': how == Coalescer.ATTACHED}, 202
+    job = ppool.wait(job_id)
+    report = get_verify_report(user, target)
+    if job is not None and job['state'] == ProcessPool.FINISHED:
+        logger.info('Return success')
+        return {'message': 'success!', 'job_id': job_id, 'report': report}
+    else:
+        logger.info('Return failed')
+        return {'message': 'failed...', 'job_id': job_id, 'report': report}, 500
+
+@app.route("/api/<user>/<target>/verify", methods=["GET"])
+def verify_report(user, target):
+    """
+    最後の検証結果取得
+
+    Parameters
+    ----------
+    user : str
+        対象ユーザ
+    target : str
+        対象区分
+    """
+    report = get_verify_report(user, target)
+    if report is None:
+        return {'message': 'not verified yet.'}, 404
+    return report
 
 if __name__ == '__main__':
-    ppool = ProcessPool()
+    # スレッドを起動する前にforkしておく
+    if BACKUP_WORKERS > 0:
+        workers = WorkerPool(BACKUP_WORKERS)
+    ppool = ProcessPool(history_size=HISTORY_SIZE or None,
+                        history_age=HISTORY_HOURS*3600 or None,
+                        store=JobStore(JOB_DB))
+    reconcile_jobs(ppool, ppool.restore())
+    job_stats = jobstats.JobStats(jobstats.HistoryStore(HISTORY_DB))
+    job_metrics.track_pool(ppool)
+    job_metrics.load_stats(job_stats.get())
+    watchers = start_watchers(load_config())
     app.run(debug=False, host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,328 @@
+import os
+import sys
+import gzip
+import lzma
+import stat
+import fcntl
+import sqlite3
+import argparse
+import datetime
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger = logging.getLogger(__name__)
+
+from manifest import walk_entries
+import remover
+
+PACK_EXT = '.pack'
+INDEX_EXT = '.pack.idx'
+# 独立して圧縮する単位(この単位で伸長できる)
+CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESSORS = {'gzip': lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+               'xz': lambda data: lzma.compress(data, preset=3)}
+
+def pack_paths(dirpath):
+    """
+    世代ディレクトリに対応するアーカイブのパスを作成
+
+    Parameters
+    ----------
+    dirpath : str
+        世代ディレクトリのパス
+
+    Returns
+    -------
+    pack : str
+        データファイルのパス
+    index : str
+        インデックスのパス
+    """
+    base = dirpath[:-1] if dirpath[-1] == '/' else dirpath
+    return base + PACK_EXT, base + INDEX_EXT
+
+def list_pack_files(dirpath):
+    """
+    世代ディレクトリに対応するアーカイブ関連ファイルを全て列挙する(削除用)
+
+    Parameters
+    ----------
+    dirpath : str
+        世代ディレクトリのパス
+
+    Returns
+    -------
+    paths : list of str
+    """
+    pack, index = pack_paths(dirpath)
+    return [pack, index, pack + '.lock', pack + '.tmp', index + '.tmp']
+
+def _read_chunks(path):
+    """
+    ファイルを CHUNK_SIZE ごとに読む
+    """
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+def create_pack(src_dir, pack, index, compression='gzip', workers=2):
+    """
+    ディレクトリツリーを圧縮アーカイブに変換する
+
+    通常ファイルはチャンクごとに独立した gzip/xz ストリームとして連結し、
+    メンバーの位置と属性を SQLite のインデックスに記録する。
+    読み込みは順次、圧縮はスレッドプールで並列に行い、書き込みは読み込み順に行う。
+
+    Parameters
+    ----------
+    src_dir : str
+        変換元ディレクトリ
+    pack : str
+        データファイルのパス
+    index : str
+        インデックスのパス
+    compression : str, default gzip
+        圧縮方式(gzip, xz)
+    workers : int, default 2
+        圧縮スレッド数
+
+    Returns
+    -------
+    counts : dict of {str: int}
+        メンバー数(members)、元サイズ(bytes)、圧縮後サイズ(packed)
+    """
+    compress = COMPRESSORS[compression]
+    workers = max(1, workers)
+    counts = {'members': 0, 'bytes': 0, 'packed': 0}
+    conn = sqlite3.connect(index)
+    try:
+        conn.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE members (
+                path TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                mode INTEGER NOT NULL,
+                link TEXT,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                         [('compression', compression), ('source', src_dir),
+                          ('created_at', datetime.datetime.now().isoformat())])
+        with open(pack, 'wb') as out, ThreadPoolExecutor(max_workers=workers) as executor:
+            # (メンバー行, 圧縮中のチャンク, 最終チャンクか) を読み込み順に保持する
+            inflight = collections.deque()
+
+            def write_head():
+                row, future, last = inflight.popleft()
+                data = future.result()
+                if row[6] is None:
+                    row[6] = out.tell()
+                out.write(data)
+                row[7] += len(data)
+                if last:
+                    conn.execute('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+            for relpath, st in walk_entries(src_dir):
+                counts['members'] += 1
+                if stat.S_ISDIR(st.st_mode):
+                    conn.execute('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (relpath, 'd', 0, st.st_mtime_ns, st.st_mode, None, 0, 0))
+                elif stat.S_ISLNK(st.st_mode):
+                    conn.execute('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (relpath, 'l', 0, st.st_mtime_ns, st.st_mode,
+                                  os.readlink(os.path.join(src_dir, relpath)), 0, 0))
+                elif stat.S_ISREG(st.st_mode):
+                    row = [relpath, 'f', st.st_size, st.st_mtime_ns, st.st_mode, None, None, 0]
+                    chunks = _read_chunks(os.path.join(src_dir, relpath))
+                    data = next(chunks, None)
+                    if data is None:
+                        row[6] = 0
+                        conn.execute('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+                        continue
+                    while data is not None:
+                        following = next(chunks, None)
+                        inflight.append((row, executor.submit(compress, data), following is None))
+                        data = following
+                        # 先読みしすぎないよう、溜まったら書き出す
+                        while len(inflight) >= workers * 2 or (len(inflight) > 0 and inflight[0][1].done()):
+                            write_head()
+                    counts['bytes'] += st.st_size
+                else:
+                    counts['members'] -= 1
+                    logger.warning('special file is not archived: %s', relpath)
+            while len(inflight) > 0:
+                write_head()
+            counts['packed'] = out.tell()
+        conn.commit()
+    finally:
+        conn.close()
+    return counts
+
+class _RangeReader:
+    """
+    ファイルの一部範囲だけを読むファイルライクオブジェクト
+    """
+
+    def __init__(self, f, offset, length):
+        self._f = f
+        self._f.seek(offset)
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def readable(self):
+        return True
+
+def extract_member(pack, index, relpath, out):
+    """
+    アーカイブから1ファイルだけを取り出す
+
+    インデックスで位置を引き、そのメンバーのストリームだけを伸長する。
+
+    Parameters
+    ----------
+    pack : str
+        データファイルのパス
+    index : str
+        インデックスのパス
+    relpath : str
+        取り出すファイルの相対パス
+    out : file object
+        書き込み先(バイナリ)
+
+    Returns
+    -------
+    size : int
+        書き込んだバイト数
+    """
+    conn = sqlite3.connect('file:%s?mode=ro' % index, uri=True)
+    try:
+        compression = conn.execute("SELECT value FROM meta WHERE key = 'compression'").fetchone()[0]
+        row = conn.execute('SELECT type, offset, length FROM members WHERE path = ?', (relpath,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        raise FileNotFoundError(relpath)
+    if row[0] != 'f':
+        raise IsADirectoryError(relpath) if row[0] == 'd' else OSError('not a regular file: %s' % relpath)
+    size = 0
+    if row[2] == 0:
+        return size
+    with open(pack, 'rb') as f:
+        reader = _RangeReader(f, row[1], row[2])
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=reader, mode='rb')
+        else:
+            stream = lzma.LZMAFile(reader, mode='rb')
+        with stream:
+            while True:
+                data = stream.read(CHUNK_SIZE)
+                if not data:
+                    break
+                out.write(data)
+                size += len(data)
+    return size
+
+def archive_generation(dirpath, compression='gzip', workers=2):
+    """
+    世代ディレクトリをアーカイブに変換し、元のディレクトリを削除する
+
+    同じ世代を変換中の他プロセスがあれば何もしない。
+
+    Parameters
+    ----------
+    dirpath : str
+        世代ディレクトリのパス
+    compression : str, default gzip
+        圧縮方式(gzip, xz)
+    workers : int, default 2
+        圧縮スレッド数
+
+    Returns
+    -------
+    returncode : int
+        終了コード
+    """
+    pack, index = pack_paths(dirpath)
+    lock_fd = os.open(pack + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info('%s is being archived by another process', dirpath)
+            return 0
+        if not os.path.isdir(dirpath):
+            return 0
+        for tmppath in [pack + '.tmp', index + '.tmp']:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        try:
+            counts = create_pack(dirpath, pack + '.tmp', index + '.tmp', compression, workers)
+        except (OSError, sqlite3.Error) as e:
+            logger.error('Failed to archive %s: %s', dirpath, e)
+            for tmppath in [pack + '.tmp', index + '.tmp']:
+                if os.path.exists(tmppath):
+                    os.remove(tmppath)
+            return 1
+        # データファイルがあればアーカイブ完成とみなすので、インデックスを先に置く
+        os.replace(index + '.tmp', index)
+        os.replace(pack + '.tmp', pack)
+        logger.info('archived %s : %d members, %d bytes -> %d bytes',
+                    dirpath, counts['members'], counts['bytes'], counts['packed'])
+        stats = remover.remove_trees([dirpath], workers)
+        logger.info('%s', stats)
+        return 0 if stats.errors == 0 else 1
+    finally:
+        os.close(lock_fd)
+
+def main(args=sys.argv[1:]):
+    """
+    バックグラウンド変換・1ファイル復元のエントリポイント
+
+    Parameters
+    ----------
+    args : list
+        コマンド引数
+
+    Returns
+    -------
+    returncode : int
+        終了コード
+    """
+    parser = argparse.ArgumentParser(description='Archive past generations')
+    parser.add_argument('--compression', dest='COMPRESSION', choices=sorted(COMPRESSORS), default='gzip')
+    parser.add_argument('--workers', dest='WORKERS', type=int, default=2)
+    parser.add_argument('--log', dest='LOG', type=str, default=None)
+    parser.add_argument('--restore', dest='RESTORE', type=str, default=None,
+                        help='restore this relative path from the given pack to stdout')
+    parser.add_argument('paths', nargs='+')
+    options = parser.parse_args(args)
+
+    LOG_FORMAT = '[%(levelname)s] %(asctime)s : %(name)s(%(lineno)s) %(message)s'
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    if options.LOG is not None:
+        filehandler = logging.FileHandler(options.LOG, mode='a', encoding='UTF-8')
+        filehandler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+        logging.getLogger().addHandler(filehandler)
+
+    if options.RESTORE is not None:
+        pack = options.paths[0]
+        extract_member(pack, pack[:-len(PACK_EXT)] + INDEX_EXT, options.RESTORE, sys.stdout.buffer)
+        return 0
+    return max([archive_generation(path, options.COMPRESSION, options.WORKERS) for path in options.paths])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,30 @@
 import os
 import sys
-import glob
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 import logging
 logger = logging.getLogger(__name__)
 
 from process import Process
 from settings import Settings
+import snapshot
+import remover
+import rsyncshard
+import manifest
+import watcher
+import mountutil
+import archive
+import rsyncstat
+import generations
+import checkpoint
+import verify
+import joblock
+
+# 中断された転送は --partial-dir に残して再実行時に続きから送る
+PARTIAL_DIR = '.rsync-partial'
+RSYNC_OPTIONS = ['-avE', '--delete-after', '--copy-unsafe-links', '--info=progress2,stats2',
+                 '--partial-dir='+PARTIAL_DIR]
 
 def exec_with_startend_log(additional):
     # 実行時に開始終了ログを付与するラッパー
@@ -29,19 +48,96 @@ def forceexit_when_error(func):
     return wrapper
 
 @forceexit_when_error
-def exec_mount_all():
+def exec_mount(setting):
     """
-    sudo mount -a 実行
+    source, dest に必要なファイルシステムがマウントされているか確認し、足りなければマウントする
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
 
     Returns
     -------
     endcode : int
         終了コード
     """
-    cmd = ['sudo', 'mount', '-a']
-    proc = Process(cmd=cmd)
-    proc.execute(wait=True)
-    return proc.returncode
+    if setting.NO_MOUNT:
+        # app.py がサーバ全体で共有するキャッシュで確認済み
+        return 0
+    return mountutil.checker.ensure([setting.SOURCE, setting.DEST], setting.MOUNTS)
+
+def load_generations(setting):
+    """
+    セクションの世代カタログを読み込む
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    catalog : generations.GenerationCatalog
+    """
+    return generations.GenerationCatalog(os.path.join(setting.STATE_DIR, setting.TARGET + '_generations.json'),
+                                         setting.DEST, setting.LOG[:setting.LOG.rfind('_')])
+
+def get_retention(setting):
+    """
+    保持ポリシーを取得する
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    retention : tuple of int
+        日次・週次・月次で残す世代数
+    """
+    keep_daily = setting.KEEP_COUNT if setting.KEEP_DAILY is None else setting.KEEP_DAILY
+    return keep_daily, setting.KEEP_WEEKLY, setting.KEEP_MONTHLY
+
+def get_link_dest(setting):
+    """
+    rsync --link-dest に渡す前世代ディレクトリを取得する
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    link_dest : str or None
+        前世代ディレクトリの絶対パス(hardlink で世代を作らないときはNone)
+    """
+    if setting.SNAPSHOT != 'hardlink' or setting.PASS_CP or sum(get_retention(setting)) == 0:
+        return None
+    if not os.path.isdir(setting.CPDEST):
+        return None
+    # 相対パスは同期先からの相対になるので絶対パスで渡す
+    return os.path.abspath(setting.CPDEST)
+
+def get_rsync_options(setting):
+    """
+    rsyncの共通オプションを取得する
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    list of str
+    """
+    link_dest = get_link_dest(setting)
+    if link_dest is None:
+        return list(RSYNC_OPTIONS)
+    return RSYNC_OPTIONS + ['--link-dest='+link_dest]
 
 @exec_with_startend_log('Copy recent directory')
 @forceexit_when_error
@@ -63,16 +159,153 @@ def exec_cp(setting):
     if setting.PASS_CP:
         logger.info('passing cp is given. cp is not to execute.')
         return 0
-    # KEEP_COUNTが0なら世代コピーを作らない
-    if setting.KEEP_COUNT == 0:
+    # 保持する世代がなければ世代コピーを作らない
+    if sum(get_retention(setting)) == 0:
         logger.info('keep count is 0. cp is not to execute.')
         return 0
+    # hardlinkなら最新ディレクトリを世代に改名し、rsync --link-dest で変更のないファイルだけを共有する
+    if setting.SNAPSHOT == 'hardlink':
+        try:
+            snapshot.rotate(setting.DEST, setting.CPDEST)
+        except OSError as e:
+            logger.error('Failed to rotate %s to %s: %s', setting.DEST, setting.CPDEST, e)
+            return 1
+    else:
+        cmd = ['cp', '-avR', setting.DEST, setting.CPDEST]
+        proc = Process(cmd=cmd, out_to_log=True)
+        proc.execute(wait=True)
+        if proc.returncode != 0:
+            return proc.returncode
+    # 世代カタログに登録
+    load_generations(setting).add(generations.DIRS, setting.DATE_LAST)
+    return 0
+
+def _exec_rsync_unit(cmd, progress, unit=''):
+    """
+    rsyncを1つ実行し、終了コードと所要時間を返す
+
+    Parameters
+    ----------
+    cmd : list
+        実行するrsyncコマンド
+    progress : rsyncstat.RsyncProgress
+        進捗の集計先
+    unit : str, default ''
+        作業単位名
+
+    Returns
+    -------
+    returncode : int
+        終了コード
+    elapsed : float
+        所要時間(s)
+    """
+    start = time.monotonic()
+    proc = Process(cmd=cmd, out_to_log=True, handlers=[progress.handler(unit)])
+    proc.execute(wait=True)
+    progress.finish(unit)
+    return proc.returncode, time.monotonic() - start
+
+def exec_rsync_sharded(setting, progress):
+    """
+    バックアップ元を直下のエントリ単位に分割してrsyncを並列実行する
+
+    最後に直下だけを対象に削除のみのrsyncを行い、
+    単一実行の --delete-after と同じく全転送の後に削除する。
 
-    cmd = ['cp', '-avR', setting.DEST, setting.CPDEST]
+    Parameters
+    ----------
+    setting : Settings
+        設定
+    progress : rsyncstat.RsyncProgress
+        進捗の集計先
+
+    Returns
+    -------
+    endcode : int
+        終了コード
+    """
+    units = rsyncshard.list_units(setting.SOURCE)
+    weights_path = os.path.join(setting.STATE_DIR, setting.TARGET + '_shards.json')
+    order = rsyncshard.plan_units(units, rsyncshard.load_weights(weights_path))
+    logger.info('rsync %d units with %d workers', len(order), setting.RSYNC_WORKERS)
+
+    rcodes = {}
+    weights = {}
+    with ThreadPoolExecutor(max_workers=setting.RSYNC_WORKERS) as executor:
+        futures = {name: executor.submit(_exec_rsync_unit, ['rsync'] + get_rsync_options(setting) + units[name] + [setting.DEST],
+                                         progress, name)
+                   for name in order}
+        for name, future in futures.items():
+            rcodes[name], weights[name] = future.result()
+    rsyncshard.save_weights(weights_path, weights)
+
+    rcode = max(rcodes.values(), default=0)
+    if rcode != 0:
+        logger.error('rsync failed in units : %s',
+                     ','.join([name or '(files)' for name, code in rcodes.items() if code != 0]))
+        return rcode
+
+    # 直下で不要になったエントリの削除(転送はしない)
+    cmd = ['rsync', '-dv', '--delete-after', '--existing', '--ignore-existing', '--partial-dir='+PARTIAL_DIR,
+           setting.SOURCE, setting.DEST]
     proc = Process(cmd=cmd, out_to_log=True)
     proc.execute(wait=True)
     return proc.returncode
 
+def exec_rsync_journal(relpaths, setting, progress):
+    """
+    変更ジャーナルに記録されたパスだけをrsyncする
+
+    Parameters
+    ----------
+    relpaths : list of str
+        バックアップ元からの相対パス
+    setting : Settings
+        設定
+    progress : rsyncstat.RsyncProgress
+        進捗の集計先
+
+    Returns
+    -------
+    endcode : int
+        終了コード
+    """
+    if len(relpaths) == 0:
+        logger.info('No change is journaled. rsync is not to execute.')
+        return 0
+    files_from = os.path.join(setting.STATE_DIR, setting.SECTION + '_journal.files')
+    with open(files_from, 'wb') as f:
+        f.write(b''.join(os.fsencode(relpath) + b'\0' for relpath in relpaths))
+    logger.info('rsync %d journaled paths', len(relpaths))
+    # 消えたパスは --delete-missing-args で削除、新しいディレクトリは -r で中身ごと転送する
+    cmd = ['rsync'] + get_rsync_options(setting) + ['-r', '--from0', '--files-from='+files_from, '--delete-missing-args',
+                                       setting.SOURCE, setting.DEST]
+    return _exec_rsync_unit(cmd, progress)[0]
+
+def exec_rsync_full(setting, progress):
+    """
+    バックアップ元全体をrsyncする
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+    progress : rsyncstat.RsyncProgress
+        進捗の集計先
+
+    Returns
+    -------
+    endcode : int
+        終了コード
+    """
+    # 分割はバックアップ元の中身を同期する(末尾/あり)ときのみ
+    if setting.RSYNC_WORKERS > 1 and setting.SOURCE.endswith('/'):
+        return exec_rsync_sharded(setting, progress)
+
+    cmd = ['rsync'] + get_rsync_options(setting) + [setting.SOURCE, setting.DEST]
+    return _exec_rsync_unit(cmd, progress)[0]
+
 @exec_with_startend_log('Backup by rsync')
 @forceexit_when_error
 def exec_rsync(setting):
@@ -89,10 +322,30 @@ def exec_rsync(setting):
     endcode : int
         終了コード
     """
-    cmd = ['rsync', '-avE', '--delete-after', '--copy-unsafe-links', setting.SOURCE, setting.DEST]
-    proc = Process(cmd=cmd, out_to_log=True)
-    proc.execute(wait=True)
-    return proc.returncode
+    progress = rsyncstat.RsyncProgress()
+    try:
+        if not setting.WATCH:
+            return exec_rsync_full(setting, progress)
+        if not setting.SOURCE.endswith('/'):
+            logger.warning('journal needs source ending with /. full scan is executed.')
+            return exec_rsync_full(setting, progress)
+
+        journal = watcher.Journal(setting.STATE_DIR, setting.SECTION)
+        relpaths = journal.take()
+        # --link-dest では同期先が空から始まるので、変更のないパスも含めて全体を走査する
+        full_scan = relpaths is None or get_link_dest(setting) is not None
+        if full_scan:
+            rcode = exec_rsync_full(setting, progress)
+        else:
+            rcode = exec_rsync_journal(relpaths, setting, progress)
+        # 失敗したらジャーナルを戻して次回に再実行させる
+        if rcode == 0:
+            journal.commit(full_scan=full_scan)
+        else:
+            journal.rollback()
+        return rcode
+    finally:
+        progress.log()
 
 def get_dates_to_remove(setting, is_log=False):
     """
@@ -110,33 +363,18 @@ def get_dates_to_remove(setting, is_log=False):
     dates : list
         削除対象の日付リスト(YYYYmmdd)
     """
-    # 種類取得
-    backup_type = setting.TARGET
-    # 対象ディレクトリ取得
-    if is_log:
-        dest_dir = os.path.dirname(setting.DEST[:-1]) + '/log/' + backup_type
-    else:
-        dest_dir = setting.DEST[:-1]
-    dirs_sametype = glob.glob(dest_dir+'_*')
-    # 日付つきのみに限定
-    dirs_sametype = [os.path.splitext(dirname)[0] for dirname in dirs_sametype if os.path.splitext(dirname)[0][-8:].isdecimal()]
-    # 日付抽出
-    dates_sametype = [[idx,int(dirname[-8:])] for idx, dirname in enumerate(dirs_sametype)]
-    # 日付部分でソート
-    dates_sametype = sorted(dates_sametype, key=lambda x: x[1])
-    # KEEP_COUNTで削る
-    if len(dates_sametype) <= setting.KEEP_COUNT+int(is_log):
-        return []
-    else:
-        remove_targets = dates_sametype[:len(dates_sametype)-(setting.KEEP_COUNT+int(is_log))]
-        return [str(rt[1]) for rt in remove_targets]
+    # 世代カタログから保持ポリシーで選ぶ(ログは今回分も含むので日次を1つ多く残す)
+    catalog = load_generations(setting)
+    keep_daily, keep_weekly, keep_monthly = get_retention(setting)
+    kind = generations.LOGS if is_log else generations.DIRS
+    return generations.select_to_remove(catalog.get(kind), keep_daily+int(is_log), keep_weekly, keep_monthly)
 
 
 @exec_with_startend_log('Remove past directory')
 @forceexit_when_error
 def exec_rm_dir(dates, setting):
     """
-    rm実行(directory)
+    過去世代ディレクトリの削除
 
     Parameters
     ----------
@@ -150,23 +388,44 @@ def exec_rm_dir(dates, setting):
     endcode : int
         終了コード
     """
-    # 日付を削除対象に変換
+    # 日付を削除対象に変換(アーカイブ済みの世代も含む)
     rmdests = [Settings.create_dirpath_with_date(setting.DEST, date) for date in dates]
     # 削除
     if len(rmdests) == 0:
         logger.info('No directory is to remove.')
         return 0
-    for rmdest in rmdests:
-        cmd = ['rm', '-rfv', rmdest]
-        proc = Process(cmd=cmd, out_to_log=True)
-        proc.execute(wait=True)
-        return proc.returncode
+    rmdests += [path for rmdest in rmdests for path in archive.list_pack_files(rmdest)]
+    # バックグラウンドならゴミ箱に移して切り離したプロセスで削除する
+    if setting.RM_BACKGROUND:
+        try:
+            trash_dirs = remover.move_to_trash(rmdests)
+        except OSError as e:
+            logger.error('Failed to move to trash: %s', e)
+            return 1
+        trash_entries = [os.path.join(trash_dir, name) for trash_dir in trash_dirs for name in os.listdir(trash_dir)]
+        if len(trash_entries) == 0:
+            return 0
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remover.py'),
+               '--workers', str(setting.RM_WORKERS), '--log', setting.LOG] + trash_entries
+        proc = Process(cmd=cmd)
+        proc.execute(detach=True)
+        logger.info('removing %s in background (pid %d)', ' '.join(rmdests), proc.pid)
+        load_generations(setting).remove(generations.DIRS, dates)
+        logger.info(remover.format_removed(generations.DIRS, len(dates)))
+        return 0
+    stats = remover.remove_trees(rmdests, setting.RM_WORKERS)
+    logger.info('%s', stats)
+    if stats.errors > 0:
+        return 1
+    load_generations(setting).remove(generations.DIRS, dates)
+    logger.info(remover.format_removed(generations.DIRS, len(dates)))
+    return 0
 
 @exec_with_startend_log('Remove past log')
 @forceexit_when_error
 def exec_rm_log(dates, setting):
     """
-    rm実行(log)
+    過去ログの削除
 
     Parameters
     ----------
@@ -186,15 +445,122 @@ def exec_rm_log(dates, setting):
     if len(rmdests) == 0:
         logger.info('No log is to remove.')
         return 0
-    for rmdest in rmdests:
-        cmd = ['rm', '-rfv', rmdest]
-        proc = Process(cmd=cmd, out_to_log=True)
-        proc.execute(wait=True)
-        return proc.returncode
+    stats = remover.remove_trees(rmdests, setting.RM_WORKERS)
+    logger.info('%s', stats)
+    if stats.errors > 0:
+        return 1
+    load_generations(setting).remove(generations.LOGS, dates)
+    logger.info(remover.format_removed(generations.LOGS, len(dates)))
+    return 0
 
-def main(setting):
+@exec_with_startend_log('Record manifest')
+def exec_manifest(dates, setting):
     """
-    エントリポイント
+    今回世代のマニフェストを記録し、削除した世代のマニフェストを消す
+
+    Parameters
+    ----------
+    dates : list
+        削除した日付リスト(YYYYmmdd)
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    endcode : int
+        終了コード
+    """
+    if not setting.MANIFEST:
+        logger.info('manifest is disabled.')
+        return 0
+    try:
+        catalog = manifest.Manifest(os.path.join(setting.STATE_DIR, setting.TARGET + '_manifest.sqlite'))
+        try:
+            counts = catalog.record(setting.DATE_CURRENT, setting.DEST, with_hash=setting.MANIFEST_HASH)
+            catalog.remove(dates)
+        finally:
+            catalog.close()
+    except (OSError, sqlite3.Error) as e:
+        # バックアップ自体は終わっているので失敗扱いにはしない
+        logger.warning('Failed to record manifest: %s', e)
+        return 0
+    logger.info('manifest %s : %d files (%d reused, %d hashed), %d bytes', setting.DATE_CURRENT,
+                counts['files'], counts['reused'], counts['hashed'], counts['bytes'])
+    return 0
+
+@exec_with_startend_log('Archive past directory')
+def exec_archive(setting):
+    """
+    新しい ARCHIVE_AFTER 世代より古い世代ディレクトリを、切り離したプロセスで圧縮アーカイブに変換する
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    endcode : int
+        終了コード
+    """
+    if setting.ARCHIVE_AFTER <= 0:
+        return 0
+    # 世代カタログの古い日付のうち、まだディレクトリのものを対象にする
+    dates = load_generations(setting).get(generations.DIRS)[::-1][setting.ARCHIVE_AFTER:]
+    targets = [dirpath for dirpath in (Settings.create_dirpath_with_date(setting.DEST, date) for date in dates)
+               if os.path.isdir(dirpath)]
+    if len(targets) == 0:
+        logger.info('No directory is to archive.')
+        return 0
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive.py'),
+           '--compression', setting.ARCHIVE_COMPRESSION, '--workers', str(setting.ARCHIVE_WORKERS),
+           '--log', setting.LOG] + targets
+    proc = Process(cmd=cmd)
+    proc.execute(detach=True)
+    logger.info('archiving %s in background (pid %d)', ' '.join(targets), proc.pid)
+    return 0
+
+@exec_with_startend_log('Verify generations')
+def exec_verify(setting):
+    """
+    最新と過去世代のファイルをハッシュして検証する
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    endcode : int
+        終了コード(不一致があれば1)
+    """
+    # 最新はバックアップ元とも比較する。アーカイブ済みの世代は対象外
+    roots = [('', setting.DEST, setting.SOURCE)]
+    for date in load_generations(setting).get(generations.DIRS):
+        dirpath = Settings.create_dirpath_with_date(setting.DEST, date)
+        if os.path.isdir(dirpath):
+            roots.append((date, dirpath, None))
+    try:
+        store = verify.DigestStore(os.path.join(setting.STATE_DIR, setting.TARGET + '_verify.sqlite'))
+        try:
+            store.prune([generation for generation, _, _ in roots])
+            verifier = verify.Verifier(store, setting.VERIFY_WORKERS, setting.VERIFY_MAX_AGE*24*3600)
+            for generation, root, source in roots:
+                verifier.verify_tree(generation, root, source)
+        finally:
+            store.close()
+        verify.save_report(os.path.join(setting.STATE_DIR, setting.TARGET + '_verify.json'),
+                           setting.SECTION, verifier.report)
+    except (OSError, sqlite3.Error) as e:
+        logger.error('Failed to verify: %s', e)
+        return 1
+    logger.info('%s', verifier.report)
+    return 0 if len(verifier.report.mismatches) == 0 else 1
+
+def run(setting):
+    """
+    バックアップ本体
 
     Parameters
     ----------
@@ -207,29 +573,88 @@ def main(setting):
         終了コード
     """
     # 予めマウント
-    exec_mount_all()
+    exec_mount(setting)
+
+    # 検証のみ
+    if setting.VERIFY:
+        return exec_verify(setting)
+
+    # 前回中断したフェーズから再開する
+    ckpt = checkpoint.Checkpoint(os.path.join(setting.STATE_DIR, setting.TARGET + '_checkpoint.json'),
+                                 setting.DATE_LAST, setting.DATE_CURRENT)
 
     # 世代バックアップの作成
-    exec_cp(setting)
+    if not ckpt.is_done('cp'):
+        # 途中まで作られた世代コピーは作り直す(hardlinkの世代は改名なので途中の状態はない)
+        if ckpt.is_started('cp') and setting.SNAPSHOT != 'hardlink' and os.path.exists(setting.CPDEST):
+            logger.info('removing partial copy %s', setting.CPDEST)
+            remover.remove_trees([setting.CPDEST], setting.RM_WORKERS)
+        ckpt.start('cp')
+        exec_cp(setting)
+        ckpt.done('cp')
 
     # rsyncによるバックアップ
-    exec_rsync(setting)
-
-    # 不要世代の洗い出し
-    rm_dates = get_dates_to_remove(setting)
-    # 不要世代の削除
-    exec_rm_dir(rm_dates, setting)
-    # 不要世代の洗い出し
-    rm_log_dates = get_dates_to_remove(setting, is_log=True)
-    # 不要世代ログの削除
-    exec_rm_log(rm_log_dates, setting)
+    if not ckpt.is_done('rsync'):
+        ckpt.start('rsync')
+        exec_rsync(setting)
+        ckpt.done('rsync')
+
+    # 今回のログを世代カタログに登録
+    load_generations(setting).add(generations.LOGS, setting.DATE_CURRENT)
+
+    if not ckpt.is_done('retention'):
+        ckpt.start('retention')
+        # 不要世代の洗い出し
+        rm_dates = get_dates_to_remove(setting)
+        ckpt.set('rm_dates', sorted(set(ckpt.get('rm_dates', []) + rm_dates)))
+        # 不要世代の削除
+        exec_rm_dir(rm_dates, setting)
+        # 不要世代の洗い出し
+        rm_log_dates = get_dates_to_remove(setting, is_log=True)
+        # 不要世代ログの削除
+        exec_rm_log(rm_log_dates, setting)
+        ckpt.done('retention')
+    rm_dates = ckpt.get('rm_dates', [])
+
+    # 古い世代のアーカイブ
+    exec_archive(setting)
+
+    # マニフェストの記録
+    exec_manifest(rm_dates, setting)
 
     # config.iniのエクスポート
     setting.export_config()
+    ckpt.clear()
 
     return 0
 
 
+def main(setting):
+    """
+    エントリポイント
+
+    同じリソースを使う他のバックアップの終了を待ってから実行する。
+
+    Parameters
+    ----------
+    setting : Settings
+        設定
+
+    Returns
+    -------
+    returncode : int
+        終了コード
+    """
+    if setting.NO_LOCK:
+        return run(setting)
+    # app.py のジョブはセクションのロックを取るので、device のときもセクションを排他する
+    with joblock.ResourceLock(setting.SECTION):
+        if setting.LOCK_KEY == 'section':
+            return run(setting)
+        with joblock.ResourceLock(joblock.resource_key(setting.SECTION, setting.DEST, setting.LOCK_KEY)):
+            return run(setting)
+
+
 if __name__ == "__main__":
     setting = Settings()
-    main(setting)
\ No newline at end of file
+    sys.exit(main(setting))
\ No newline at end of file
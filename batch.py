@@ -0,0 +1,183 @@
+import fnmatch
+import datetime
+import itertools
+import threading
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+# 残しておくバッチの件数
+MAX_BATCHES = 100
+
+def match_sections(sections, names=(), pattern=None):
+    """
+    バッチの対象セクションを選ぶ
+
+    Parameters
+    ----------
+    sections : list of str
+        設定にあるセクション
+    names : list of str, default ()
+        指定されたセクション名
+    pattern : str, default None
+        セクション名のグロブ(例: foo_*)
+
+    Returns
+    -------
+    selected : list of str
+        対象セクション(重複なし、指定順)
+    unknown : list of str
+        設定にないセクション名
+    """
+    selected = list(OrderedDict.fromkeys(name for name in names if name in sections))
+    unknown = [name for name in names if name not in sections]
+    if pattern is not None:
+        selected += [name for name in fnmatch.filter(sections, pattern) if name not in selected]
+    return selected, unknown
+
+def split_section(section):
+    """
+    セクション名をユーザーとターゲットに分ける
+
+    Parameters
+    ----------
+    section : str
+        セクション名(user_target)
+
+    Returns
+    -------
+    tuple of (str, str) or None
+        ユーザーとターゲット(_ が1つでなければ分け方が決まらないのでNone)
+    """
+    if section.count('_') != 1:
+        return None
+    user, target = section.split('_')
+    if len(user) == 0 or len(target) == 0:
+        return None
+    return user, target
+
+def plan(items):
+    """
+    ジョブの実行順を決める
+
+    優先度の高い順に、物理デバイスが最も早く空くジョブ(同じなら所要時間の長いもの)から並べる
+    (リストスケジューリング)。別々のディスクのジョブが並列に走り、長いジョブが後回しに
+    ならないので全体の所要時間(makespan)が短くなる。
+
+    Parameters
+    ----------
+    items : list of dict
+        section, devices, priority, duration(推定所要時間 s)を持つジョブ
+
+    Returns
+    -------
+    list of dict
+        実行順に並べたジョブ(推定の開始 start と終了 finish(バッチ開始からの s)を加える)
+    """
+    free = {}
+    ordered = []
+    for _, group in itertools.groupby(sorted(items, key=lambda item: -item['priority']),
+                                      key=lambda item: item['priority']):
+        remaining = list(group)
+        while len(remaining) > 0:
+            def start_of(item):
+                return max([free.get(dev, 0.0) for dev in item['devices']], default=0.0)
+
+            item = min(remaining, key=lambda item: (start_of(item), -item['duration']))
+            remaining.remove(item)
+            start = start_of(item)
+            finish = start + item['duration']
+            for dev in item['devices']:
+                free[dev] = finish
+            ordered.append(dict(item, start=round(start, 3), finish=round(finish, 3)))
+    return ordered
+
+class Batch:
+    """
+    まとめて登録したジョブ
+
+    Attributes
+    ----------
+    id : int
+        バッチID
+    created_at : str
+        登録日時
+    jobs : list of dict
+        実行順のジョブ(section, job_id, how, start, finish)
+    """
+
+    def __init__(self, batch_id, jobs):
+        self.id = batch_id
+        self.created_at = datetime.datetime.now().isoformat()
+        self.jobs = jobs
+
+    def progress(self, get_job):
+        """
+        進捗を集計する
+
+        Parameters
+        ----------
+        get_job : function
+            ジョブIDから状態(pending, running, finished, error, unknown)を返す関数
+
+        Returns
+        -------
+        dict
+            状態ごとのジョブ数(counts)、終了したジョブの割合(progress)、全て終了したか(done)と各ジョブの状態
+        """
+        jobs = [dict(job, state=get_job(job['job_id'])) for job in self.jobs]
+        counts = {}
+        for job in jobs:
+            counts[job['state']] = counts.get(job['state'], 0) + 1
+        # 履歴から消えたジョブ(unknown)も終了したものとする
+        completed = len(jobs) - counts.get('pending', 0) - counts.get('running', 0)
+        return {'batch_id': self.id, 'created_at': self.created_at, 'total': len(jobs), 'counts': counts,
+                'progress': round(completed / len(jobs), 3) if len(jobs) > 0 else 1.0,
+                'done': completed == len(jobs),
+                'estimated_makespan': max([job['finish'] for job in jobs], default=0.0),
+                'jobs': jobs}
+
+class BatchRegistry:
+    """
+    バッチを保持するクラス(古いものから捨てる)
+
+    Attributes
+    ----------
+    max_batches : int, default MAX_BATCHES
+        残す件数
+    """
+
+    def __init__(self, max_batches=MAX_BATCHES):
+        self.max_batches = max_batches
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._batches = OrderedDict()
+
+    def add(self, jobs):
+        """
+        バッチを登録する
+
+        Parameters
+        ----------
+        jobs : list of dict
+            実行順のジョブ
+
+        Returns
+        -------
+        batch : Batch
+        """
+        with self._lock:
+            batch = Batch(next(self._ids), jobs)
+            self._batches[batch.id] = batch
+            while len(self._batches) > self.max_batches:
+                self._batches.popitem(last=False)
+        return batch
+
+    def get(self, batch_id):
+        """
+        Returns
+        -------
+        batch : Batch or None
+        """
+        with self._lock:
+            return self._batches.get(batch_id)
@@ -0,0 +1,88 @@
+import os
+import json
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+STARTED = 'started'
+DONE = 'done'
+# 実行日付が変わっても引き継げるフェーズ(前回日付の世代コピーは日付によらない)
+CARRYOVER_PHASES = ('cp',)
+
+class Checkpoint:
+    """
+    バックアップのフェーズごとの進行状況を保存するクラス
+
+    異常終了後の再実行では完了済みのフェーズを飛ばす。
+    前回日付(date_last)が変わっていれば別の世代の作業とみなして破棄し、
+    実行日付が変わっていれば CARRYOVER_PHASES 以外をやり直す。
+
+    Attributes
+    ----------
+    path : str
+        保存先ファイルのパス
+    state : dict
+        date_last, date_current, phases(フェーズ名: started/done), data
+    """
+
+    def __init__(self, path, date_last, date_current):
+        self.path = path
+        try:
+            with open(path, encoding='UTF-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = None
+        if state is None or state.get('date_last') != date_last:
+            state = {'phases': {}, 'data': {}}
+        elif state.get('date_current') != date_current:
+            state['phases'] = {phase: status for phase, status in state['phases'].items()
+                               if phase in CARRYOVER_PHASES}
+            state['data'] = {}
+        elif len(state['phases']) > 0:
+            logger.info('resuming from checkpoint: %s', state['phases'])
+        state['date_last'] = date_last
+        state['date_current'] = date_current
+        self.state = state
+
+    def save(self):
+        """
+        電源断でも壊れないよう、一時ファイルに書いて置き換える
+        """
+        self.state['updated_at'] = datetime.datetime.now().isoformat()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w', encoding='UTF-8') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, self.path)
+
+    def is_started(self, phase):
+        return self.state['phases'].get(phase) == STARTED
+
+    def is_done(self, phase):
+        return self.state['phases'].get(phase) == DONE
+
+    def start(self, phase):
+        self.state['phases'][phase] = STARTED
+        self.save()
+
+    def done(self, phase):
+        self.state['phases'][phase] = DONE
+        self.save()
+
+    def get(self, key, default=None):
+        return self.state['data'].get(key, default)
+
+    def set(self, key, value):
+        self.state['data'][key] = value
+        self.save()
+
+    def clear(self):
+        """
+        全フェーズが終わったら削除する
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.state = {'date_last': self.state['date_last'], 'date_current': self.state['date_current'],
+                      'phases': {}, 'data': {}}
@@ -0,0 +1,115 @@
+import time
+import threading
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+# 前回の成功を残すキーの件数
+MAX_LAST = 1000
+
+class Coalescer:
+    """
+    同じジョブの重複した実行要求をまとめるクラス
+
+    同じキーのジョブが実行待ちなら新しく登録せず、そのジョブIDを返す。
+    実行が始まった後の要求は(ソースが変わっているかもしれないので)新しく登録する。
+    min_interval を指定すると、その時間内に成功していれば登録せずに前回のジョブIDを返す。
+    前回の成功は、指定された最大の min_interval より古くなるか、max_last 件を超えたら古いものから捨てる。
+
+    Attributes
+    ----------
+    max_last : int, default MAX_LAST
+        前回の成功を残すキーの件数
+    """
+    SUBMITTED = 'submitted'
+    ATTACHED = 'attached'
+    SKIPPED = 'skipped'
+
+    def __init__(self, max_last=MAX_LAST):
+        self.max_last = max_last
+        self._lock = threading.Lock()
+        self._pending = {}
+        # 成功した順(キー: (時刻, ジョブID))
+        self._last = OrderedDict()
+        self._max_interval = 0
+
+    def _prune(self):
+        """
+        どの min_interval でも使わない前回の成功を捨てる(ロックの中で呼ぶ)
+        """
+        while len(self._last) > self.max_last:
+            self._last.popitem(last=False)
+        if self._max_interval <= 0:
+            return
+        limit = time.monotonic() - self._max_interval
+        while len(self._last) > 0 and next(iter(self._last.values()))[0] < limit:
+            self._last.popitem(last=False)
+
+    def submit(self, key, create, min_interval=0):
+        """
+        ジョブを登録する(重複していればまとめる)
+
+        Parameters
+        ----------
+        key : hashable
+            ジョブのキー
+        create : function
+            ジョブを登録してジョブIDを返す関数
+        min_interval : float, default 0
+            前回の成功からこの時間(s)内なら登録しない
+
+        Returns
+        -------
+        job_id : int
+            ジョブID
+        how : str
+            SUBMITTED(登録した), ATTACHED(実行待ちのジョブにまとめた), SKIPPED(前回の成功から間もない)
+        """
+        with self._lock:
+            self._max_interval = max(self._max_interval, min_interval)
+            self._prune()
+            last = self._last.get(key)
+            if min_interval > 0 and last is not None and time.monotonic() - last[0] < min_interval:
+                logger.info('skip %s: succeeded %.0fs ago', key, time.monotonic() - last[0])
+                return last[1], self.SKIPPED
+            if key in self._pending:
+                logger.info('attach to pending job %s', key)
+                return self._pending[key], self.ATTACHED
+            job_id = create()
+            self._pending[key] = job_id
+        return job_id, self.SUBMITTED
+
+    def started(self, key, job_id):
+        """
+        ジョブが実行待ちを抜けた(以降の要求はまとめない)
+
+        Parameters
+        ----------
+        key : hashable
+            ジョブのキー
+        job_id : int
+            ジョブID
+        """
+        with self._lock:
+            if self._pending.get(key) == job_id:
+                del self._pending[key]
+
+    def finished(self, key, job_id, returncode):
+        """
+        ジョブが終了した
+
+        Parameters
+        ----------
+        key : hashable
+            ジョブのキー
+        job_id : int
+            ジョブID
+        returncode : int
+            終了コード
+        """
+        self.started(key, job_id)
+        if returncode == 0:
+            with self._lock:
+                self._last.pop(key, None)
+                self._last[key] = (time.monotonic(), job_id)
+                self._prune()
@@ -1,9 +1,52 @@
 import { useState, useEffect } from "react";
 import "./App.scss";
-import { Status } from "@/types/status";
+import {
+  Section,
+  SnapshotEvent,
+  Status,
+  StatusResponse,
+  UpdateEvent,
+} from "@/types/status";
 import { AppSection } from "@/components/AppSection.tsx";
 import { AppButtonClear } from "@/components/AppButtonClear.tsx";
 
+const SECTIONS: Section[] = ["error", "finished", "running", "pending"];
+
+/**
+ * 変わったタスクだけをステータスに反映する
+ * @param status 現在のステータス
+ * @param event update イベント
+ */
+const applyUpdate: (status: Status, event: UpdateEvent) => Status = (
+  status,
+  event,
+) => {
+  const next = { ...status };
+  const removed = new Set(event.removed);
+  const changed = new Map(event.changed.map((t) => [t.id, t]));
+  for (const name of SECTIONS) {
+    // 同じ状態のまま変わったタスクはその場で置き換え、移ったタスクは末尾に足す
+    next[name] = status[name]
+      .filter(
+        (t) =>
+          !removed.has(t.id) &&
+          (!changed.has(t.id) || changed.get(t.id)?.state === name),
+      )
+      .map((t) => {
+        const c = changed.get(t.id);
+        if (c) {
+          changed.delete(t.id);
+          return c;
+        }
+        return t;
+      });
+  }
+  for (const t of changed.values()) {
+    next[t.state] = [...next[t.state], t];
+  }
+  return next;
+};
+
 function App() {
   const [status, setStatus] = useState<Status>({
     error: [],
@@ -23,15 +66,42 @@ function App() {
     }
 
     if (response.ok) {
-      const json = await response.json();
-      setStatus(json);
+      const json: StatusResponse = await response.json();
+      setStatus({
+        error: json.error,
+        finished: json.finished,
+        running: json.running,
+        pending: json.pending,
+      });
     } else {
       console.error(response);
     }
   };
 
   useEffect(() => {
-    updateStatus();
+    // 変化をサーバから受け取る(使えなければ取得だけする)
+    if (typeof EventSource === "undefined") {
+      updateStatus();
+      return;
+    }
+    const url = new URL("/api/events", import.meta.env.VITE_SERVER);
+    const source = new EventSource(url);
+    source.addEventListener("snapshot", (e) => {
+      const { status: json }: SnapshotEvent = JSON.parse(
+        (e as MessageEvent).data,
+      );
+      setStatus({
+        error: json.error,
+        finished: json.finished,
+        running: json.running,
+        pending: json.pending,
+      });
+    });
+    source.addEventListener("update", (e) => {
+      const event: UpdateEvent = JSON.parse((e as MessageEvent).data);
+      setStatus((current) => applyUpdate(current, event));
+    });
+    return () => source.close();
   }, []);
 
   return (
@@ -44,8 +114,8 @@ function App() {
         </div>
       </section>
       <section className="section-container">
-        {Object.entries(status).map(([name, tasks], idx) => (
-          <AppSection key={idx} name={name} tasks={tasks} />
+        {SECTIONS.map((name, idx) => (
+          <AppSection key={idx} name={name} tasks={status[name]} />
         ))}
       </section>
     </>
@@ -1,12 +1,34 @@
 import { useMemo } from "react";
+import { Metrics, Resources, Task } from "@/types/status";
 import "./AppSection.scss";
 
 type SectionProps = {
   name: string;
-  tasks: {
-    name: string;
-    updated_at: string;
-  }[];
+  tasks: Task[];
+};
+
+/**
+ * 転送状況の表示文字列
+ * @param metrics rsync の転送状況
+ */
+const formatMetrics: (metrics?: Metrics) => string = (metrics) => {
+  if (!metrics || metrics.bytes === undefined) {
+    return "-";
+  }
+  const mb = (value: number) => (value / 1024 / 1024).toFixed(1);
+  return `${metrics.percent ?? 0}% ${mb(metrics.bytes)}MB (${mb(metrics.rate ?? 0)}MB/s, eta ${metrics.eta ?? 0}s)`;
+};
+
+/**
+ * 資源使用量の表示文字列
+ * @param resources プロセスツリーの資源使用量
+ */
+const formatResources: (resources?: Resources) => string = (resources) => {
+  if (!resources || !resources.samples) {
+    return "-";
+  }
+  const mb = (value: number) => (value / 1024 / 1024).toFixed(1);
+  return `cpu ${resources.cpu_seconds}s (max ${resources.cpu_percent_peak}%), rss max ${mb(resources.rss_peak)}MB, io ${mb(resources.read_bytes)}/${mb(resources.write_bytes)}MB`;
 };
 
 export const AppSection = (props: SectionProps) => {
@@ -16,6 +38,8 @@ export const AppSection = (props: SectionProps) => {
       tasks.map((t) => ({
         ...t,
         updated_at: new Date(t.updated_at).toLocaleString("ja-JP"),
+        progress: formatMetrics(t.metrics),
+        resources: formatResources(t.resources),
       })),
     [tasks],
   );
@@ -28,19 +52,23 @@ export const AppSection = (props: SectionProps) => {
           <tr>
             <th>name</th>
             <th>updated</th>
+            <th>progress</th>
+            <th>resources</th>
           </tr>
         </thead>
         <tbody className="body">
           {parsedTasks.length ? (
-            parsedTasks.map((t, idx) => (
-              <tr key={idx}>
+            parsedTasks.map((t) => (
+              <tr key={t.id}>
                 <td>{t.name}</td>
                 <td>{t.updated_at}</td>
+                <td>{t.progress}</td>
+                <td>{t.resources}</td>
               </tr>
             ))
           ) : (
             <tr>
-              <td colSpan={2} className="placeholder">
+              <td colSpan={4} className="placeholder">
                 no tasks
               </td>
             </tr>
@@ -1,7 +1,35 @@
+// rsync の転送状況
+export type Metrics = {
+  bytes?: number;
+  files?: number;
+  rate?: number;
+  eta?: number;
+  percent?: number;
+  updated_at?: string;
+};
+
+// プロセスツリーの資源使用量
+export type Resources = {
+  cpu_seconds: number;
+  cpu_percent: number;
+  cpu_percent_peak: number;
+  rss: number;
+  rss_peak: number;
+  read_bytes: number;
+  write_bytes: number;
+  read_rate_peak: number;
+  write_rate_peak: number;
+  procs_peak: number;
+  samples: number;
+};
+
 // 各バックアップタスク
 export type Task = {
+  id: number;
   name: string;
   updated_at: string;
+  metrics?: Metrics;
+  resources?: Resources;
 };
 
 // セクション名
@@ -12,3 +40,28 @@ export type Section = ClearableSection | "running" | "pending";
 export type Status = {
   [key in Section]: Task[];
 };
+
+// 変更ジャーナルの状態
+export type JournalStatus = {
+  bytes: number;
+  overflow: boolean;
+  last_full_scan: string | null;
+};
+
+// /api/status のレスポンス
+export type StatusResponse = Status & {
+  journal: { [section: string]: JournalStatus };
+};
+
+// /api/events の snapshot イベント
+export type SnapshotEvent = {
+  version: number;
+  status: StatusResponse;
+};
+
+// /api/events の update イベント(変わったタスクのみ)
+export type UpdateEvent = {
+  version: number;
+  changed: (Task & { state: Section })[];
+  removed: number[];
+};
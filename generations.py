@@ -0,0 +1,142 @@
+import os
+import glob
+import json
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+DIRS = 'dirs'
+LOGS = 'logs'
+
+def select_to_remove(dates, keep_daily, keep_weekly=0, keep_monthly=0):
+    """
+    GFS(日次・週次・月次)の保持ポリシーで削除する日付を選ぶ
+
+    新しい順に1回だけ走査し、直近 keep_daily 日分、
+    直近 keep_weekly 週・keep_monthly 月それぞれの最新の日付を残す。
+
+    Parameters
+    ----------
+    dates : list of str
+        日付(YYYYmmdd)
+    keep_daily : int
+        日次で残す数
+    keep_weekly : int, default 0
+        週次で残す数
+    keep_monthly : int, default 0
+        月次で残す数
+
+    Returns
+    -------
+    dates : list of str
+        削除対象の日付の昇順リスト
+    """
+    days = set()
+    weeks = set()
+    months = set()
+    remove = []
+    for date in sorted(set(dates), reverse=True):
+        day = datetime.datetime.strptime(date, '%Y%m%d').date()
+        week = day.isocalendar()[:2]
+        month = (day.year, day.month)
+        keep = False
+        if len(days) < keep_daily:
+            days.add(day)
+            keep = True
+        if week not in weeks and len(weeks) < keep_weekly:
+            weeks.add(week)
+            keep = True
+        if month not in months and len(months) < keep_monthly:
+            months.add(month)
+            keep = True
+        if not keep:
+            remove.append(date)
+    return sorted(remove)
+
+class GenerationCatalog:
+    """
+    セクションの世代(過去世代ディレクトリ・アーカイブ、ログ)の日付を保持するカタログ
+
+    作成・削除のたびに更新するので、保持判定でディレクトリを検索しなくてよい。
+    カタログがなければ一度だけ検索して作成する。
+
+    Attributes
+    ----------
+    path : str
+        カタログファイルのパス
+    dates : dict of {str: list of str}
+        種類(dirs, logs)ごとの日付(YYYYmmdd)の昇順リスト
+    """
+
+    def __init__(self, path, dest, logbase):
+        self.path = path
+        try:
+            with open(path, encoding='UTF-8') as f:
+                self.dates = json.load(f)
+        except FileNotFoundError:
+            self.dates = {DIRS: self._scan(dest[:-1] if dest[-1] == '/' else dest),
+                          LOGS: self._scan(logbase)}
+            logger.info('generation catalog is created from directory listing: %s', path)
+            self.save()
+
+    @staticmethod
+    def _scan(base):
+        """
+        base_YYYYmmdd(拡張子は問わない)の日付を検索する
+        """
+        names = [os.path.splitext(name)[0] for name in glob.glob(base+'_*')]
+        return sorted(set(name[-8:] for name in names if name[-8:].isdecimal()))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w', encoding='UTF-8') as f:
+            json.dump(self.dates, f)
+        os.replace(tmppath, self.path)
+
+    def get(self, kind):
+        """
+        日付を取得する
+
+        Parameters
+        ----------
+        kind : str
+            種類(dirs, logs)
+
+        Returns
+        -------
+        dates : list of str
+        """
+        return list(self.dates.get(kind, []))
+
+    def add(self, kind, date):
+        """
+        日付を追加して保存する
+
+        Parameters
+        ----------
+        kind : str
+            種類(dirs, logs)
+        date : str
+            日付(YYYYmmdd)
+        """
+        dates = self.dates.setdefault(kind, [])
+        if date in dates:
+            return
+        dates.append(date)
+        dates.sort()
+        self.save()
+
+    def remove(self, kind, dates):
+        """
+        日付を削除して保存する
+
+        Parameters
+        ----------
+        kind : str
+            種類(dirs, logs)
+        dates : list of str
+            日付(YYYYmmdd)
+        """
+        self.dates[kind] = [date for date in self.dates.get(kind, []) if date not in dates]
+        self.save()
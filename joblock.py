@@ -0,0 +1,153 @@
+import os
+import fcntl
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+import mountutil
+
+# ロックファイルを置くディレクトリ(ソースツリーに書き込まないよう実行時ディレクトリに置く)
+LOCK_DIR = os.environ.get('BACKUP_LOCK_DIR', '/run/lock/backupserver')
+# ロックの単位(device: バックアップ先のマウントポイント, section: セクション)
+KEY_MODES = ('device', 'section')
+
+def resource_key(section, dest, mode='device'):
+    """
+    ジョブが占有するリソースのキーを作成する
+
+    Parameters
+    ----------
+    section : str
+        セクション名
+    dest : str
+        バックアップ先パス
+    mode : str, default device
+        ロックの単位(device, section)
+
+    Returns
+    -------
+    key : str
+    """
+    if mode == 'section':
+        return section
+    # マウント前でも同じキーになるよう fstab のマウントポイントも使う
+    points = [mount['mount_point'] for mount in mountutil.read_mountinfo()] + mountutil.read_fstab()
+    return 'dev' + mountutil.mount_point_of(dest, points).replace('/', '_')
+
+class ResourceLock:
+    """
+    リソースごとの排他ロック
+
+    同じプロセス内のスレッド間はキーごとの threading.Lock で、
+    プロセス間は LOCK_DIR/<key>.lock の flock で排他する。
+    どちらも解放された瞬間に待っている側が起こされる(ポーリングしない)。
+
+    Attributes
+    ----------
+    key : str
+        リソースのキー
+    path : str
+        ロックファイルのパス
+    """
+    _registry_lock = threading.Lock()
+    _thread_locks = {}
+
+    def __init__(self, key, lock_dir=None):
+        self.key = key
+        self.path = os.path.join(LOCK_DIR if lock_dir is None else lock_dir, key + '.lock')
+        with ResourceLock._registry_lock:
+            self._thread_lock = ResourceLock._thread_locks.setdefault(key, threading.Lock())
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def _flock(self, fd, timeout):
+        """
+        flock を取る(timeout は別スレッドで待って打ち切る)
+
+        Returns
+        -------
+        bool
+            取れたか？
+        """
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            pass
+        logger.info('waiting for lock %s held by another process', self.key)
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return True
+        state = {'acquired': False, 'cancelled': False}
+        state_lock = threading.Lock()
+        acquired = threading.Event()
+
+        def wait_flock():
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with state_lock:
+                if state['cancelled']:
+                    # 諦めた後に取れたら閉じて手放す
+                    os.close(fd)
+                    return
+                state['acquired'] = True
+            acquired.set()
+
+        threading.Thread(target=wait_flock, daemon=True).start()
+        acquired.wait(timeout)
+        with state_lock:
+            if not state['acquired']:
+                state['cancelled'] = True
+            return state['acquired']
+
+    def acquire(self, timeout=None):
+        """
+        ロックを取る
+
+        Parameters
+        ----------
+        timeout : float, default None
+            待つ時間の上限(s)。None は無制限
+
+        Returns
+        -------
+        bool
+            取れたか？
+        """
+        if not self._thread_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            self._thread_lock.release()
+            raise
+        if not self._flock(fd, timeout):
+            # fd は待機スレッドが閉じる
+            self._thread_lock.release()
+            return False
+        # 調査用に保持しているプロセスを書いておく
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        """
+        ロックを解放する
+        """
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,307 @@
+import os
+import re
+import json
+import time
+import bisect
+import sqlite3
+import threading
+from collections import deque
+import logging
+logger = logging.getLogger(__name__)
+
+# backup.py の exec_with_startend_log が出力する行
+PHASE_PATTERN = re.compile(r'(Start|End) - (.+?)\s*$')
+# 1セクション・種類あたりに残す履歴の件数
+MAX_HISTORY = 500
+# 転送速度の傾向を見る指数移動平均の係数(短期, 長期)
+EWMA_ALPHAS = (0.3, 0.05)
+
+class PhaseTimer:
+    """
+    backup.py の出力の "Start - X" と "End - X" から各フェーズの所要時間を測るクラス
+
+    Attributes
+    ----------
+    phases : dict of {str: float}
+        フェーズ名と所要時間(s)(同じフェーズが複数回あれば合計)
+    """
+
+    def __init__(self, phases):
+        self.phases = phases
+        self._started = {}
+
+    def __call__(self, line):
+        m = PHASE_PATTERN.search(line)
+        if m is None:
+            return False
+        kind, name = m.groups()
+        now = time.monotonic()
+        if kind == 'Start':
+            self._started[name] = now
+        elif name in self._started:
+            self.phases[name] = round(self.phases.get(name, 0.0) + now - self._started.pop(name), 3)
+        return False
+
+def percentile(values, q):
+    """
+    ソート済みの値の百分位数(最近傍順位)を求める
+
+    Parameters
+    ----------
+    values : list of float
+        昇順の値
+    q : float
+        百分位(0-100)
+
+    Returns
+    -------
+    float or None
+    """
+    if len(values) == 0:
+        return None
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+class Window:
+    """
+    直近 size 件の値を保持し、百分位数を取得するクラス
+
+    値は到着順(古いものを捨てる)とソート順の両方で持ち、1件ごとに更新する。
+
+    Attributes
+    ----------
+    size : int
+        保持する件数
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self._order = deque()
+        self._sorted = []
+
+    def add(self, value):
+        self._order.append(value)
+        bisect.insort(self._sorted, value)
+        if len(self._order) > self.size:
+            old = self._order.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, old)]
+
+    def __len__(self):
+        return len(self._order)
+
+    def summary(self):
+        """
+        Returns
+        -------
+        dict of {p50: float, p95: float, max: float, last: float}
+        """
+        if len(self._order) == 0:
+            return {'p50': None, 'p95': None, 'max': None, 'last': None}
+        return {'p50': percentile(self._sorted, 50), 'p95': percentile(self._sorted, 95),
+                'max': self._sorted[-1], 'last': self._order[-1]}
+
+class SectionStats:
+    """
+    1セクション・種類の統計を1件ずつ更新するクラス
+
+    Attributes
+    ----------
+    count : int
+        記録した件数
+    failures : int
+        失敗した件数
+    duration : Window
+        成功したジョブの所要時間(s)
+    phases : dict of {str: Window}
+        成功したジョブのフェーズごとの所要時間(s)
+    throughput : list of float
+        成功したジョブの転送速度(B/s)の指数移動平均(短期, 長期)
+    """
+
+    def __init__(self, window=100):
+        self.window = window
+        self.count = 0
+        self.failures = 0
+        self.last = None
+        self.last_success = None
+        self.duration = Window(window)
+        self.phases = {}
+        self.throughput = [None, None]
+        self.last_throughput = None
+
+    def add(self, entry):
+        """
+        履歴を1件加える
+
+        Parameters
+        ----------
+        entry : dict
+            finished_at, duration, returncode, bytes, phases を持つ履歴
+        """
+        self.count += 1
+        self.last = entry
+        if entry['returncode'] != 0:
+            self.failures += 1
+            return
+        self.last_success = entry
+        self.duration.add(entry['duration'])
+        for name, seconds in entry['phases'].items():
+            self.phases.setdefault(name, Window(self.window)).add(seconds)
+        if entry['bytes'] is not None and entry['duration'] > 0:
+            rate = entry['bytes'] / entry['duration']
+            self.last_throughput = rate
+            self.throughput = [rate if avg is None else avg + alpha * (rate - avg)
+                               for avg, alpha in zip(self.throughput, EWMA_ALPHAS)]
+
+    def to_dict(self):
+        duration = self.duration.summary()
+        short, long = self.throughput
+        return {'count': self.count,
+                'failures': self.failures,
+                'last_finished_at': None if self.last is None else self.last['finished_at'],
+                'last_returncode': None if self.last is None else self.last['returncode'],
+                'last_success_at': None if self.last_success is None else self.last_success['finished_at'],
+                'duration': duration,
+                # 直近が中央値の何倍かかったか(急に遅くなったら大きくなる)
+                'slowdown': (round(duration['last'] / duration['p50'], 2)
+                             if duration['p50'] else None),
+                'phases': {name: window.summary() for name, window in self.phases.items()},
+                'throughput': {'last': self.last_throughput, 'short': short, 'long': long,
+                               # 短期平均 / 長期平均。1より小さければ遅くなっている
+                               'trend': round(short / long, 2) if long else None}}
+
+class HistoryStore:
+    """
+    完了したジョブの履歴を保持するSQLiteストア(WALモード)
+
+    セクション・種類ごとに新しい MAX_HISTORY 件だけを残す。
+
+    Attributes
+    ----------
+    path : str
+        DBファイルのパス
+    max_history : int
+        セクション・種類ごとに残す件数
+    """
+
+    def __init__(self, path, max_history=MAX_HISTORY):
+        self.path = path
+        self.max_history = max_history
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                section TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                finished_at TEXT NOT NULL,
+                duration REAL NOT NULL,
+                returncode INTEGER NOT NULL,
+                bytes INTEGER,
+                phases TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_section ON history (section, kind, id);
+        """)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def load(self):
+        """
+        全履歴を古い順に取得する
+
+        Returns
+        -------
+        list of dict
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT section, kind, finished_at, duration, returncode, bytes, phases '
+                                      'FROM history ORDER BY id').fetchall()
+        return [{'section': row[0], 'kind': row[1], 'finished_at': row[2], 'duration': row[3],
+                 'returncode': row[4], 'bytes': row[5], 'phases': json.loads(row[6])} for row in rows]
+
+    def add(self, entry):
+        """
+        履歴を1件書き込み、古いものを消す
+
+        Parameters
+        ----------
+        entry : dict
+            section, kind, finished_at, duration, returncode, bytes, phases を持つ履歴
+        """
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO history (section, kind, finished_at, duration, returncode, bytes, phases) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (entry['section'], entry['kind'], entry['finished_at'], entry['duration'],
+                                entry['returncode'], entry['bytes'], json.dumps(entry['phases'])))
+            self._conn.execute('DELETE FROM history WHERE section = ? AND kind = ? AND id <= '
+                               '(SELECT id FROM history WHERE section = ? AND kind = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                               (entry['section'], entry['kind'], entry['section'], entry['kind'], self.max_history))
+
+class JobStats:
+    """
+    セクションごとのジョブの統計
+
+    完了のたびに履歴を1件加えて統計を更新し、ストアがあれば書き込む。
+    起動時はストアの履歴(ログではない)から統計を作り直す。
+
+    Attributes
+    ----------
+    store : HistoryStore, default None
+        履歴のストア
+    window : int, default 100
+        百分位数を求める直近の件数
+    """
+
+    def __init__(self, store=None, window=100):
+        self.store = store
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats = {}
+        if store is not None:
+            for entry in store.load():
+                self._add(entry)
+
+    def _add(self, entry):
+        stats = self._stats.setdefault(entry['section'], {})
+        stats.setdefault(entry['kind'], SectionStats(self.window)).add(entry)
+
+    def record(self, entry):
+        """
+        完了したジョブを記録する
+
+        Parameters
+        ----------
+        entry : dict
+            section, kind, finished_at, duration, returncode, bytes, phases を持つ履歴
+        """
+        with self._lock:
+            self._add(entry)
+        if self.store is not None:
+            try:
+                self.store.add(entry)
+            except Exception as e:
+                logger.warning('could not save job history: %s', e)
+
+    def get(self, section=None):
+        """
+        統計を取得する
+
+        Parameters
+        ----------
+        section : str, default None
+            セクション名(None は全セクション)
+
+        Returns
+        -------
+        dict of {str: dict of {str: dict}}
+            セクション名、種類(backup, verify)と統計
+        """
+        with self._lock:
+            sections = self._stats if section is None else {section: self._stats.get(section, {})}
+            return {name: {kind: stats.to_dict() for kind, stats in kinds.items()}
+                    for name, kinds in sections.items()}
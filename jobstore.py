@@ -0,0 +1,121 @@
+import os
+import json
+import sqlite3
+import threading
+import psutil
+import logging
+logger = logging.getLogger(__name__)
+
+class JobStore:
+    """
+    ProcessPool のジョブを保持するSQLiteストア(WALモード)
+
+    状態が変わるたびに1行を書き換えるだけなので、WALかつ synchronous=NORMAL で
+    コミットごとのfsyncを避ける(電源断で直前の数件が失われることはあるが、DBは壊れない)。
+
+    Attributes
+    ----------
+    path : str
+        DBファイルのパス
+    _conn : sqlite3.Connection
+        DBへの接続(スレッド間で共有し、_lock で排他する)
+    """
+    COLUMNS = ('id', 'cmd', 'state', 'updated_at', 'updated_ts', 'pid', 'create_time',
+               'returncode', 'metrics', 'resources', 'log_file')
+    # JSON で保存する列
+    JSON_COLUMNS = ('cmd', 'metrics', 'resources', 'log_file')
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                cmd TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                updated_ts REAL NOT NULL,
+                pid INTEGER,
+                create_time REAL,
+                returncode INTEGER,
+                metrics TEXT NOT NULL,
+                resources TEXT NOT NULL,
+                log_file TEXT
+            );
+        """)
+        # 以前のバージョンで作ったDBには列を足す
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]
+        if 'log_file' not in columns:
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN log_file TEXT')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def load(self):
+        """
+        全ジョブを登録順に取得する
+
+        Returns
+        -------
+        list of dict
+            COLUMNS をキーとする辞書(JSON_COLUMNS はデコード済み)
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT %s FROM jobs ORDER BY id' % ', '.join(self.COLUMNS)).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(zip(self.COLUMNS, row))
+            for key in self.JSON_COLUMNS:
+                job[key] = None if job[key] is None else json.loads(job[key])
+            jobs.append(job)
+        return jobs
+
+    def save(self, job):
+        """
+        ジョブを書き込む
+
+        Parameters
+        ----------
+        job : dict
+            COLUMNS をキーとする辞書
+        """
+        values = [json.dumps(job.get(key)) if key in self.JSON_COLUMNS else job[key]
+                  for key in self.COLUMNS]
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO jobs VALUES (%s)' % ', '.join('?' * len(values)), values)
+
+    def delete(self, job_ids):
+        """
+        ジョブを消す
+
+        Parameters
+        ----------
+        job_ids : iterable of int
+            ジョブID
+        """
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in job_ids])
+
+def create_time_of(pid):
+    """
+    プロセスの起動時刻を取得する(PIDの再利用と区別するのに使う)
+
+    Parameters
+    ----------
+    pid : int
+        プロセスID
+
+    Returns
+    -------
+    float or None
+        起動時刻(プロセスがなければNone)
+    """
+    try:
+        return psutil.Process(pid).create_time()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
@@ -0,0 +1,192 @@
+import os
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+# 1ジョブあたりにメモリに残す出力の上限
+MAX_BYTES = 1024 * 1024
+
+class LogBuffer:
+    """
+    ジョブの出力をメモリに残すリングバッファ
+
+    出力はジョブの先頭からのバイト位置(offset)で読む。
+    上限を超えたら古いものから捨てる(まとめて捨てるので追加は償却 O(1))。
+    spool でファイルを指定すると同じバイト列をファイルにも書き込むので、捨てたところはファイルの同じ位置から読める。
+
+    Attributes
+    ----------
+    max_bytes : int, default MAX_BYTES
+        残す上限
+    start : int
+        残っている先頭の位置
+    end : int
+        書き込んだ末尾の位置
+    closed : bool
+        ジョブが終了したか？
+    spooled : bool
+        全ての出力をファイルにも書き込んだか？
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.start = 0
+        self.closed = False
+        self.spooled = False
+        self._buf = bytearray()
+        self._cond = threading.Condition()
+        self._spool = None
+
+    @property
+    def end(self):
+        return self.start + len(self._buf)
+
+    def spool(self, path):
+        """
+        以降の出力をファイルにも書き込む(まだ何も書き込んでいないときに呼ぶ)
+
+        Parameters
+        ----------
+        path : str
+            書き込むファイルのパス(あれば空にする)
+        """
+        with self._cond:
+            if self.end > 0:
+                raise ValueError('spool must be opened before output')
+            self._spool = open(path, 'wb')
+            self.spooled = True
+
+    def append(self, line):
+        """
+        1行を書き込む(ProcessPool のハンドラとして使う)
+
+        Parameters
+        ----------
+        line : str
+            出力1行
+
+        Returns
+        -------
+        bool
+            常にFalse(ログには出す)
+        """
+        data = (line + '\n').encode('UTF-8', errors='replace')
+        with self._cond:
+            if self._spool is not None:
+                try:
+                    self._spool.write(data)
+                    self._spool.flush()
+                except OSError as e:
+                    # 以降はメモリにだけ残す
+                    logger.warning('could not write log %s: %s', self._spool.name, e)
+                    self._close_spool()
+                    self.spooled = False
+            self._buf += data
+            excess = len(self._buf) - self.max_bytes
+            if excess > self.max_bytes // 4:
+                del self._buf[:excess]
+                self.start += excess
+            self._cond.notify_all()
+        return False
+
+    __call__ = append
+
+    def close(self):
+        """
+        ジョブの終了を知らせる
+        """
+        with self._cond:
+            self.closed = True
+            self._close_spool()
+            self._cond.notify_all()
+
+    def _close_spool(self):
+        if self._spool is None:
+            return
+        try:
+            self._spool.close()
+        except OSError as e:
+            logger.warning('could not close log %s: %s', self._spool.name, e)
+        self._spool = None
+
+    def read(self, offset, limit):
+        """
+        位置から読む
+
+        Parameters
+        ----------
+        offset : int
+            読み始める位置
+        limit : int
+            読む上限(バイト)
+
+        Returns
+        -------
+        start : int
+            読んだ先頭の位置(捨てられていれば offset より後ろ)
+        data : bytes
+        """
+        with self._cond:
+            start = min(max(offset, self.start), self.end)
+            pos = start - self.start
+            return start, bytes(self._buf[pos:pos + limit])
+
+    def wait(self, offset, timeout=None):
+        """
+        位置より後ろに書き込まれるか、終了するまで待つ
+
+        Parameters
+        ----------
+        offset : int
+            読んだ位置
+        timeout : float, default None
+            待つ時間の上限(s)
+
+        Returns
+        -------
+        bool
+            読めるものがあるか？
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.end > offset or self.closed, timeout)
+            return self.end > offset
+
+def file_size(path):
+    """
+    ファイルサイズを取得する(ファイルがなければ0)
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def read_file(path, base, offset, limit, end=None):
+    """
+    ログファイルのジョブの範囲を位置から読む
+
+    Parameters
+    ----------
+    path : str
+        ログファイルのパス
+    base : int
+        ファイル内のジョブの先頭
+    offset : int
+        ジョブの先頭からの位置
+    limit : int
+        読む上限(バイト)
+    end : int, default None
+        ファイル内のジョブの末尾(None はファイルの末尾)
+
+    Returns
+    -------
+    data : bytes
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(base + offset)
+            if end is not None:
+                limit = min(limit, max(0, end - base - offset))
+            return f.read(limit)
+    except OSError as e:
+        logger.warning('could not read log %s: %s', path, e)
+        return b''
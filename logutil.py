@@ -2,6 +2,21 @@ import logging
 import logging.handlers
 logger = logging.getLogger(__name__)
 
+# extra にこのキーを True で渡したレコードはフォーマットせずにメッセージだけを出す
+RAW = 'raw'
+
+class RawAwareFormatter(logging.Formatter):
+    """
+    子プロセスの出力などを、既に整形済みの行としてそのまま出すフォーマッタ
+
+    ハンドラのフォーマットを一時的に差し替えなくても、レコードごとに切り替えられる。
+    """
+
+    def format(self, record):
+        if getattr(record, RAW, False):
+            return record.getMessage()
+        return super().format(record)
+
 def set_logger_format(handlers, fmt):
     """
     ロギングハンドラのフォーマットを変更する
@@ -14,4 +29,4 @@ def set_logger_format(handlers, fmt):
         変更後フォーマット
     """
     for handler in handlers:
-        handler.setFormatter(logging.Formatter(fmt=fmt))
+        handler.setFormatter(RawAwareFormatter(fmt=fmt))
@@ -0,0 +1,205 @@
+import os
+import stat
+import sqlite3
+import hashlib
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+# 一度にまとめて書き込む行数
+BATCH_SIZE = 1000
+# ハッシュ計算時の読み込みサイズ
+READ_SIZE = 1024 * 1024
+
+def file_digest(path, read_size=READ_SIZE):
+    """
+    ファイルのSHA-256ダイジェストを計算する
+
+    Parameters
+    ----------
+    path : str
+        対象ファイルパス
+    read_size : int, default 1MiB
+        1回の読み込みサイズ
+
+    Returns
+    -------
+    str
+        16進ダイジェスト
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        buf = bytearray(read_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+def walk_entries(root):
+    """
+    ツリー内のエントリを逐次列挙する
+
+    Parameters
+    ----------
+    root : str
+        対象ディレクトリ
+
+    Yields
+    ------
+    relpath : str
+        rootからの相対パス(/区切り)
+    st : os.stat_result
+        エントリのstat(シンボリックリンクは辿らない)
+    """
+    stack = ['']
+    while len(stack) > 0:
+        reldir = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, reldir))
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                relpath = reldir + '/' + entry.name if reldir else entry.name
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(relpath)
+                yield relpath, st
+
+class Manifest:
+    """
+    世代ごとのファイル一覧(マニフェスト)を保持するSQLiteカタログ
+
+    Attributes
+    ----------
+    path : str
+        カタログファイルのパス
+    _conn : sqlite3.Connection
+        カタログへの接続
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS generations (
+                date TEXT PRIMARY KEY,
+                root TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                files INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                date TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                mode INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                hash TEXT,
+                PRIMARY KEY (date, path)
+            ) WITHOUT ROWID;
+        """)
+
+    def close(self):
+        self._conn.close()
+
+    def get_dates(self):
+        """
+        記録済みの世代日付を取得する
+
+        Returns
+        -------
+        dates : list of str
+            日付(YYYYmmdd)の昇順リスト
+        """
+        return [row[0] for row in self._conn.execute('SELECT date FROM generations ORDER BY date')]
+
+    def get_previous_date(self, date):
+        """
+        指定日付より前で最新の世代日付を取得する
+
+        Parameters
+        ----------
+        date : str
+            基準日付(YYYYmmdd)
+
+        Returns
+        -------
+        str or None
+        """
+        row = self._conn.execute('SELECT MAX(date) FROM generations WHERE date < ?', (date,)).fetchone()
+        return row[0]
+
+    def record(self, date, root, with_hash=False):
+        """
+        ツリーを走査して世代のマニフェストを記録する
+
+        前世代でstat(size, mtime, inode)が変わらないファイルは前世代の行を再利用する。
+
+        Parameters
+        ----------
+        date : str
+            世代日付(YYYYmmdd)
+        root : str
+            走査するディレクトリ
+        with_hash : bool, default False
+            通常ファイルのハッシュを記録するか？
+
+        Returns
+        -------
+        counts : dict of {str: int}
+            記録件数(files)、再利用件数(reused)、ハッシュ計算件数(hashed)、合計サイズ(bytes)
+        """
+        counts = {'files': 0, 'reused': 0, 'hashed': 0, 'bytes': 0}
+        prev_date = self.get_previous_date(date)
+        lookup = self._conn.cursor()
+        with self._conn:
+            self._conn.execute('DELETE FROM files WHERE date = ?', (date,))
+            rows = []
+            for relpath, st in walk_entries(root):
+                row = [date, relpath, st.st_size, st.st_mtime_ns, st.st_mode, st.st_ino, None]
+                prev = None
+                if prev_date is not None:
+                    prev = lookup.execute('SELECT size, mtime_ns, inode, hash FROM files WHERE date = ? AND path = ?',
+                                          (prev_date, relpath)).fetchone()
+                if prev is not None and prev[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+                    row[6] = prev[3]
+                    counts['reused'] += 1
+                if with_hash and row[6] is None and stat.S_ISREG(st.st_mode):
+                    try:
+                        row[6] = file_digest(os.path.join(root, relpath))
+                        counts['hashed'] += 1
+                    except OSError as e:
+                        logger.warning('Could not hash %s: %s', relpath, e)
+                rows.append(row)
+                counts['files'] += 1
+                counts['bytes'] += st.st_size
+                if len(rows) >= BATCH_SIZE:
+                    self._conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                    rows = []
+            self._conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.execute('INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?)',
+                               (date, root, datetime.datetime.now().isoformat(), counts['files'], counts['bytes']))
+        return counts
+
+    def remove(self, dates):
+        """
+        世代のマニフェストを削除する
+
+        Parameters
+        ----------
+        dates : list of str
+            削除する日付(YYYYmmdd)
+        """
+        with self._conn:
+            for date in dates:
+                self._conn.execute('DELETE FROM files WHERE date = ?', (date,))
+                self._conn.execute('DELETE FROM generations WHERE date = ?', (date,))
@@ -0,0 +1,289 @@
+import os
+import time
+import fcntl
+import tempfile
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from process import Process
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+FSTAB_PATH = '/etc/fstab'
+SYS_DEV_BLOCK = '/sys/dev/block'
+LOCK_PATH = os.path.join(tempfile.gettempdir(), 'backupserver_mount.lock')
+
+def _unescape(field):
+    """
+    mountinfo, fstab の8進エスケープ(\\040 など)を戻す
+    """
+    if '\\' not in field:
+        return field
+    return field.encode().decode('unicode_escape').encode('latin-1').decode()
+
+def read_mountinfo(path=MOUNTINFO_PATH):
+    """
+    マウント情報を読み込む
+
+    Parameters
+    ----------
+    path : str, default /proc/self/mountinfo
+        mountinfo のパス
+
+    Returns
+    -------
+    mounts : list of dict
+        マウントポイント(mount_point)、デバイス番号(dev: maj:min)、ファイルシステム(fstype)、ソース(source)
+    """
+    mounts = []
+    with open(path, encoding='UTF-8') as f:
+        for line in f:
+            fields = line.split()
+            # オプションフィールドは - で終わる
+            sep = fields.index('-')
+            mounts.append({'mount_point': _unescape(fields[4]),
+                           'dev': fields[2],
+                           'fstype': fields[sep+1],
+                           'source': _unescape(fields[sep+2])})
+    return mounts
+
+def read_fstab(path=FSTAB_PATH):
+    """
+    mount -a の対象になるマウントポイントを fstab から読み込む
+
+    Parameters
+    ----------
+    path : str, default /etc/fstab
+        fstab のパス
+
+    Returns
+    -------
+    mount_points : list of str
+    """
+    mount_points = []
+    try:
+        f = open(path, encoding='UTF-8')
+    except FileNotFoundError:
+        return mount_points
+    with f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4 or fields[0].startswith('#'):
+                continue
+            if fields[2] == 'swap' or 'noauto' in fields[3].split(','):
+                continue
+            mount_points.append(os.path.normpath(_unescape(fields[1])))
+    return mount_points
+
+def required_mounts(paths, fstab_points, extra=()):
+    """
+    パスの利用に必要なマウントポイントを求める
+
+    Parameters
+    ----------
+    paths : list of str
+        利用するパス(source, dest)
+    fstab_points : list of str
+        fstab のマウントポイント
+    extra : list of str
+        config.ini で宣言されたマウントポイント
+
+    Returns
+    -------
+    required : set of str
+    """
+    required = set(os.path.normpath(mp) for mp in extra)
+    for path in paths:
+        path = os.path.abspath(path)
+        for mp in fstab_points:
+            if mp != '/' and (path == mp or path.startswith(mp + os.sep)):
+                required.add(mp)
+    return required
+
+def mount_point_of(path, mount_points):
+    """
+    パスを含むマウントポイントのうち最も深いものを求める(未マウントでも fstab から分かる)
+
+    Parameters
+    ----------
+    path : str
+        対象パス
+    mount_points : iterable of str
+        マウントポイント
+
+    Returns
+    -------
+    mount_point : str
+    """
+    path = os.path.abspath(path)
+    found = '/'
+    for mp in mount_points:
+        mp = os.path.normpath(mp)
+        if (path == mp or path.startswith(mp.rstrip(os.sep) + os.sep)) and len(mp) > len(found):
+            found = mp
+    return found
+
+def physical_device(dev, sys_dev_block=SYS_DEV_BLOCK):
+    """
+    デバイス番号から物理ディスク名を求める
+
+    パーティションは親のディスクに、LVM・dm-crypt などは下位デバイスが1つならそれにたどる。
+
+    Parameters
+    ----------
+    dev : str
+        デバイス番号(maj:min)
+    sys_dev_block : str, default /sys/dev/block
+        sysfs のブロックデバイス一覧
+
+    Returns
+    -------
+    name : str
+        ディスク名(sysfs に無ければ dev<maj:min>)
+    """
+    path = os.path.join(sys_dev_block, dev)
+    if not os.path.exists(path):
+        return 'dev' + dev
+    real = os.path.realpath(path)
+    for _ in range(8):
+        slaves = os.path.join(real, 'slaves')
+        below = os.listdir(slaves) if os.path.isdir(slaves) else []
+        if len(below) != 1:
+            break
+        real = os.path.realpath(os.path.join(slaves, below[0]))
+    if os.path.exists(os.path.join(real, 'partition')):
+        real = os.path.dirname(real)
+    return os.path.basename(real)
+
+def devices_of(paths, mounts=None, fstab_points=None, sys_dev_block=SYS_DEV_BLOCK):
+    """
+    パスが置かれた物理デバイスを求める
+
+    マウント済みなら mountinfo のデバイス番号からディスク名を、ネットワーク等(maj 0)はマウント元を、
+    未マウントなら fstab のマウントポイントをキーにする。
+
+    Parameters
+    ----------
+    paths : list of str
+        対象パス(source, dest)
+    mounts : list of dict, default None
+        read_mountinfo の結果(None なら読み込む)
+    fstab_points : list of str, default None
+        read_fstab の結果(None なら読み込む)
+    sys_dev_block : str, default /sys/dev/block
+        sysfs のブロックデバイス一覧
+
+    Returns
+    -------
+    devices : set of str
+    """
+    mounts = read_mountinfo() if mounts is None else mounts
+    fstab_points = read_fstab() if fstab_points is None else fstab_points
+    # 重ねてマウントされていれば後のものが見える
+    mounted = {mount['mount_point']: mount for mount in mounts}
+    devices = set()
+    for path in paths:
+        mp = mount_point_of(path, list(mounted) + fstab_points)
+        mount = mounted.get(mp)
+        if mount is None:
+            devices.add('mnt:' + mp)
+        elif mount['dev'].split(':')[0] == '0':
+            devices.add('src:' + mount['source'])
+        else:
+            devices.add(physical_device(mount['dev'], sys_dev_block))
+    return devices
+
+class MountChecker:
+    """
+    マウント状態を確認し、足りないときだけマウントするクラス
+
+    マウントポイント一覧は ttl 秒キャッシュし、同じプロセス内のジョブで共有する。
+    app.py はジョブの実行直前にサーバ全体で1つのインスタンス(checker)で確認し、backup.py には --no_mount を渡す。
+
+    Attributes
+    ----------
+    ttl : float, default 30.0
+        マウントポイント一覧のキャッシュ時間(s)
+    """
+
+    def __init__(self, ttl=30.0, mountinfo_path=MOUNTINFO_PATH, fstab_path=FSTAB_PATH):
+        self.ttl = ttl
+        self._mountinfo_path = mountinfo_path
+        self._fstab_path = fstab_path
+        self._lock = threading.Lock()
+        self._mounted = None
+        self._fstab = None
+        self._checked_at = 0.0
+
+    def _refresh(self, force=False):
+        """
+        キャッシュが古ければマウントポイント一覧を読み直す(ロック内で呼ぶ)
+        """
+        if force or self._mounted is None or time.monotonic() - self._checked_at > self.ttl:
+            self._mounted = set(mount['mount_point'] for mount in read_mountinfo(self._mountinfo_path))
+            self._fstab = read_fstab(self._fstab_path)
+            self._checked_at = time.monotonic()
+
+    def get_missing(self, paths, extra=(), force=False):
+        """
+        マウントされていない必要なマウントポイントを取得する
+
+        Parameters
+        ----------
+        paths : list of str
+            利用するパス
+        extra : list of str
+            追加で必要なマウントポイント
+        force : bool, default False
+            キャッシュを使わないか？
+
+        Returns
+        -------
+        missing : list of str
+        """
+        with self._lock:
+            self._refresh(force)
+            required = required_mounts(paths, self._fstab, extra)
+            return sorted(required - self._mounted)
+
+    def ensure(self, paths, extra=()):
+        """
+        必要なマウントポイントがマウントされていることを保証する
+
+        Parameters
+        ----------
+        paths : list of str
+            利用するパス
+        extra : list of str
+            追加で必要なマウントポイント
+
+        Returns
+        -------
+        returncode : int
+            終了コード
+        """
+        missing = self.get_missing(paths, extra)
+        if len(missing) == 0:
+            return 0
+        # 他のジョブ・プロセスと同時にマウントしないようにする
+        with self._lock:
+            fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._refresh(force=True)
+                for mount_point in sorted(required_mounts(paths, self._fstab, extra) - self._mounted):
+                    proc = Process(cmd=['sudo', 'mount', mount_point])
+                    proc.execute(wait=True)
+                    if proc.returncode != 0:
+                        logger.error('Failed to mount %s', mount_point)
+                self._refresh(force=True)
+            finally:
+                os.close(fd)
+        missing = self.get_missing(paths, extra)
+        if len(missing) > 0:
+            logger.error('not mounted : %s', ', '.join(missing))
+            return 1
+        return 0
+
+# プロセス内のジョブで共有するインスタンス(app.py ではサーバ全体で共有する)
+checker = MountChecker()
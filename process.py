@@ -1,11 +1,77 @@
-from subprocess import PIPE, STDOUT, Popen
+from subprocess import DEVNULL, Popen
+import re
+import asyncio
+import codecs
+import threading
 import psutil
-import time
 import logging
 logger = logging.getLogger(__name__)
 
 import logutil
 
+# 出力を読み込む単位
+READ_SIZE = 64 * 1024
+LINE_BREAK = re.compile(r'\r\n|\r|\n')
+
+class EventLoopThread:
+    """
+    全ジョブのサブプロセスを扱う1つのイベントループを専用スレッドで動かすクラス
+    """
+    _lock = threading.Lock()
+    _loop = None
+
+    @classmethod
+    def get_loop(cls):
+        """
+        イベントループを取得する(初回に起動する)
+
+        Returns
+        -------
+        loop : asyncio.AbstractEventLoop
+        """
+        with cls._lock:
+            if cls._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='process-engine', daemon=True).start()
+                cls._loop = loop
+            return cls._loop
+
+    @classmethod
+    def submit(cls, coro):
+        """
+        コルーチンをイベントループで実行する
+
+        Parameters
+        ----------
+        coro : coroutine
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, cls.get_loop())
+
+def split_lines(text):
+    """
+    改行(\\n, \\r\\n, \\r)で分割する
+
+    rsyncの進捗行は \\r で上書きされるので、\\r も行の区切りとして扱う。
+
+    Parameters
+    ----------
+    text : str
+        読み込んだ文字列(前回の残りを含む)
+
+    Returns
+    -------
+    lines : list of str
+        完結した行
+    rest : str
+        次のチャンクに持ち越す残り
+    """
+    parts = LINE_BREAK.split(text)
+    return parts[:-1], parts[-1]
+
 class Process:
     """
     プロセスに関するクラス
@@ -13,120 +79,216 @@ class Process:
     Attributes
     ----------
     cmd : list
-        実行するコマンド
+        実行するコマンド(シェルを介さずに実行する)
     out_to_log : bool, default False
         実行出力をログに出すか？
-    _proc : subprocess.Popen
-        実行したプロセスのPopenオブジェクト
+    handlers : list of function
+        実行出力を1行ずつ受け取る関数(Trueを返した行はログに出さない)
+    metrics : dict
+        実行中に集計したメトリクス
+    resources : dict
+        実行中に集計した資源使用量(resusage.ResourceSampler が書き込む)
+    phases : dict
+        フェーズごとの所要時間(jobstats.PhaseTimer が書き込む)
+    log : logbuffer.LogBuffer, default None
+        実行出力のリングバッファ
+    log_file : dict of {path: str, start: int, end: int}, default None
+        実行出力が書かれるログファイルと、ファイル内の範囲(end は終了まで None)
+    lock : joblock.ResourceLock, default None
+        実行前に取るリソースのロック
+    job_id : int, default None
+        processpool.ProcessPool に登録したときのジョブID
+    _proc : asyncio.subprocess.Process or subprocess.Popen
+        実行したプロセス
+    _future : concurrent.futures.Future
+        出力の読み込みと終了待ち(終了コードを返す)
     _returncode : int, default -1
         実行したプロセスの終了コード
     """
 
-    def __init__(self, cmd, out_to_log=False):
+    def __init__(self, cmd, out_to_log=False, handlers=None):
         self.cmd = cmd
         self.out_to_log = out_to_log
+        self.handlers = [] if handlers is None else handlers
+        self.metrics = {}
+        self.resources = {}
+        self.phases = {}
+        self.log = None
+        self.log_file = None
+        self.lock = None
+        self.job_id = None
         self._proc = None
+        self._future = None
         self._returncode = -1
 
     @property
     def returncode(self):
         # 実行してなかったらそのまま返す
-        if self._proc == None:
+        if self._proc is None:
             return self._returncode
         # 要求されたのに終了してなかったら待つ
-        if self._proc.returncode is None:
+        if self._future is not None:
+            self._returncode = self._future.result()
+        elif self._proc.returncode is None:
             self._returncode = self._proc.wait()
+        else:
+            self._returncode = self._proc.returncode
         return self._returncode
 
     @property
     def pid(self):
         return self._proc.pid
 
-    def _print_stuout_to_logger(self):
+    def _handle_line(self, line):
         """
-        コマンド実行の標準出力をログに出力する
+        1行を各ハンドラに渡し、消費されなければ整形せずにログに出す
         """
-        format_before = logging.getLogger().handlers[0].formatter._fmt
-        try:
-            logutil.set_logger_format(logging.getLogger().handlers, '%(message)s')
-            for line in self._proc.stdout:
-                logger.info(line.strip())
-        finally:
-            logutil.set_logger_format(logging.getLogger().handlers, format_before)
+        line = line.rstrip()
+        consumed = False
+        for handler in self.handlers:
+            try:
+                consumed = handler(line) or consumed
+            except Exception:
+                logger.exception('line handler failed')
+        if self.out_to_log and not consumed:
+            logger.info(line.strip(), extra={logutil.RAW: True})
 
-    def _process_if(self, func, *args, **kwargs):
-        """
-        プロセスに関する条件判定
-        """
-        try:
-            return func(*args, **kwargs)
-        except psutil.NoSuchProcess:
-            return False
+    async def _start(self):
+        self._proc = await asyncio.create_subprocess_exec(*self.cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                          stdout=asyncio.subprocess.PIPE,
+                                                          stderr=asyncio.subprocess.STDOUT)
 
-    def get_other_process_pids(self):
+    async def _stream(self):
         """
-        実行時に動いている他のプロセスのPIDを取得する
-
-        Returns
-        -------
-        pids : list
-            プロセスIDのリスト
+        出力をチャンク単位で読んで行に分け、終了コードを返す
         """
-        procs = []
-        append = procs.append
-        for proc in psutil.process_iter(attrs=['pid', 'name', 'status']):
-            try:
-                append(proc)
-            except psutil.NoSuchProcess:
-                pass
-        procs_running = [proc for proc in procs
-                         if self._process_if(lambda: proc.status() == 'running')]
-        procs_samename = [proc for proc in procs_running
-                          if self._process_if(lambda: proc.name() == self.cmd[0])]
-        pids_other = [proc.pid for proc in procs_samename
-                      if self._process_if(lambda: proc.cmdline()[:2] == self.cmd[:2])]
-        return pids_other
+        decoder = codecs.getincrementaldecoder('UTF-8')(errors='replace')
+        rest = ''
+        # チャンク末尾の \r は行末として出し、続く \n は読み捨てる
+        skip_lf = False
+        while True:
+            chunk = await self._proc.stdout.read(READ_SIZE)
+            if not chunk:
+                break
+            text = rest + decoder.decode(chunk)
+            if skip_lf and text.startswith('\n'):
+                text = text[1:]
+            if text:
+                skip_lf = text.endswith('\r')
+            lines, rest = split_lines(text)
+            for line in lines:
+                self._handle_line(line)
+        rest += decoder.decode(b'', final=True)
+        lines, rest = split_lines(rest)
+        for line in lines + ([rest] if rest else []):
+            self._handle_line(line)
+        return await self._proc.wait()
 
     def wait_other_process(self, timeout=None):
         """
-        実行時に動いている他の指定プロセスの終了を待つ
+        同じリソースを使う他のジョブの終了を待ち、ロックを取る
 
         Parameters
         ----------
-        timeout : int, default 60
-            1回のプロセス待ちをチェックする間隔(s)
+        timeout : float, default None
+            待つ時間の上限(s)。None は無制限
 
         Returns
         -------
         returncode : int
             終了コード
         """
-        other_procs = [psutil.Process(pid) for pid in self.get_other_process_pids()
-                      if self._process_if(lambda: psutil.pid_exists(pid))]
-        if len(other_procs) > 0:
-            gone, alive = psutil.wait_procs(other_procs, timeout=timeout)
-            if len(alive) > 0:
-                logger.error('process wait failed. pid : %s',
-                             ','.join([str(proc.pid) for proc in alive]))
-                return 1
+        if self.lock is None:
+            return 0
+        if not self.lock.acquire(timeout):
+            logger.error('lock wait timed out. key : %s', self.lock.key)
+            return 1
         return 0
 
-    def execute(self, wait=False):
+    def release_lock(self):
+        """
+        wait_other_process で取ったロックを解放する
         """
-        シェルコマンド実行
+        if self.lock is not None:
+            self.lock.release()
+
+    def execute(self, wait=False, detach=False):
+        """
+        コマンド実行
+
+        出力は共有のイベントループで読み込むので、wait=False なら起動後すぐに戻る。
 
         Parameters
         ----------
         wait : bool, default False
             プロセスの終了を待つか？
+        detach : bool, default False
+            呼び出し元と切り離して実行するか？(出力は破棄し、終了も待たない)
         """
-        joined_cmd = ' '.join(self.cmd)
         logger.info('execute command (%s)', ' '.join(self.cmd))
-        proc = Popen(joined_cmd, shell=True, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
-        self._proc = proc
-        # ログを出す
-        if self.out_to_log:
-            self._print_stuout_to_logger()
+        if detach:
+            self._proc = Popen(self.cmd, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+            return
+        try:
+            EventLoopThread.submit(self._start()).result()
+        except OSError as e:
+            # シェル経由のときと同じく、起動できなければ127で終了したものとする
+            logger.error('Could not execute %s: %s', self.cmd[0], e)
+            self._returncode = 127
+            return
+        self._future = EventLoopThread.submit(self._stream())
         # 終了を待つ
         if wait:
-            self._returncode = self._proc.wait()
\ No newline at end of file
+            self._returncode = self._future.result()
+
+class AttachedProcess(Process):
+    """
+    以前のサーバが起動し、サーバの再起動後も動き続けているプロセス
+
+    自分の子プロセスではないので、出力は読めず終了コードも分からない(終了後は-1とする)。
+
+    Attributes
+    ----------
+    create_time : float
+        起動時刻(PIDの再利用と区別する)
+    """
+
+    def __init__(self, cmd, pid, create_time):
+        super().__init__(cmd)
+        self._pid = pid
+        self.create_time = create_time
+
+    @property
+    def pid(self):
+        return self._pid
+
+    @property
+    def returncode(self):
+        if self.is_alive():
+            try:
+                psutil.Process(self._pid).wait()
+            except psutil.NoSuchProcess:
+                pass
+        return self._returncode
+
+    def is_alive(self):
+        """
+        記録したPIDと起動時刻のプロセスがまだ動いているか？
+
+        Returns
+        -------
+        bool
+        """
+        if self._pid is None or self.create_time is None:
+            return False
+        try:
+            return abs(psutil.Process(self._pid).create_time() - self.create_time) < 0.01
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return False
+
+    def execute(self, wait=False, detach=False):
+        """
+        既に動いているので何もしない(wait=True なら終了を待つ)
+        """
+        if wait:
+            self.returncode
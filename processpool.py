@@ -1,36 +1,64 @@
+import time
 import datetime
+import itertools
+import threading
+from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)
 
+from process import Process, AttachedProcess
+import jobstore
+
+# touch で版数を上げる間隔(s)(ジョブごと)
+TOUCH_INTERVAL = 1.0
+
 class ProcessPool:
     """
     プロセスをプールするクラス
 
+    ジョブはIDで索引し、状態ごとに登録順で持つ。
+    Flaskのスレッドから同時に呼ばれるので、操作は全てロックの中で行う。
+    終了・エラーの履歴は件数と経過時間で古いものから捨てる。
+    store を指定すると状態が変わるたびに書き込み、restore でサーバ再起動後に読み戻す。
+    書き込む行はロックの中で作り、SQLiteへの書き込みはロックの外でまとめて行う(同じジョブは最新の行だけ)。
+
     Attributes
     ----------
-    error : list
-        エラープロセスプール
-    finished : list
-        終了プロセスプール
-    running : list
-        実行中プロセスプール
-    pending : list
-        実行持ちプロセスプール
+    history_size : int, default 100
+        終了・エラーそれぞれに残す件数の上限(None は無制限)
+    history_age : float, default None
+        終了・エラーを残す時間(s)(None は無制限)
+    store : jobstore.JobStore, default None
+        ジョブを永続化するストア
+    touch_interval : float, default TOUCH_INTERVAL
+        メトリクスの更新で版数を上げる間隔(s)
+    version : int
+        状態が変わるたびに増える番号
     """
     ERROR = 'error'
     FINISHED = 'finished'
     RUNNING = 'running'
     PENDING = 'pending'
+    KEYS = (ERROR, FINISHED, RUNNING, PENDING)
+    # 履歴として件数・経過時間で捨てる状態
+    HISTORY_KEYS = (ERROR, FINISHED)
 
-    def __init__(self):
-        self.error = []
-        self.finished = []
-        self.running = []
-        self.pending = []
-        self.map = {self.ERROR: self.error,
-                    self.FINISHED: self.finished,
-                    self.RUNNING: self.running,
-                    self.PENDING: self.pending}
+    def __init__(self, history_size=100, history_age=None, store=None, touch_interval=TOUCH_INTERVAL):
+        self.history_size = history_size
+        self.history_age = history_age
+        self.store = store
+        self.touch_interval = touch_interval
+        self.version = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._states = {key: OrderedDict() for key in self.KEYS}
+        self._snapshot = None
+        self._section_func = None
+        # ストアへの書き込み待ち(ジョブID: 行、削除はNone)
+        self._writes = OrderedDict()
+        self._store_lock = threading.Lock()
 
     def is_in_keys(self, key):
         """
@@ -45,7 +73,103 @@ class ProcessPool:
         -------
         bool
         """
-        return key in self.map.keys()
+        return key in self._states
+
+    def _changed(self):
+        self.version += 1
+        self._snapshot = None
+        self._cond.notify_all()
+
+    def _put(self, job, key):
+        """
+        ジョブを状態に登録する(ロックの中で呼ぶ)
+        """
+        job['state'] = key
+        job['updated_at'] = datetime.datetime.now().isoformat()
+        job['updated_ts'] = time.time()
+        job['updated_mono'] = time.monotonic()
+        job['section'] = None
+        self._states[key][job['id']] = job
+        self._persist(job)
+        if key in self.HISTORY_KEYS:
+            self._evict()
+
+    def _persist(self, job):
+        """
+        ジョブの今の行を書き込み待ちにする(ロックの中で呼ぶ)
+        """
+        if self.store is None:
+            return
+        proc = job['proc']
+        # 終了していないプロセスの終了コードは待たずに空にする
+        returncode = proc.returncode if job['state'] in self.HISTORY_KEYS else None
+        self._writes.pop(job['id'], None)
+        self._writes[job['id']] = {'id': job['id'], 'cmd': list(proc.cmd), 'state': job['state'],
+                                   'updated_at': job['updated_at'], 'updated_ts': job['updated_ts'],
+                                   'pid': job.get('pid'), 'create_time': job.get('create_time'),
+                                   'returncode': returncode, 'metrics': dict(proc.metrics),
+                                   'resources': dict(proc.resources),
+                                   'log_file': None if proc.log_file is None else dict(proc.log_file)}
+
+    def _forget(self, job_ids):
+        """
+        ジョブの削除を書き込み待ちにする(ロックの中で呼ぶ)
+        """
+        if self.store is None:
+            return
+        for job_id in job_ids:
+            self._writes.pop(job_id, None)
+            self._writes[job_id] = None
+
+    def _flush(self):
+        """
+        書き込み待ちをストアに書き込む(ロックの外で呼ぶ)
+
+        取り出しと書き込みを _store_lock で直列にするので、後から取り出した行が先に書かれることはない。
+        """
+        if self.store is None or len(self._writes) == 0:
+            return
+        with self._store_lock:
+            with self._lock:
+                writes, self._writes = self._writes, OrderedDict()
+            for job_id, row in writes.items():
+                if row is None:
+                    continue
+                try:
+                    self.store.save(row)
+                except Exception as e:
+                    logger.warning('could not save job %d: %s', job_id, e)
+            deleted = [job_id for job_id, row in writes.items() if row is None]
+            if len(deleted) == 0:
+                return
+            try:
+                self.store.delete(deleted)
+            except Exception as e:
+                logger.warning('could not delete jobs %s: %s', deleted, e)
+
+    def _evict(self):
+        """
+        上限を超えた・古くなった履歴を捨てる(ロックの中で呼ぶ)
+
+        Returns
+        -------
+        bool
+            捨てたものがあるか？
+        """
+        evicted = []
+        limit = None if self.history_age is None else time.monotonic() - self.history_age
+        for key in self.HISTORY_KEYS:
+            history = self._states[key]
+            while len(history) > 0:
+                job = next(iter(history.values()))
+                if not ((self.history_size is not None and len(history) > self.history_size)
+                        or (limit is not None and job['updated_mono'] < limit)):
+                    break
+                history.popitem(last=False)
+                del self._jobs[job['id']]
+                evicted.append(job['id'])
+        self._forget(evicted)
+        return len(evicted) > 0
 
     def register(self, proc, key):
         """
@@ -57,14 +181,198 @@ class ProcessPool:
             プロセスインスタンス
         key : str
             登録先キー
+
+        Returns
+        -------
+        job_id : int
+            ジョブID(キー違反ならNone)
         """
         # キー違反チェック
         if not self.is_in_keys(key):
             logger.error('given target key %s not exist', key)
-            return
+            return None
 
         # 登録
-        self.map[key].append({'proc': proc, 'updated_at': datetime.datetime.now().isoformat()})
+        with self._lock:
+            job = {'id': next(self._ids), 'proc': proc}
+            proc.job_id = job['id']
+            self._jobs[job['id']] = job
+            self._put(job, key)
+            self._changed()
+        self._flush()
+        return job['id']
+
+    def update_proc(self, proc):
+        """
+        起動したプロセスのPIDと起動時刻を記録する
+
+        Parameters
+        ----------
+        proc : process.Process
+            起動したプロセス
+        """
+        try:
+            pid = proc.pid
+        except AttributeError:
+            pid = None
+        create_time = None if pid is None else jobstore.create_time_of(pid)
+        with self._lock:
+            job = self._jobs.get(proc.job_id)
+            if job is None or job['proc'] is not proc:
+                return
+            job['pid'] = pid
+            job['create_time'] = create_time
+            self._persist(job)
+        self._flush()
+
+    def restore(self):
+        """
+        ストアからジョブを読み戻す
+
+        終了・エラーは履歴として戻す。実行中・待機中だったものは
+        process.AttachedProcess として元の状態に戻すので、呼び出し側で照合する。
+
+        Returns
+        -------
+        list of process.AttachedProcess
+            前回終了時に実行中・待機中だったジョブのプロセス
+        """
+        if self.store is None:
+            return []
+        rows = self.store.load()
+        unfinished = []
+        with self._lock:
+            now_ts = time.time()
+            now_mono = time.monotonic()
+            for row in rows:
+                if not self.is_in_keys(row['state']) or row['id'] in self._jobs:
+                    continue
+                if row['state'] in self.HISTORY_KEYS:
+                    proc = Process(row['cmd'])
+                    proc._returncode = -1 if row['returncode'] is None else row['returncode']
+                else:
+                    proc = AttachedProcess(row['cmd'], row['pid'], row['create_time'])
+                    unfinished.append(proc)
+                proc.metrics.update(row['metrics'])
+                proc.resources.update(row['resources'])
+                proc.log_file = row.get('log_file')
+                proc.job_id = row['id']
+                job = {'id': row['id'], 'proc': proc, 'state': row['state'],
+                       'updated_at': row['updated_at'], 'updated_ts': row['updated_ts'],
+                       'updated_mono': now_mono - max(0.0, now_ts - row['updated_ts']),
+                       'pid': row['pid'], 'create_time': row['create_time'], 'section': None}
+                self._jobs[job['id']] = job
+                self._states[job['state']][job['id']] = job
+            if len(self._jobs) > 0:
+                self._ids = itertools.count(max(self._jobs) + 1)
+            self._evict()
+            self._changed()
+        self._flush()
+        return unfinished
+
+    def get(self, job_id):
+        """
+        ジョブを取得する
+
+        Parameters
+        ----------
+        job_id : int
+            ジョブID
+
+        Returns
+        -------
+        dict of {id: int, proc: process.Process, state: str, updated_at: str} or None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def wait(self, job_id, timeout=None):
+        """
+        ジョブが終了・エラーになるのを待つ
+
+        Parameters
+        ----------
+        job_id : int
+            ジョブID
+        timeout : float, default None
+            待つ時間の上限(s)。None は無制限
+
+        Returns
+        -------
+        dict or None
+            get と同じ(時間切れならその時点の状態)
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: job_id not in self._jobs
+                                or self._jobs[job_id]['state'] in self.HISTORY_KEYS, timeout)
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def _to_section(self, job, to_section_name):
+        return {'id': job['id'], 'name': to_section_name(job['proc']), 'updated_at': job['updated_at'],
+                'metrics': dict(job['proc'].metrics), 'resources': dict(job['proc'].resources)}
+
+    def touch(self, proc):
+        """
+        プロセスのメトリクスが変わったことを知らせる(状態表示を作り直す)
+
+        進捗行や資源使用量のサンプルごとに呼ばれるので、版数を上げて待っている
+        クライアントを起こすのはジョブごとに touch_interval に1回までにする(間の更新は次の touch で反映する)。
+
+        Parameters
+        ----------
+        proc : process.Process
+            対象のプロセス
+        """
+        with self._lock:
+            job = self._jobs.get(proc.job_id)
+            if job is None or job['proc'] is not proc:
+                return
+            now = time.monotonic()
+            if now - job.get('touched_mono', float('-inf')) < self.touch_interval:
+                return
+            job['touched_mono'] = now
+            job['section'] = None
+            self._changed()
+
+    def snapshot(self, to_section_name):
+        """
+        版数とプロセスのセクション辞書を取得する
+
+        項目は変わったジョブ(状態の移動、touch)だけを作り直し、
+        変わっていないジョブは前回と同じ辞書を返す(返した辞書は変更しないこと)。
+
+        Parameters
+        ----------
+        to_section_name : function
+            セクション作成関数
+
+        Returns
+        -------
+        version : int
+            版数
+        sections : dict of {str: list of {id: int, name: str, updated_at: str, metrics: dict, resources: dict}}
+        """
+        with self._lock:
+            if self.history_age is not None and self._evict():
+                self._changed()
+            if self._section_func is not to_section_name:
+                # 作成関数が変わったら全て作り直す
+                self._section_func = to_section_name
+                for job in self._jobs.values():
+                    job['section'] = None
+                self._snapshot = None
+            if self._snapshot is None:
+                self._snapshot = {}
+                for key in self.KEYS:
+                    for job in self._states[key].values():
+                        if job['section'] is None:
+                            job['section'] = self._to_section(job, to_section_name)
+                    self._snapshot[key] = [job['section'] for job in self._states[key].values()]
+            version, sections = self.version, {key: list(value) for key, value in self._snapshot.items()}
+        self._flush()
+        return version, sections
 
     def get_section(self, to_section_name):
         """
@@ -77,10 +385,40 @@ class ProcessPool:
 
         Returns
         -------
-        dict of {str: list of {name: str}}
+        dict of {str: list of {id: int, name: str, updated_at: str, metrics: dict, resources: dict}}
+        """
+        return self.snapshot(to_section_name)[1]
+
+    def counts(self):
+        """
+        状態ごとのジョブ数を取得する
+
+        Returns
+        -------
+        dict of {str: int}
         """
-        procs_sections = {key: [{'name': to_section_name(v['proc']), 'updated_at': v['updated_at']} for v in value] if len(value) > 0 else [] for key, value in self.map.items()}
-        return procs_sections
+        with self._lock:
+            return {key: len(jobs) for key, jobs in self._states.items()}
+
+    def wait_change(self, version, timeout=None):
+        """
+        版数が変わるのを待つ
+
+        Parameters
+        ----------
+        version : int
+            知っている版数
+        timeout : float, default None
+            待つ時間の上限(s)。None は無制限
+
+        Returns
+        -------
+        version : int
+            現在の版数
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
 
     def move_proc(self, proc, target):
         """
@@ -98,29 +436,21 @@ class ProcessPool:
         int
             終了コード
         """
-        # プロセスのある場所を探す
-        for k, v in self.map.items():
-            for i, item in enumerate(v):
-                if proc == item['proc']:
-                    key = k
-                    index = i
-                    break
-            else:
-                continue
-            break
-        else:
-            logger.error('given process not exist in pool')
-            return 1
-
         # targetのキー違反チェック
         if not self.is_in_keys(target):
             logger.error('given target key %s not exist', target)
             return 1
 
-        # 処理
-        self.map[key].pop(index)
-        self.register(proc, target)
-
+        with self._lock:
+            job = self._jobs.get(getattr(proc, 'job_id', None))
+            if job is None or job['proc'] is not proc:
+                logger.error('given process not exist in pool')
+                return 1
+            # 処理
+            del self._states[job['state']][job['id']]
+            self._put(job, target)
+            self._changed()
+        self._flush()
         return 0
 
     def clear_procs(self, targets):
@@ -132,10 +462,16 @@ class ProcessPool:
         targets : list of str
             クリアするキーのリスト
         """
-        for target in targets:
-            # targetのキー違反チェック
-            if not self.is_in_keys(target):
-                logger.warning('given target key %s not exist', target)
-                continue
+        with self._lock:
+            for target in targets:
+                # targetのキー違反チェック
+                if not self.is_in_keys(target):
+                    logger.warning('given target key %s not exist', target)
+                    continue
 
-            self.map[target].clear()
+                for job_id in self._states[target]:
+                    del self._jobs[job_id]
+                self._forget(list(self._states[target]))
+                self._states[target].clear()
+            self._changed()
+        self._flush()
@@ -0,0 +1,324 @@
+import math
+import bisect
+import datetime
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+# Prometheus テキスト形式の Content-Type
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# ジョブの所要時間のバケット(s): 1分から1日まで
+DURATION_BUCKETS = (60, 300, 600, 1800, 3600, 2*3600, 4*3600, 8*3600, 16*3600, 24*3600)
+# 実行待ち時間のバケット(s)
+WAIT_BUCKETS = (1, 10, 60, 300, 900, 1800, 3600, 4*3600)
+
+def format_value(value):
+    """
+    値をテキスト形式で表す
+    """
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+def format_labels(names, values):
+    """
+    ラベルをテキスト形式で表す
+
+    Parameters
+    ----------
+    names : tuple of str
+        ラベル名
+    values : tuple of str
+        ラベルの値
+
+    Returns
+    -------
+    str
+        {a="x",b="y"}(ラベルがなければ空文字列)
+    """
+    if len(names) == 0:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join('%s="%s"' % (name, value) for name, value in zip(names, escaped)) + '}'
+
+class Metric:
+    """
+    ラベルごとの値を持つメトリクスの基底クラス
+
+    値はイベントのたびに更新し、スクレイプでは今の値を書き出すだけにする。
+
+    Attributes
+    ----------
+    name : str
+        メトリクス名
+    help : str
+        説明
+    labelnames : tuple of str
+        ラベル名
+    """
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('labels of %s must be %s' % (self.name, self.labelnames))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def samples(self):
+        """
+        Returns
+        -------
+        list of tuple of (str, str, float)
+            サンプル名、ラベル、値
+        """
+        with self._lock:
+            return [(self.name, format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+    def expose(self):
+        """
+        テキスト形式で書き出す
+
+        Returns
+        -------
+        list of str
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.TYPE)]
+        lines += ['%s%s %s' % (name, labels, format_value(value)) for name, labels, value in self.samples()]
+        return lines
+
+class Counter(Metric):
+    """
+    増えるだけの値
+    """
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('counter can only increase')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    増減する値
+
+    set_function で関数を渡すと、スクレイプ時にその値を書き出す(ラベルなしのとき)。
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function):
+        """
+        Parameters
+        ----------
+        function : function
+            ラベルの値のタプルと値の辞書を返す関数
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        try:
+            values = self._function()
+        except Exception as e:
+            logger.warning('could not collect %s: %s', self.name, e)
+            return []
+        return [(self.name, format_labels(self.labelnames, key), value) for key, value in values.items()]
+
+class Histogram(Metric):
+    """
+    値の分布(バケットごとの件数、合計、件数)
+
+    観測はバケットの件数を1つ増やすだけで、累積はスクレイプ時に O(バケット数) で求める。
+
+    Attributes
+    ----------
+    buckets : tuple of float
+        バケットの上限(昇順、+Inf は自動で足す)
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """
+        Returns
+        -------
+        dict of {count: int, sum: float} or None
+        """
+        value = super().get(**labels)
+        if value is None:
+            return None
+        return {'count': sum(value[0]), 'sum': value[1]}
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket',
+                                format_labels(self.labelnames + ('le',), key + (format_value(bound),)),
+                                cumulative))
+            labels = format_labels(self.labelnames, key)
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+class Registry:
+    """
+    メトリクスをまとめて書き出すクラス
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """
+        全メトリクスをテキスト形式で書き出す
+
+        Returns
+        -------
+        str
+        """
+        lines = []
+        for metric in self._metrics:
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+class JobMetrics:
+    """
+    バックアップサーバのメトリクス
+
+    ジョブの完了、実行待ち、世代の削除のたびに更新する。
+
+    Attributes
+    ----------
+    registry : Registry
+        メトリクスの登録先
+    """
+
+    def __init__(self, registry=None):
+        self.registry = Registry() if registry is None else registry
+        register = self.registry.register
+        self.jobs = register(Gauge('backup_jobs', 'Number of jobs in the process pool by state.', ('state',)))
+        self.completed = register(Counter('backup_jobs_completed_total', 'Number of completed jobs.',
+                                          ('section', 'kind', 'result')))
+        self.duration = register(Histogram('backup_job_duration_seconds', 'Duration of completed jobs.',
+                                           ('section', 'kind'), DURATION_BUCKETS))
+        self.bytes = register(Counter('backup_transferred_bytes_total', 'Bytes transferred by rsync.',
+                                      ('section',)))
+        self.last_success = register(Gauge('backup_last_success_timestamp_seconds',
+                                           'Unix time of the last successful job.', ('section', 'kind')))
+        self.queue_wait = register(Histogram('backup_queue_wait_seconds',
+                                             'Time jobs waited for other jobs using the same resources.',
+                                             ('section',), WAIT_BUCKETS))
+        self.removed = register(Counter('backup_retention_removed_total',
+                                        'Number of generations removed by the retention policy.',
+                                        ('section', 'kind')))
+
+    def track_pool(self, pool):
+        """
+        ジョブ数をプロセスプールから取る
+
+        Parameters
+        ----------
+        pool : processpool.ProcessPool
+            プロセスプールインスタンス
+        """
+        self.jobs.set_function(lambda: {(key,): count for key, count in pool.counts().items()})
+
+    def job_finished(self, entry):
+        """
+        完了したジョブを記録する
+
+        Parameters
+        ----------
+        entry : dict
+            section, kind, finished_at, duration, returncode, bytes を持つ履歴(jobstats と同じ)
+        """
+        section, kind = entry['section'], entry['kind']
+        succeeded = entry['returncode'] == 0
+        self.completed.inc(section=section, kind=kind, result='success' if succeeded else 'failure')
+        if not succeeded:
+            return
+        self.duration.observe(entry['duration'], section=section, kind=kind)
+        if entry['bytes'] is not None:
+            self.bytes.inc(entry['bytes'], section=section)
+        self.last_success.set(datetime.datetime.fromisoformat(entry['finished_at']).timestamp(),
+                              section=section, kind=kind)
+
+    def load_stats(self, stats):
+        """
+        再起動前の最終成功日時を統計から引き継ぐ
+
+        Parameters
+        ----------
+        stats : dict
+            jobstats.JobStats.get() の戻り値
+        """
+        for section, kinds in stats.items():
+            for kind, summary in kinds.items():
+                if summary.get('last_success_at') is not None:
+                    self.last_success.set(datetime.datetime.fromisoformat(summary['last_success_at']).timestamp(),
+                                          section=section, kind=kind)
+
+    def queue_waited(self, section, seconds):
+        """
+        実行待ちの時間を記録する
+        """
+        self.queue_wait.observe(seconds, section=section)
+
+    def retention_removed(self, section, kind, count):
+        """
+        保持ポリシーで削除した世代数を記録する
+        """
+        self.removed.inc(count, section=section, kind=kind)
+
+    def expose(self):
+        return self.registry.expose()
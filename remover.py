@@ -0,0 +1,281 @@
+import os
+import re
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+logger = logging.getLogger(__name__)
+
+TRASH_DIRNAME = '.trash'
+# backup.py が出力し app.py が読み取る、保持ポリシーで削除した世代数の行
+REMOVED_PREFIX = 'retention removed:'
+REMOVED_PATTERN = re.compile(re.escape(REMOVED_PREFIX) + r' kind=(\w+) generations=(\d+)')
+
+class RemoveStats:
+    """
+    削除結果を集計するクラス
+
+    Attributes
+    ----------
+    files : int
+        削除したファイル数(シンボリックリンク等を含む)
+    dirs : int
+        削除したディレクトリ数
+    bytes_freed : int
+        解放したバイト数(他にリンクが残るファイルは数えない)
+    errors : int
+        削除に失敗したエントリ数
+    elapsed : float
+        処理時間(s)
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.bytes_freed = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    @property
+    def files_per_sec(self):
+        if self.elapsed <= 0:
+            return float(self.files)
+        return self.files / self.elapsed
+
+    def __str__(self):
+        return 'removed %d files, %d dirs, %d bytes freed in %.1fs (%.0f files/s), %d errors' % (
+            self.files, self.dirs, self.bytes_freed, self.elapsed, self.files_per_sec, self.errors)
+
+def format_removed(kind, count):
+    """
+    削除した世代数の行を作る
+
+    Parameters
+    ----------
+    kind : str
+        世代の種類(dirs, logs)
+    count : int
+        削除した世代数
+
+    Returns
+    -------
+    str
+    """
+    return '%s kind=%s generations=%d' % (REMOVED_PREFIX, kind, count)
+
+def parse_removed(line):
+    """
+    削除した世代数の行をパースする
+
+    Parameters
+    ----------
+    line : str
+        出力1行
+
+    Returns
+    -------
+    tuple of (str, int) or None
+        世代の種類と削除した世代数
+    """
+    m = REMOVED_PATTERN.search(line)
+    if m is None:
+        return None
+    return m.group(1), int(m.group(2))
+
+def _freed_size(st):
+    """
+    unlinkで解放されるバイト数
+
+    Parameters
+    ----------
+    st : os.stat_result
+        削除するエントリのstat
+
+    Returns
+    -------
+    int
+    """
+    # 他のハードリンクが残る場合は解放されない
+    if st.st_nlink > 1:
+        return 0
+    return st.st_blocks * 512
+
+def _unlink_entries(dirpath):
+    """
+    ディレクトリ直下のディレクトリ以外のエントリを削除する
+
+    Parameters
+    ----------
+    dirpath : str
+        対象ディレクトリ
+
+    Returns
+    -------
+    subdirs : list of str
+        直下のサブディレクトリ
+    stats : RemoveStats
+        削除結果
+    """
+    subdirs = []
+    stats = RemoveStats()
+    try:
+        fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        return subdirs, stats
+    except OSError as e:
+        logger.error('cannot open %s: %s', dirpath, e)
+        stats.errors += 1
+        return subdirs, stats
+    try:
+        with os.scandir(fd) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(os.path.join(dirpath, entry.name))
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    os.unlink(entry.name, dir_fd=fd)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.error('cannot remove %s: %s', os.path.join(dirpath, entry.name), e)
+                    stats.errors += 1
+                    continue
+                stats.files += 1
+                stats.bytes_freed += _freed_size(st)
+    finally:
+        os.close(fd)
+    return subdirs, stats
+
+def remove_trees(paths, workers=4):
+    """
+    ファイル・ディレクトリツリーを並列に削除する
+
+    ディレクトリ単位のunlinkをスレッドプールで並列に行い、
+    最後に深いディレクトリから順にrmdirする。
+
+    Parameters
+    ----------
+    paths : list of str
+        削除するパス
+    workers : int, default 4
+        削除スレッド数
+
+    Returns
+    -------
+    stats : RemoveStats
+        削除結果
+    """
+    stats = RemoveStats()
+    start = time.monotonic()
+    dirs = []
+    for path in paths:
+        path = path.rstrip('/') or path
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            dirs.append(path)
+            continue
+        try:
+            os.unlink(path)
+        except OSError as e:
+            logger.error('cannot remove %s: %s', path, e)
+            stats.errors += 1
+            continue
+        stats.files += 1
+        stats.bytes_freed += _freed_size(st)
+
+    # ファイル削除(ディレクトリを見つけ次第投入する)
+    all_dirs = list(dirs)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(_unlink_entries, d) for d in dirs}
+        while len(futures) > 0:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, sub_stats = future.result()
+                stats.files += sub_stats.files
+                stats.bytes_freed += sub_stats.bytes_freed
+                stats.errors += sub_stats.errors
+                all_dirs.extend(subdirs)
+                futures.update(executor.submit(_unlink_entries, d) for d in subdirs)
+
+    # ディレクトリ削除(深い順)
+    for dirpath in sorted(all_dirs, key=lambda d: d.count(os.sep), reverse=True):
+        try:
+            os.rmdir(dirpath)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.error('cannot remove %s: %s', dirpath, e)
+            stats.errors += 1
+            continue
+        stats.dirs += 1
+
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+def move_to_trash(paths):
+    """
+    削除対象を同じ階層のゴミ箱ディレクトリへ移動する
+
+    renameのみなので即座に終わり、世代の検索対象からも外れる。
+
+    Parameters
+    ----------
+    paths : list of str
+        移動するパス
+
+    Returns
+    -------
+    trash_dirs : list of str
+        移動先のゴミ箱ディレクトリ(重複なし)
+    """
+    trash_dirs = []
+    for path in paths:
+        path = path.rstrip('/') or path
+        if not os.path.lexists(path):
+            continue
+        trash_dir = os.path.join(os.path.dirname(path), TRASH_DIRNAME)
+        os.makedirs(trash_dir, exist_ok=True)
+        os.rename(path, os.path.join(trash_dir, '%s.%d' % (os.path.basename(path), time.time_ns())))
+        if trash_dir not in trash_dirs:
+            trash_dirs.append(trash_dir)
+    return trash_dirs
+
+def main(args=sys.argv[1:]):
+    """
+    バックグラウンド削除のエントリポイント
+
+    Parameters
+    ----------
+    args : list
+        コマンド引数
+
+    Returns
+    -------
+    returncode : int
+        終了コード
+    """
+    parser = argparse.ArgumentParser(description='Remove trees in background')
+    parser.add_argument('--workers', dest='WORKERS', type=int, default=4)
+    parser.add_argument('--log', dest='LOG', type=str, default=None)
+    parser.add_argument('paths', nargs='+')
+    options = parser.parse_args(args)
+
+    LOG_FORMAT = '[%(levelname)s] %(asctime)s : %(name)s(%(lineno)s) %(message)s'
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    if options.LOG is not None:
+        filehandler = logging.FileHandler(options.LOG, mode='a', encoding='UTF-8')
+        filehandler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+        logging.getLogger().addHandler(filehandler)
+
+    stats = remove_trees(options.paths, options.WORKERS)
+    logger.info('background remove %s : %s', ' '.join(options.paths), stats)
+    return 0 if stats.errors == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
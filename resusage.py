@@ -0,0 +1,150 @@
+import time
+import threading
+import psutil
+import logging
+logger = logging.getLogger(__name__)
+
+class ResourceSampler(threading.Thread):
+    """
+    プロセスツリー全体(子孫プロセスを含む)の資源使用量を定期的に集計するスレッド
+
+    CPU時間とI/Oバイト数はプロセスごとの累積値の最新を合計する(サンプリング間に終了した分は数えない)。
+    集計結果は proc.resources に書き込む
+    (cpu_seconds, cpu_percent, cpu_percent_peak, rss, rss_peak,
+    read_bytes, write_bytes, read_rate_peak, write_rate_peak, procs_peak, samples)。
+
+    Attributes
+    ----------
+    proc : process.Process
+        集計するプロセス(PIDが分かるまでは集計しない)
+    interval : float, default 5.0
+        サンプリング間隔(s)
+    baseline : bool, default False
+        最初の集計時点で既にあったプロセス(常駐ワーカーなど)は、その時点からの増分だけを数えるか？
+    on_sample : function, default None
+        集計するたびに呼ぶ関数
+    """
+
+    def __init__(self, proc, interval=5.0, baseline=False, on_sample=None):
+        super().__init__(name='resource-sampler', daemon=True)
+        self.proc = proc
+        self.on_sample = on_sample
+        self.resources = proc.resources
+        self.interval = interval
+        self.baseline = baseline
+        self._stop_event = threading.Event()
+        self._procs = {}
+        self._baseline = {}
+        self._last = None
+        self.resources.update({'cpu_seconds': 0.0, 'cpu_percent': 0.0, 'cpu_percent_peak': 0.0,
+                               'rss': 0, 'rss_peak': 0, 'read_bytes': 0, 'write_bytes': 0,
+                               'read_rate_peak': 0.0, 'write_rate_peak': 0.0, 'procs_peak': 0, 'samples': 0})
+
+    def _tree(self, pid):
+        """
+        ツリーのプロセスを列挙する
+
+        Returns
+        -------
+        list of tuple of ((int, float), psutil.Process)
+            (PID, 起動時刻) とプロセス
+        """
+        try:
+            root = psutil.Process(pid)
+            procs = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+        tree = []
+        for proc in procs:
+            try:
+                key = (proc.pid, proc.create_time())
+            except psutil.NoSuchProcess:
+                continue
+            tree.append((key, self._procs.setdefault(key, proc)))
+        return tree
+
+    @staticmethod
+    def _read(proc):
+        """
+        1プロセスの累積CPU時間、RSS、I/Oを読む
+        """
+        with proc.oneshot():
+            cpu = proc.cpu_times()
+            rss = proc.memory_info().rss
+            try:
+                io = proc.io_counters()
+                read_bytes, write_bytes = io.read_bytes, io.write_bytes
+            except (psutil.AccessDenied, AttributeError, NotImplementedError):
+                read_bytes, write_bytes = 0, 0
+        return cpu.user + cpu.system, rss, read_bytes, write_bytes
+
+    def sample(self):
+        """
+        1回集計する
+        """
+        try:
+            pid = self.proc.pid
+        except AttributeError:
+            pid = None
+        if pid is None:
+            return
+        first = self._last is None
+        totals = {}
+        rss = 0
+        count = 0
+        for key, proc in self._tree(pid):
+            try:
+                values = self._read(proc)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            if first and self.baseline:
+                self._baseline[key] = (values[0], values[2], values[3])
+            base = self._baseline.get(key, (0.0, 0, 0))
+            totals[key] = (values[0] - base[0], values[2] - base[1], values[3] - base[2])
+            rss += values[1]
+            count += 1
+        # 終了したプロセスは最後に読めた値を残す
+        if self._last is not None:
+            for key, values in self._last['totals'].items():
+                totals.setdefault(key, values)
+        now = time.monotonic()
+        cpu_seconds = sum(values[0] for values in totals.values())
+        read_bytes = sum(values[1] for values in totals.values())
+        write_bytes = sum(values[2] for values in totals.values())
+
+        res = self.resources
+        if self._last is not None and now > self._last['at']:
+            elapsed = now - self._last['at']
+            res['cpu_percent'] = round((cpu_seconds - self._last['cpu_seconds']) / elapsed * 100, 1)
+            res['cpu_percent_peak'] = max(res['cpu_percent_peak'], res['cpu_percent'])
+            res['read_rate_peak'] = max(res['read_rate_peak'],
+                                        round((read_bytes - self._last['read_bytes']) / elapsed, 1))
+            res['write_rate_peak'] = max(res['write_rate_peak'],
+                                         round((write_bytes - self._last['write_bytes']) / elapsed, 1))
+        res['cpu_seconds'] = round(cpu_seconds, 2)
+        res['rss'] = rss
+        res['rss_peak'] = max(res['rss_peak'], rss)
+        res['read_bytes'] = read_bytes
+        res['write_bytes'] = write_bytes
+        res['procs_peak'] = max(res['procs_peak'], count)
+        res['samples'] += 1
+        self._last = {'at': now, 'totals': totals, 'cpu_seconds': cpu_seconds,
+                      'read_bytes': read_bytes, 'write_bytes': write_bytes}
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+                if self.on_sample is not None:
+                    self.on_sample()
+            except Exception as e:
+                logger.warning('resource sampling failed: %s', e)
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        """
+        集計を止める
+        """
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,98 @@
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+# 直下のファイル類をまとめる作業単位の名前
+FILES_UNIT = ''
+
+def list_units(source):
+    """
+    バックアップ元を作業単位に分割する
+
+    直下のディレクトリは1つずつ、それ以外のエントリはまとめて1単位とする。
+
+    Parameters
+    ----------
+    source : str
+        バックアップ元ディレクトリパス
+
+    Returns
+    -------
+    units : dict of {str: list of str}
+        作業単位名とrsyncに渡すパスのリスト
+    """
+    units = {}
+    files = []
+    with os.scandir(source) as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            path = os.path.join(source, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                units[entry.name] = [path]
+            else:
+                files.append(path)
+    if len(files) > 0:
+        units[FILES_UNIT] = files
+    return units
+
+def plan_units(units, weights):
+    """
+    作業単位を前回の所要時間が長い順に並べる
+
+    空いたワーカから順に取り出すことで LPT スケジューリングになる。
+    前回実績のない単位は実績の平均値で見積もる。
+
+    Parameters
+    ----------
+    units : dict of {str: list of str}
+        作業単位
+    weights : dict of {str: float}
+        作業単位ごとの前回所要時間(s)
+
+    Returns
+    -------
+    names : list of str
+        実行順の作業単位名
+    """
+    known = [weights[name] for name in units if name in weights]
+    default = sum(known) / len(known) if len(known) > 0 else 1.0
+    return sorted(units, key=lambda name: weights.get(name, default), reverse=True)
+
+def load_weights(path):
+    """
+    作業単位の前回所要時間を読み込む
+
+    Parameters
+    ----------
+    path : str
+        保存ファイルパス
+
+    Returns
+    -------
+    weights : dict of {str: float}
+    """
+    try:
+        with open(path, encoding='UTF-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning('Could not read shard weights %s: %s', path, e)
+        return {}
+
+def save_weights(path, weights):
+    """
+    作業単位の所要時間を保存する
+
+    Parameters
+    ----------
+    path : str
+        保存ファイルパス
+    weights : dict of {str: float}
+        作業単位ごとの所要時間(s)
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w', encoding='UTF-8') as f:
+        json.dump(weights, f)
+    os.replace(tmppath, path)
@@ -0,0 +1,223 @@
+import re
+import time
+import threading
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+# rsync --info=progress2 の進捗行
+# 例)       1,238,099  10%  102.09MB/s    0:00:00 (xfr#1, to-chk=97/99)
+PROGRESS_PATTERN = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kMGT]?B)/s\s+(\d+):(\d+):(\d+)'
+                              r'(?:\s+\(xfr#(\d+), (?:ir|to)-chk=(\d+)/(\d+)\))?\s*$')
+# rsync --info=stats2 の集計行
+STATS_PATTERNS = {'files': re.compile(r'^Number of regular files transferred: ([\d,]+)'),
+                  'bytes': re.compile(r'^Total transferred file size: ([\d,]+) bytes')}
+# backup.py が出力し app.py が読み取る集計行
+METRICS_PREFIX = 'rsync metrics:'
+METRICS_PATTERN = re.compile(re.escape(METRICS_PREFIX) + r'((?: \w+=[\d.]+)+)')
+RATE_UNITS = {'B': 1, 'kB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+def parse_progress(line):
+    """
+    進捗行をパースする
+
+    Parameters
+    ----------
+    line : str
+        rsyncの出力1行
+
+    Returns
+    -------
+    dict or None
+        転送バイト数(bytes)、進捗率(percent)、転送速度(rate: B/s)、残り時間(eta: s)、転送ファイル数(files)
+    """
+    m = PROGRESS_PATTERN.match(line)
+    if m is None:
+        return None
+    percent = int(m.group(2))
+    progress = {'bytes': int(m.group(1).replace(',', '')),
+                'percent': percent,
+                'rate': float(m.group(3)) * RATE_UNITS[m.group(4)],
+                # 完了時は経過時間が出るので残り時間は0とする
+                'eta': 0 if percent >= 100 else int(m.group(5))*3600 + int(m.group(6))*60 + int(m.group(7))}
+    if m.group(8) is not None:
+        progress['files'] = int(m.group(8))
+    return progress
+
+def parse_stats(line):
+    """
+    集計行をパースする
+
+    Parameters
+    ----------
+    line : str
+        rsyncの出力1行
+
+    Returns
+    -------
+    tuple of (str, int) or None
+        項目名(files, bytes)と値
+    """
+    for key, pattern in STATS_PATTERNS.items():
+        m = pattern.match(line.strip())
+        if m is not None:
+            return key, int(m.group(1).replace(',', ''))
+    return None
+
+def parse_metrics(line):
+    """
+    backup.py が出力した集計行をパースする
+
+    Parameters
+    ----------
+    line : str
+        出力1行
+
+    Returns
+    -------
+    dict or None
+    """
+    m = METRICS_PATTERN.search(line)
+    if m is None:
+        return None
+    metrics = {}
+    for item in m.group(1).split():
+        key, value = item.split('=')
+        metrics[key] = float(value) if '.' in value else int(value)
+    return metrics
+
+class RsyncProgress:
+    """
+    rsyncの出力から進捗を集計するクラス
+
+    分割実行時は作業単位ごとの進捗を合算する。
+    集計行は interval 秒に1回だけログに出す。
+
+    Attributes
+    ----------
+    interval : float, default 5.0
+        集計行をログに出す間隔(s)
+    """
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._units = {}
+        self._logged_at = 0.0
+
+    def handler(self, unit=''):
+        """
+        Process に渡す行ハンドラを作成する
+
+        Parameters
+        ----------
+        unit : str, default ''
+            作業単位名
+
+        Returns
+        -------
+        function
+            行を受け取り、進捗行ならTrue(ログに出さない)を返す関数
+        """
+        def handle(line):
+            return self.update(unit, line)
+        return handle
+
+    def update(self, unit, line):
+        """
+        1行を反映する
+
+        Parameters
+        ----------
+        unit : str
+            作業単位名
+        line : str
+            rsyncの出力1行
+
+        Returns
+        -------
+        bool
+            進捗行だったか？
+        """
+        progress = parse_progress(line)
+        if progress is None:
+            stats = parse_stats(line)
+            if stats is not None:
+                with self._lock:
+                    self._units.setdefault(unit, {})[stats[0]] = stats[1]
+            return False
+        with self._lock:
+            self._units.setdefault(unit, {}).update(progress)
+            log_now = time.monotonic() - self._logged_at >= self.interval
+            if log_now:
+                self._logged_at = time.monotonic()
+        if log_now:
+            self.log()
+        return True
+
+    def finish(self, unit=''):
+        """
+        作業単位の終了を反映する(速度と残り時間を0にする)
+
+        Parameters
+        ----------
+        unit : str, default ''
+            作業単位名
+        """
+        with self._lock:
+            state = self._units.setdefault(unit, {})
+            state['rate'] = 0.0
+            state['eta'] = 0
+            state['percent'] = 100
+
+    def snapshot(self):
+        """
+        全作業単位を合算した進捗を取得する
+
+        Returns
+        -------
+        dict
+            bytes, files, rate, eta, percent
+        """
+        with self._lock:
+            units = [dict(state) for state in self._units.values()]
+        total_bytes = sum(state.get('bytes', 0) for state in units)
+        # 進捗率から各単位の総量を見積もって全体の進捗率にする
+        estimated = sum(state.get('bytes', 0) * 100 / state['percent'] if state.get('percent') else 0 for state in units)
+        return {'bytes': total_bytes,
+                'files': sum(state.get('files', 0) for state in units),
+                'rate': round(sum(state.get('rate', 0.0) for state in units), 1),
+                'eta': max([state.get('eta', 0) for state in units], default=0),
+                'percent': int(total_bytes * 100 / estimated) if estimated > 0 else 0}
+
+    def log(self):
+        """
+        集計行をログに出す
+        """
+        metrics = self.snapshot()
+        logger.info('%s %s', METRICS_PREFIX, ' '.join('%s=%s' % (key, metrics[key]) for key in sorted(metrics)))
+
+class MetricsCollector:
+    """
+    backup.py の出力から集計行を拾ってジョブのメトリクスにするクラス
+
+    Attributes
+    ----------
+    metrics : dict
+        更新先のメトリクス(updated_at を含む)
+    on_update : function, default None
+        メトリクスを更新したときに呼ぶ関数
+    """
+
+    def __init__(self, metrics, on_update=None):
+        self.metrics = metrics
+        self.on_update = on_update
+
+    def __call__(self, line):
+        metrics = parse_metrics(line)
+        if metrics is not None:
+            metrics['updated_at'] = datetime.datetime.now().isoformat()
+            self.metrics.update(metrics)
+            if self.on_update is not None:
+                self.on_update()
+        return False
@@ -0,0 +1,260 @@
+import time
+import bisect
+import itertools
+import threading
+from collections import Counter
+import logging
+logger = logging.getLogger(__name__)
+
+class Scheduler:
+    """
+    デバイスごとの同時実行数を守りながら、優先度の高いジョブから実行させるスケジューラ
+
+    ジョブは source, dest の物理デバイスの集合を持ち、全てのデバイスに空きがあれば実行できる。
+    待っているジョブは優先度(同じなら到着順)に見て、実行できないジョブのデバイスは
+    後続の優先度の低いジョブに使わせない(追い越されて待ち続けることがない)。
+    別々のディスクを使うジョブは並列に実行される。
+    Ticket.enqueue で acquire より前に順番だけ取っておくこともできる(バッチを計画した順に実行させる)。
+
+    Attributes
+    ----------
+    _running : collections.Counter
+        デバイスごとの実行中ジョブ数
+    _waiting : list of Ticket
+        実行を待っているジョブ(優先度順)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = Counter()
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def ticket(self, key, devices, priority=0, limit=1, lock=None, device_lock=None):
+        """
+        ジョブの実行権を作成する
+
+        Parameters
+        ----------
+        key : str
+            ジョブのキー(セクション名)
+        devices : iterable of str
+            ジョブが使う物理デバイス
+        priority : int, default 0
+            優先度(大きいほど先)
+        limit : int, default 1
+            デバイスごとの同時実行数の上限
+        lock : joblock.ResourceLock, default None
+            実行権を待つ前に取るロック
+        device_lock : joblock.ResourceLock, default None
+            実行権を得た後に取るロック
+
+        Returns
+        -------
+        ticket : Ticket
+        """
+        return Ticket(self, key, devices, priority, limit, lock, device_lock)
+
+    def _dispatch(self):
+        """
+        待っているジョブのうち実行できるものに実行権を渡す(ロックの中で呼ぶ)
+
+        予約しただけ(まだ acquire していない)のジョブのデバイスは、同じキーのジョブには使わせる
+        (そのジョブがキーのロックを持っているので、待たせると互いに待ち続ける)。
+        """
+        # デバイスと、予約しているジョブのキー(実行できずに待っているジョブは None)
+        reserved = {}
+        for ticket in list(self._waiting):
+            if not ticket._ready:
+                for dev in ticket.devices:
+                    reserved.setdefault(dev, set()).add(ticket.key)
+            elif (all(reserved.get(dev, set()) <= {ticket.key} for dev in ticket.devices)
+                    and all(self._running[dev] < ticket.limit for dev in ticket.devices)):
+                self._waiting.remove(ticket)
+                self._running.update(ticket.devices)
+                ticket._granted.set()
+            else:
+                for dev in ticket.devices:
+                    reserved.setdefault(dev, set()).add(None)
+
+    def _enqueue(self, ticket):
+        """
+        実行待ちの順番だけを取る
+        """
+        with self._lock:
+            if ticket not in self._waiting:
+                bisect.insort(self._waiting, ticket)
+
+    def _cancel(self, ticket):
+        """
+        予約を取り消す
+        """
+        with self._lock:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self._dispatch()
+
+    def _wait(self, ticket, timeout):
+        """
+        実行権を待つ
+
+        Returns
+        -------
+        bool
+            得られたか？
+        """
+        with self._lock:
+            ticket._ready = True
+            if ticket not in self._waiting:
+                bisect.insort(self._waiting, ticket)
+            self._dispatch()
+        if not ticket._granted.wait(timeout):
+            with self._lock:
+                # 諦める前に渡されていたら受け取る
+                if not ticket._granted.is_set():
+                    self._waiting.remove(ticket)
+                    self._dispatch()
+                    return False
+        return True
+
+    def _done(self, ticket):
+        with self._lock:
+            self._running.subtract(ticket.devices)
+            self._running += Counter()
+            self._dispatch()
+
+    def status(self):
+        """
+        デバイスごとの実行数と待っているジョブを取得する
+
+        Returns
+        -------
+        dict of {running: dict of {str: int}, waiting: list of str}
+        """
+        with self._lock:
+            return {'running': dict(self._running), 'waiting': [ticket.key for ticket in self._waiting]}
+
+class Ticket:
+    """
+    Scheduler の実行権(joblock.ResourceLock と同じように acquire, release する)
+
+    Attributes
+    ----------
+    key : str
+        ジョブのキー
+    devices : frozenset of str
+        ジョブが使う物理デバイス
+    priority : int
+        優先度
+    limit : int
+        デバイスごとの同時実行数の上限
+    lock : joblock.ResourceLock
+        実行権を待つ前に取るロック
+    device_lock : joblock.ResourceLock
+        実行権を得た後に取るロック
+    """
+
+    def __init__(self, scheduler, key, devices, priority=0, limit=1, lock=None, device_lock=None):
+        self.scheduler = scheduler
+        self.key = key
+        self.devices = frozenset(devices)
+        self.priority = priority
+        self.limit = max(1, limit)
+        self.lock = lock
+        self.device_lock = device_lock
+        self._order = (-priority, next(scheduler._seq))
+        self._ready = False
+        self._granted = threading.Event()
+        self._locks = []
+
+    def __lt__(self, other):
+        return self._order < other._order
+
+    @property
+    def locked(self):
+        return self._granted.is_set()
+
+    def enqueue(self):
+        """
+        acquire する前に実行待ちの順番だけを取る
+
+        別スレッドで acquire するジョブを、作成した順に実行させたいときに使う。
+        予約したデバイスは後続のジョブに使わせない。
+        """
+        self.scheduler._enqueue(self)
+
+    def cancel(self):
+        """
+        acquire せずに終わるときに、enqueue で取った順番を返す(取っていなければ何もしない)
+        """
+        self.scheduler._cancel(self)
+
+    def acquire(self, timeout=None):
+        """
+        ロック、実行権、デバイスのロックの順に取る
+
+        Parameters
+        ----------
+        timeout : float, default None
+            待つ時間の上限(s)。None は無制限
+
+        Returns
+        -------
+        bool
+            取れたか？
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        try:
+            if self.lock is not None:
+                if not self.lock.acquire(timeout):
+                    self.scheduler._cancel(self)
+                    return False
+                self._locks.append(self.lock)
+            if not self.scheduler._wait(self, remaining()):
+                self._release_locks()
+                return False
+            if self.device_lock is not None:
+                if not self.device_lock.acquire(remaining()):
+                    self._granted.clear()
+                    self.scheduler._done(self)
+                    self._release_locks()
+                    return False
+                self._locks.append(self.device_lock)
+            return True
+        except BaseException:
+            # ロックが例外を出しても、予約したデバイスで後続のジョブを待たせ続けない
+            self.scheduler._cancel(self)
+            # 待ちから外れた後は渡されないので、渡されていれば返す
+            if self._granted.is_set():
+                self._granted.clear()
+                self.scheduler._done(self)
+            self._release_locks()
+            raise
+
+    def _release_locks(self):
+        while len(self._locks) > 0:
+            self._locks.pop().release()
+
+    def release(self):
+        """
+        実行権とロックを解放する
+        """
+        if not self._granted.is_set():
+            return
+        self._granted.clear()
+        if self.device_lock in self._locks:
+            self._locks.remove(self.device_lock)
+            self.device_lock.release()
+        self.scheduler._done(self)
+        self._release_locks()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -1,5 +1,7 @@
 import os
 import sys
+import fcntl
+import threading
 import argparse
 import configparser
 import datetime
@@ -8,6 +10,49 @@ import logging
 import logging.handlers
 logger = logging.getLogger(__name__)
 
+import logutil
+
+class ConfigCache:
+    """
+    パース済みの config.ini を保持し、更新されたときだけ読み直すクラス
+
+    常駐するワーカーがジョブごとに config.ini をパースしないようにする。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._configs = {}
+
+    def get(self, path):
+        """
+        config.iniのパース結果を取得する
+
+        Parameters
+        ----------
+        path : str
+            config.iniのパス
+
+        Returns
+        -------
+        config : configparser.ConfigParser or None
+            読み込めなければNone
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        # export_config は os.replace で書き換えるので inode が変わる
+        # (mtime の粒度が粗いファイルシステムでは mtime だけでは更新を見逃す)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._configs.get(path)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            config = configparser.ConfigParser()
+            config.read(path, 'UTF-8')
+            self._configs[path] = (key, config)
+            return config
+
 class Settings:
     """
     設定を保持するクラス
@@ -30,21 +75,63 @@ class Settings:
         バックアップ先パス
     CPDEST : str
         世代コピー先パス
+    MOUNTS : list of str, default []
+        source, dest の他に必要なマウントポイント
     KEEP_COUNT : int, default 0
         世代コピーを作成する数
+    KEEP_DAILY : int or None, default None
+        日次で残す世代数(None は KEEP_COUNT と同じ)
+    KEEP_WEEKLY : int, default 0
+        週次(各週の最新)で残す世代数
+    KEEP_MONTHLY : int, default 0
+        月次(各月の最新)で残す世代数
+    SNAPSHOT : str, default copy
+        世代コピーの作成方式(copy: cp による複製, hardlink: ハードリンクによる複製)
+    RM_WORKERS : int, default 4
+        過去世代を削除するスレッド数
+    RM_BACKGROUND : bool, default False
+        過去世代をバックグラウンドで削除するか？
+    RSYNC_WORKERS : int, default 1
+        rsyncの並列数(2以上でバックアップ元を分割して実行する)
+    ARCHIVE_AFTER : int, default 0
+        新しい順にこの数より古い世代を圧縮アーカイブにする(0は変換しない)
+    ARCHIVE_COMPRESSION : str, default gzip
+        アーカイブの圧縮方式(gzip, xz)
+    ARCHIVE_WORKERS : int, default 2
+        アーカイブの圧縮スレッド数
+    WATCH : bool, default False
+        変更ジャーナルに記録されたパスだけをrsyncするか？
+    MANIFEST : bool, default True
+        世代ごとのマニフェストを記録するか？
+    MANIFEST_HASH : bool, default False
+        マニフェストにファイルのハッシュを含めるか？
+    LOCK_KEY : str, default device
+        同時実行を防ぐ単位(device: バックアップ先のマウントポイント, section: セクション)
+    NO_LOCK : bool, default False
+        ロックを取らないか？(app.py から実行されたとき)
+    NO_MOUNT : bool, default False
+        マウントを確認しないか？(app.py が確認済みのとき)
+    VERIFY : bool, default False
+        バックアップせずに世代の検証だけを行うか？
+    VERIFY_WORKERS : int, default 2
+        検証のハッシュ計算スレッド数
+    VERIFY_MAX_AGE : int, default 30
+        検証済みで変更のないファイルを再検証するまでの日数
     DATE_CURRENT : str, default datetime.date.today().strftime('%Y%m%d')
         実行日付(YYYYmmdd)
     DATE_LAST : str
         前回実行日付(YYYYmmdd)
     LOG : str
         ログファイルのパス
+    STATE_DIR : str
+        実行状態を保存するディレクトリのパス
     LOG_LEVEL : int, default logging.INFO
         ログのレベル
     LOG_FORMATTER : str, default [%(levelname)s] %(asctime)s : %(name)s(%(lineno)s) %(message)s
         ログのフォーマット
     """
 
-    def __init__(self, args=sys.argv[1:]):
+    def __init__(self, args=sys.argv[1:], config_cache=None):
         # 初期化
         self._INIDIR = '/mnt/backup'
         self._INIPATH = './config.ini'
@@ -56,15 +143,37 @@ class Settings:
         self.SOURCE = ''
         self.DEST = ''
         self.CPDEST = ''
+        self.MOUNTS = []
         self.KEEP_COUNT = 0
+        self.KEEP_DAILY = None
+        self.KEEP_WEEKLY = 0
+        self.KEEP_MONTHLY = 0
+        self.SNAPSHOT = 'copy'
+        self.RM_WORKERS = 4
+        self.RM_BACKGROUND = False
+        self.RSYNC_WORKERS = 1
+        self.ARCHIVE_AFTER = 0
+        self.ARCHIVE_COMPRESSION = 'gzip'
+        self.ARCHIVE_WORKERS = 2
+        self.WATCH = False
+        self.MANIFEST = True
+        self.MANIFEST_HASH = False
+        self.LOCK_KEY = 'device'
+        self.NO_LOCK = False
+        self.NO_MOUNT = False
+        self.VERIFY = False
+        self.VERIFY_WORKERS = 2
+        self.VERIFY_MAX_AGE = 30
         self.DATE_CURRENT = datetime.date.today().strftime('%Y%m%d')
         self.DATE_LAST = ''
         self.LOG = ''
+        self.STATE_DIR = ''
         self.LOG_LEVEL = logging.INFO
         self.LOG_FORMAT = '[%(levelname)s] %(asctime)s : %(name)s(%(lineno)s) %(message)s'
 
         # log設定
         logging.basicConfig(level=logging.INFO, format=self.LOG_FORMAT)
+        logutil.set_logger_format(logging.getLogger().handlers, self.LOG_FORMAT)
 
         # コマンド引数をパース
         options = self._parse_args(args)
@@ -73,10 +182,13 @@ class Settings:
         self.USER = options.USER
         self.TARGET = options.TARGET
         self.PASS_CP = options.PASS_CP
+        self.VERIFY = options.VERIFY
+        self.NO_LOCK = options.NO_LOCK
+        self.NO_MOUNT = options.NO_MOUNT
         self.SECTION = self.USER + '_' + self.TARGET
 
-        # config.ini読み込み
-        self.CONFIG = self._load_config()
+        # config.ini読み込み(キャッシュがあればパース済みのものを使う)
+        self.CONFIG = self._load_config(config_cache)
 
         # config.iniの内容をインスタンス変数に入れる
         self._set_config_values_to_instance()
@@ -87,10 +199,13 @@ class Settings:
         # LOGの値をセット
         self.LOG = self._generate_logpath()
 
+        # STATE_DIRの値をセット
+        self.STATE_DIR = Settings.create_statedir(self.DEST)
+
         # ファイルハンドラを追加
         filehandler = logging.FileHandler(self.LOG, mode='a', encoding='UTF-8')
         filehandler.setLevel(self.LOG_LEVEL)
-        filehandler.setFormatter(logging.Formatter(fmt=self.LOG_FORMAT))
+        filehandler.setFormatter(logutil.RawAwareFormatter(fmt=self.LOG_FORMAT))
         logging.getLogger().addHandler(filehandler)
 
         # ログに内容を吐き出し
@@ -124,6 +239,23 @@ class Settings:
         result = result + '/'
         return result
 
+    @staticmethod
+    def create_statedir(dest):
+        """
+        実行状態を保存するディレクトリパスを作成
+
+        Parameters
+        ----------
+        dest : str
+            バックアップ先パス
+
+        Returns
+        -------
+        path : str
+            ディレクトリパス
+        """
+        return str(Path(Path(dest).parent, '.state'))
+
     def _parse_args(self, args):
         """
         コマンド引数をインスタンス変数にパース
@@ -144,16 +276,27 @@ class Settings:
         parser.add_argument('--user', dest='USER', type=str, required=True)
         parser.add_argument('--target', dest='TARGET', type=str, required=True)
         parser.add_argument('--pass_cp', dest='PASS_CP', action='store_true')
+        parser.add_argument('--verify', dest='VERIFY', action='store_true')
+        parser.add_argument('--no_lock', dest='NO_LOCK', action='store_true')
+        parser.add_argument('--no_mount', dest='NO_MOUNT', action='store_true')
         options = parser.parse_args(args)
         return options
 
-    def _load_config(self):
+    def _load_config(self, config_cache=None):
         """
         config.iniを読み込む
+
+        Parameters
+        ----------
+        config_cache : ConfigCache, default None
+            パース済みのconfigのキャッシュ
         """
-        config = configparser.ConfigParser()
-        config.read(self.INIPATH, 'UTF-8')
-        if len(config) == 0:
+        if config_cache is None:
+            config = configparser.ConfigParser()
+            config.read(self.INIPATH, 'UTF-8')
+        else:
+            config = config_cache.get(self.INIPATH)
+        if config is None or len(config) == 0:
             logger.error('Failed to load config.ini. Maybe cannot find config.ini.')
             sys.exit(1)
         return config
@@ -165,27 +308,106 @@ class Settings:
         config_filtered = self.CONFIG[self.SECTION]
         self.SOURCE = config_filtered['source']
         self.DEST = config_filtered['dest']
+        self.MOUNTS = self.parse_mounts(config_filtered.get('mounts', ''))
         self.KEEP_COUNT = int(config_filtered['keep_count'])
+        self.KEEP_DAILY = config_filtered.getint('keep_daily', self.KEEP_DAILY)
+        self.KEEP_WEEKLY = config_filtered.getint('keep_weekly', self.KEEP_WEEKLY)
+        self.KEEP_MONTHLY = config_filtered.getint('keep_monthly', self.KEEP_MONTHLY)
         self.DATE_LAST = config_filtered['date_last']
+        self.SNAPSHOT = config_filtered.get('snapshot', self.SNAPSHOT)
+        if self.SNAPSHOT not in ('copy', 'hardlink'):
+            logger.error('snapshot must be copy or hardlink: %s', self.SNAPSHOT)
+            sys.exit(1)
+        self.RM_WORKERS = config_filtered.getint('rm_workers', self.RM_WORKERS)
+        self.RM_BACKGROUND = config_filtered.getboolean('rm_background', self.RM_BACKGROUND)
+        self.RSYNC_WORKERS = config_filtered.getint('rsync_workers', self.RSYNC_WORKERS)
+        self.ARCHIVE_AFTER = config_filtered.getint('archive_after', self.ARCHIVE_AFTER)
+        self.ARCHIVE_COMPRESSION = config_filtered.get('archive_compression', self.ARCHIVE_COMPRESSION)
+        if self.ARCHIVE_COMPRESSION not in ('gzip', 'xz'):
+            logger.error('archive_compression must be gzip or xz: %s', self.ARCHIVE_COMPRESSION)
+            sys.exit(1)
+        self.ARCHIVE_WORKERS = config_filtered.getint('archive_workers', self.ARCHIVE_WORKERS)
+        self.WATCH = config_filtered.getboolean('watch', self.WATCH)
+        self.MANIFEST = config_filtered.getboolean('manifest', self.MANIFEST)
+        self.MANIFEST_HASH = config_filtered.getboolean('manifest_hash', self.MANIFEST_HASH)
+        self.LOCK_KEY = config_filtered.get('lock_key', self.LOCK_KEY)
+        if self.LOCK_KEY not in ('device', 'section'):
+            logger.error('lock_key must be device or section: %s', self.LOCK_KEY)
+            sys.exit(1)
+        self.VERIFY_WORKERS = config_filtered.getint('verify_workers', self.VERIFY_WORKERS)
+        self.VERIFY_MAX_AGE = config_filtered.getint('verify_max_age', self.VERIFY_MAX_AGE)
 
     def _generate_logpath(self):
         """
         LOGパスを作成
         """
-        log_basename = self.TARGET + '_' + self.DATE_CURRENT + '.log'
-        logpath = str(Path(Path(self.DEST).parent, 'log', log_basename))
-        return logpath
+        return self.create_logpath(self.DEST, self.TARGET, self.DATE_CURRENT)
+
+    @staticmethod
+    def parse_mounts(value):
+        """
+        mounts(カンマ区切り)をパースする
+
+        Parameters
+        ----------
+        value : str
+            config.ini の mounts
+
+        Returns
+        -------
+        mounts : list of str
+            マウントポイント
+        """
+        return [mp.strip() for mp in value.split(',') if len(mp.strip()) > 0]
+
+    @staticmethod
+    def create_logpath(dest, target, date):
+        """
+        LOGパスを作成
+
+        Parameters
+        ----------
+        dest : str
+            バックアップ先パス
+        target : str
+            対象区分
+        date : str
+            実行日付(YYYYMMDD)
+
+        Returns
+        -------
+        path : str
+            LOGパス
+        """
+        return str(Path(Path(dest).parent, 'log', target + '_' + date + '.log'))
 
     def export_config(self):
         """
         configを更新してiniファイルにエクスポートする
         """
-        # 実行日付を前回日付に格納
-        self.CONFIG.set(self.SECTION, 'date_last', self.DATE_CURRENT)
         logging.info('Section %s, date_last is %s', self.SECTION, self.DATE_CURRENT)
-        # config.iniにエクスポート
+        # 他のジョブの更新を消さないよう、ロックを取って読み直してから書き換える
         try:
-            self.CONFIG.write(open(self.INIPATH, 'w'))
+            with open(self.INIPATH + '.lock', 'w') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                config = configparser.ConfigParser()
+                config.read(self.INIPATH, 'UTF-8')
+                # 実行日付を前回日付に格納
+                config.set(self.SECTION, 'date_last', self.DATE_CURRENT)
+                tmppath = self.INIPATH + '.tmp'
+                with open(tmppath, 'w') as f:
+                    config.write(f)
+                os.replace(tmppath, self.INIPATH)
         except Exception as e:
             logger.error('Could not write to config.ini: %s', e)
-            sys.exit(1)
\ No newline at end of file
+            sys.exit(1)
+
+    def close(self):
+        """
+        追加したファイルハンドラを外す(同じプロセスで続けて実行するとき用)
+        """
+        logpath = os.path.abspath(self.LOG)
+        for handler in list(logging.getLogger().handlers):
+            if isinstance(handler, logging.FileHandler) and handler.baseFilename == logpath:
+                logging.getLogger().removeHandler(handler)
+                handler.close()
\ No newline at end of file
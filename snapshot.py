@@ -0,0 +1,35 @@
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+def rotate(dest, cpdest):
+    """
+    最新ディレクトリを世代ディレクトリに改名し、空の最新ディレクトリを作る
+
+    最新ディレクトリへは rsync --link-dest=<世代ディレクトリ> で同期し、変更のないファイルだけを
+    ハードリンクで共有する(変更されたファイルは権限だけの変更でも別の inode になり、過去世代は変わらない)。
+    改名済みで最新ディレクトリが無いか空なら、改名せずに続きから行う(再実行しても壊れない)。
+
+    Parameters
+    ----------
+    dest : str
+        最新ディレクトリパス
+    cpdest : str
+        世代ディレクトリパス(dest と同一ファイルシステム上)
+
+    Returns
+    -------
+    bool
+        改名したか？
+    """
+    dest = dest.rstrip('/')
+    cpdest = cpdest.rstrip('/')
+    if os.path.isdir(cpdest) and (not os.path.exists(dest) or len(os.listdir(dest)) == 0):
+        logger.info('%s is already rotated to %s', dest, cpdest)
+        os.makedirs(dest, exist_ok=True)
+        return False
+    if os.path.exists(cpdest):
+        raise FileExistsError('generation directory already exists: %s' % cpdest)
+    os.rename(dest, cpdest)
+    os.makedirs(dest)
+    return True
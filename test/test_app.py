@@ -1,10 +1,15 @@
 import pytest
 from subprocess import Popen, PIPE, STDOUT
 import os
+import sys
+import json
+import time
+import threading
 from pathlib import Path
 
 from app import *
-from process import Process
+import psutil
+from process import Process, AttachedProcess
 from processpool import ProcessPool
 
 @pytest.fixture(autouse=True, scope='module')
@@ -14,6 +19,12 @@ def clear_log():
     if os.path.exists(logpath):
         os.remove(logpath)
 
+@pytest.fixture(autouse=True)
+def job_log_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'jobs'
+    monkeypatch.setattr(sys.modules['app'], 'JOB_LOG_DIR', str(path))
+    return path
+
 @pytest.fixture()
 def pool():
     return ProcessPool()
@@ -48,16 +59,16 @@ def context_get_status(request, pool, proc):
     sections = {ProcessPool.ERROR: [], ProcessPool.FINISHED: [], ProcessPool.RUNNING: [], ProcessPool.PENDING: []}
     if len(request.param) > 0:
         if 'e' in request.param:
-            pool.map[ProcessPool.ERROR].append(proc)
+            pool.register(proc, ProcessPool.ERROR)
             sections[ProcessPool.ERROR].append({'name': 'foo_bar'})
         if 'f' in request.param:
-            pool.map[ProcessPool.FINISHED].append(proc)
+            pool.register(proc, ProcessPool.FINISHED)
             sections[ProcessPool.FINISHED].append({'name': 'foo_bar'})
         if 'r' in request.param:
-            pool.map[ProcessPool.RUNNING].append(proc)
+            pool.register(proc, ProcessPool.RUNNING)
             sections[ProcessPool.RUNNING].append({'name': 'foo_bar'})
         if 'p' in request.param:
-            pool.map[ProcessPool.PENDING].append(proc)
+            pool.register(proc, ProcessPool.PENDING)
             sections[ProcessPool.PENDING].append({'name': 'foo_bar'})
 
     yield (pool, sections)
@@ -72,4 +83,309 @@ def test_get_status(context_get_status, monkeypatch):
     (['false'], 1)
 ], ids=['True - 0', 'False - 1'])
 def test_exec_backup(cmd, result, pool):
-    assert exec_backup(cmd, pool) == result
\ No newline at end of file
+    assert exec_backup(cmd, pool) == result
+
+def test_exec_backup_wait_lock(pool, tmp_path):
+    held = joblock.ResourceLock('foo_bar', str(tmp_path))
+    held.acquire()
+    # 他のジョブが終わったら実行される
+    timer = threading.Timer(0.3, held.release)
+    timer.start()
+    start = time.monotonic()
+    assert exec_backup(['true'], pool, joblock.ResourceLock('foo_bar', str(tmp_path))) == 0
+    assert time.monotonic() - start >= 0.3
+    assert len(pool.get_section(lambda p: p.cmd[0])[ProcessPool.FINISHED]) == 1
+
+def test_reconcile_jobs(pool, monkeypatch, tmp_path):
+    # ホストの config.ini とロックディレクトリを使わない
+    monkeypatch.setattr(joblock, 'LOCK_DIR', str(tmp_path))
+    monkeypatch.setattr(sys.modules['app'], 'load_config', configparser.ConfigParser)
+    cmd = ['python3', 'backup.py', '--user', 'foo', '--target', 'bar']
+    child = Popen(['sleep', '0.3'])
+    alive = AttachedProcess(cmd, child.pid, psutil.Process(child.pid).create_time())
+    dead = AttachedProcess(cmd, None, None)
+    pool.register(alive, ProcessPool.RUNNING)
+    pool.register(dead, ProcessPool.PENDING)
+    threads = reconcile_jobs(pool, [alive, dead])
+    # 動いていないものはすぐエラーになる
+    assert pool.get(dead.job_id)['state'] == ProcessPool.ERROR
+    assert pool.get(alive.job_id)['state'] == ProcessPool.RUNNING
+    child.wait()
+    for thread in threads:
+        thread.join(5)
+    assert pool.get(alive.job_id)['state'] == ProcessPool.ERROR
+
+def test_submit_job(pool, monkeypatch, tmp_path):
+    # ホストの config.ini とロックディレクトリを使わない
+    monkeypatch.setattr(joblock, 'LOCK_DIR', str(tmp_path))
+    monkeypatch.setattr(sys.modules['app'], 'load_config', configparser.ConfigParser)
+    held = joblock.ResourceLock('foo_bar', str(tmp_path))
+    held.acquire()
+    try:
+        job_id, how = submit_job(['true'], 'foo_bar', pool)
+        assert how == Coalescer.SUBMITTED
+        # 実行待ちのジョブにまとめられる
+        assert submit_job(['true'], 'foo_bar', pool) == (job_id, Coalescer.ATTACHED)
+        assert pool.get(job_id)['state'] == ProcessPool.PENDING
+    finally:
+        held.release()
+    assert pool.wait(job_id, 5)['state'] == ProcessPool.FINISHED
+    assert len(pool.get_section(lambda p: p.cmd[0])[ProcessPool.FINISHED]) == 1
+
+@pytest.fixture()
+def job_scheduler(monkeypatch, tmp_path):
+    monkeypatch.setattr(joblock, 'LOCK_DIR', str(tmp_path))
+    monkeypatch.setattr(sys.modules['app'], 'load_config', configparser.ConfigParser)
+    job_scheduler = Scheduler()
+    monkeypatch.setattr(sys.modules['app'], 'scheduler', job_scheduler)
+    return job_scheduler
+
+def test_submit_job_create_error(pool, monkeypatch, job_scheduler):
+    # ジョブを作れなければ取った順番を返す
+    def broken_create_job(cmd, pool, lock=None):
+        raise RuntimeError('broken')
+    monkeypatch.setattr(sys.modules['app'], 'create_job', broken_create_job)
+    with pytest.raises(RuntimeError):
+        submit_job(['true'], 'cancel_bar', pool, enqueue=True)
+    assert job_scheduler.status()['waiting'] == []
+
+def test_submit_job_thread_error(pool, monkeypatch, job_scheduler):
+    # 実行権を取る前にスレッドが終わっても順番を返す
+    def broken_run_job(proc, pool, on_start=None):
+        raise RuntimeError('broken')
+    monkeypatch.setattr(sys.modules['app'], 'run_job', broken_run_job)
+    job_id, _ = submit_job(['true'], 'cancel_bar', pool, enqueue=True)
+    assert pool.wait(job_id, 5)['state'] == ProcessPool.ERROR
+    deadline = time.monotonic() + 5
+    while job_scheduler.status()['waiting'] != [] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job_scheduler.status()['waiting'] == []
+
+@pytest.fixture()
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys.modules['app'], 'ppool', ProcessPool(), raising=False)
+    monkeypatch.setattr(sys.modules['app'], 'coalescer', Coalescer())
+    return app.test_client()
+
+def test_post_backup(client, monkeypatch):
+    monkeypatch.setattr(sys.modules['app'], 'submit_job',
+                        lambda cmd, section, pool: (create_job(['true'] + cmd[2:], pool).job_id, Coalescer.SUBMITTED))
+    res = client.post('/api/foo/bar')
+    # 登録したらすぐに返る
+    assert res.status_code == 202
+    job_id = res.get_json()['job_id']
+    assert client.get('/api/jobs/%d' % job_id).get_json()['state'] == ProcessPool.PENDING
+    assert client.get('/api/jobs/%d?wait=0.1' % job_id).get_json()['state'] == ProcessPool.PENDING
+    assert client.get('/api/jobs/999').status_code == 404
+
+    # 別スレッドで実行すると wait で終了まで待てる
+    pool = sys.modules['app'].ppool
+    threading.Thread(target=run_job, args=(pool.get(job_id)['proc'], pool)).start()
+    status = client.get('/api/jobs/%d?wait=5' % job_id).get_json()
+    assert status['state'] == ProcessPool.FINISHED
+    assert status['returncode'] == 0
+    assert status['name'] == 'foo_bar'
+
+def test_post_backup_blocking(client, monkeypatch):
+    def submit(cmd, section, pool):
+        proc = create_job(['false'] + cmd[2:], pool)
+        threading.Thread(target=run_job, args=(proc, pool)).start()
+        return proc.job_id, Coalescer.SUBMITTED
+
+    monkeypatch.setattr(sys.modules['app'], 'submit_job', submit)
+    res = client.post('/api/foo/bar?blocking=1')
+    assert res.status_code == 500
+    assert res.get_json()['message'] == 'failed...'
+
+def test_record_stats(monkeypatch):
+    stats = jobstats.JobStats()
+    monkeypatch.setattr(sys.modules['app'], 'job_stats', stats)
+    proc = Process(['python3', 'backup.py', '--user', 'foo', '--target', 'bar'])
+    proc._returncode = 0
+    proc.metrics['bytes'] = 100
+    record_stats(proc, 2.0, {'exec rsync': 1.5})
+    record_stats(Process(['true']), 1.0, {})
+    result = app.test_client().get('/api/stats').get_json()
+    assert list(result) == ['foo_bar']
+    assert result['foo_bar']['backup']['duration']['last'] == 2.0
+    assert result['foo_bar']['backup']['throughput']['last'] == 50.0
+    assert result['foo_bar']['backup']['last_success_at'] is not None
+
+def test_diff_sections():
+    kept, moved, touched, removed = ({'id': i} for i in range(4))
+    old = {ProcessPool.RUNNING: [kept, moved, touched], ProcessPool.PENDING: [removed]}
+    new = {ProcessPool.RUNNING: [kept, {'id': 2, 'metrics': {}}], ProcessPool.FINISHED: [moved]}
+    changed, gone = diff_sections(old, new)
+    assert changed == [{'id': 2, 'metrics': {}, 'state': ProcessPool.RUNNING}, {'id': 1, 'state': ProcessPool.FINISHED}]
+    assert gone == [3]
+
+def test_status_etag(client):
+    pool = sys.modules['app'].ppool
+    first = client.get('/api/status')
+    assert first.status_code == 200
+    assert set(first.get_json()) == {'error', 'finished', 'running', 'pending', 'journal'}
+    etag = first.headers['ETag']
+    # 変わっていなければ 304
+    assert client.get('/api/status', headers={'If-None-Match': etag}).status_code == 304
+    proc = Process(['python3', 'backup.py', '--user', 'foo', '--target', 'bar'])
+    pool.register(proc, ProcessPool.PENDING)
+    second = client.get('/api/status', headers={'If-None-Match': etag})
+    assert second.status_code == 200
+    assert second.get_json()[ProcessPool.PENDING][0]['name'] == 'foo_bar'
+
+def test_stream_status(pool):
+    proc = Process(['python3', 'backup.py', '--user', 'foo', '--target', 'bar'])
+    stream = stream_status(pool, keepalive=0.05)
+    first = next(stream)
+    assert first.startswith('event: snapshot\n')
+    # 変化がなければ keepalive
+    assert next(stream) == ': keepalive\n\n'
+    job_id = pool.register(proc, ProcessPool.PENDING)
+    event = next(stream)
+    assert event.startswith('event: update\n')
+    data = json.loads(event.split('data: ', 1)[1])
+    assert data['changed'][0]['id'] == job_id
+    assert data['changed'][0]['state'] == ProcessPool.PENDING
+    pool.clear_procs([ProcessPool.PENDING])
+    data = json.loads(next(stream).split('data: ', 1)[1])
+    assert data['removed'] == [job_id]
+
+def test_read_job_log(pool, tmp_path, job_log_dir):
+    proc = create_job(['python3', '-c', 'print("foo"); print("bar")'], pool)
+    assert read_job_log(proc, 0, 100) == (0, b'', False)
+    run_job(proc, pool)
+    # 終了したらバッファを手放してジョブごとの出力ファイルから読む
+    assert proc.log is None
+    assert proc.log_file == {'path': str(job_log_dir / ('%d.log' % proc.job_id)), 'start': 0, 'end': 8}
+    assert read_job_log(proc, 0, 100) == (0, b'foo\nbar\n', True)
+    assert read_job_log(proc, 4, 100) == (4, b'bar\n', True)
+    # 履歴から消えたジョブの出力ファイルは消す
+    pool.clear_procs([ProcessPool.FINISHED])
+    other = create_job(['true'], pool)
+    run_job(other, pool)
+    assert sorted(os.listdir(str(job_log_dir))) == ['%d.log' % other.job_id]
+
+    # バッファから捨てられたところはログファイルから読む
+    path = tmp_path / 'backup.log'
+    path.write_bytes(b'before\nfoo\nbar\n')
+    proc.log = logbuffer.LogBuffer()
+    proc.log.start = 4
+    proc.log.append('bar')
+    proc.log.close()
+    proc.log_file = {'path': str(path), 'start': 7, 'end': 15}
+    assert read_job_log(proc, 0, 100) == (0, b'foo\n', False)
+    assert read_job_log(proc, 4, 100) == (4, b'bar\n', True)
+
+    # バッファがなければログファイルから読む
+    proc.log = None
+    assert read_job_log(proc, 0, 100) == (0, b'foo\nbar\n', True)
+
+def test_job_log(client):
+    pool = sys.modules['app'].ppool
+    proc = create_job(['python3', '-c', 'print("foo"); print("bar")'], pool)
+    res = client.get('/api/jobs/%d/log' % proc.job_id)
+    assert res.status_code == 200
+    assert res.data == b''
+    assert res.headers['X-Log-Complete'] == 'false'
+
+    threading.Thread(target=run_job, args=(proc, pool)).start()
+    res = client.get('/api/jobs/%d/log/stream' % proc.job_id)
+    assert res.data == b'foo\nbar\n'
+    res = client.get('/api/jobs/%d/log?offset=4&limit=2' % proc.job_id)
+    assert res.data == b'ba'
+    assert res.headers['X-Log-Offset'] == '4'
+    assert res.headers['X-Log-Next-Offset'] == '6'
+    assert res.headers['X-Log-Complete'] == 'false'
+    res = client.get('/api/jobs/%d/log?offset=6' % proc.job_id)
+    assert res.data == b'r\n'
+    assert res.headers['X-Log-Complete'] == 'true'
+    assert client.get('/api/jobs/999/log').status_code == 404
+
+def test_prometheus_metrics(client, monkeypatch):
+    metrics = promexport.JobMetrics()
+    monkeypatch.setattr(sys.modules['app'], 'job_metrics', metrics)
+    pool = sys.modules['app'].ppool
+    metrics.track_pool(pool)
+    proc = create_job(['python3', '-c', 'print("%s")' % remover.format_removed('dirs', 2),
+                       '--user', 'foo', '--target', 'bar'], pool)
+    pending = client.get('/metrics')
+    assert pending.content_type == promexport.CONTENT_TYPE
+    assert 'backup_jobs{state="pending"} 1' in pending.get_data(as_text=True)
+
+    run_job(proc, pool)
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'backup_jobs{state="pending"} 0' in text
+    assert 'backup_jobs{state="finished"} 1' in text
+    assert 'backup_queue_wait_seconds_count{section="foo_bar"} 1' in text
+    assert 'backup_jobs_completed_total{section="foo_bar",kind="backup",result="success"} 1' in text
+    assert 'backup_retention_removed_total{section="foo_bar",kind="dirs"} 2' in text
+
+def test_post_batch(client, monkeypatch, tmp_path):
+    config = configparser.ConfigParser()
+    for section in ('foo_bar', 'foo_hoge_x', 'baz_bar'):
+        config[section] = {'source': str(tmp_path), 'dest': str(tmp_path / section)}
+    monkeypatch.setattr(sys.modules['app'], 'load_config', lambda: config)
+    stats = jobstats.JobStats()
+    stats.record({'section': 'foo_bar', 'kind': 'backup', 'finished_at': '2026-01-01T00:00:00',
+                  'duration': 10.0, 'returncode': 0, 'bytes': None, 'phases': {}})
+    monkeypatch.setattr(sys.modules['app'], 'job_stats', stats)
+    submitted = []
+
+    def submit(cmd, section, pool, enqueue=False):
+        assert enqueue
+        submitted.append((cmd[cmd.index('--user')+1], cmd[cmd.index('--target')+1]))
+        proc = create_job(['true'] + cmd[2:], pool)
+        threading.Thread(target=run_job, args=(proc, pool)).start()
+        return proc.job_id, Coalescer.SUBMITTED
+
+    monkeypatch.setattr(sys.modules['app'], 'submit_job', submit)
+    assert client.post('/api/batch', json={'sections': ['nothing']}).status_code == 400
+    assert client.post('/api/batch', json={'pattern': 'nothing_*'}).status_code == 400
+    assert client.post('/api/batch', json={'sections': 'foo_bar'}).status_code == 400
+
+    # _ が2つ以上あるセクション名はユーザーとターゲットに分けられない
+    res = client.post('/api/batch', json={'pattern': 'foo_*'})
+    assert res.status_code == 400
+    assert res.get_json()['ambiguous'] == ['foo_hoge_x']
+    assert submitted == []
+
+    res = client.post('/api/batch', json={'sections': ['foo_bar', {'user': 'foo', 'target': 'hoge_x'}]})
+    assert res.status_code == 202
+    body = res.get_json()
+    assert body['total'] == 2
+    assert sorted(submitted) == [('foo', 'bar'), ('foo', 'hoge_x')]
+    status = client.get('/api/batch/%d?wait=5' % body['batch_id']).get_json()
+    assert status['done']
+    assert status['counts'] == {ProcessPool.FINISHED: 2}
+    assert client.get('/api/batch/999').status_code == 404
+
+    res = client.post('/api/batch?blocking=1', json={'sections': ['baz_bar']})
+    assert res.status_code == 200
+    assert res.get_json()['counts'] == {ProcessPool.FINISHED: 1}
+
+def test_run_job_ensure_mounts(pool, monkeypatch):
+    config = configparser.ConfigParser()
+    config['foo_bar'] = {'source': '/mnt/data/foo/', 'dest': '/mnt/backup/foo/', 'mounts': '/mnt/a, /mnt/b'}
+    monkeypatch.setattr(sys.modules['app'], 'load_config', lambda: config)
+    calls = []
+    checker = mountutil.MountChecker()
+    monkeypatch.setattr(checker, 'ensure', lambda paths, extra=(): calls.append((paths, extra)) or 1)
+    monkeypatch.setattr(mountutil, 'checker', checker)
+    # サーバで確認するジョブだけ確認し、マウントできなければ実行しない
+    proc = create_job(['true', '--user', 'foo', '--target', 'bar', '--no_mount'], pool)
+    assert run_job(proc, pool) == 1
+    assert calls == [(['/mnt/data/foo/', '/mnt/backup/foo/'], ['/mnt/a', '/mnt/b'])]
+    assert pool.get(proc.job_id)['state'] == ProcessPool.ERROR
+    proc = create_job(['true', '--user', 'foo', '--target', 'bar'], pool)
+    assert run_job(proc, pool) == 0
+    assert len(calls) == 1
+    # 確認で例外が起きてもロックを返してエラーにする
+    def raise_error(paths, extra=()):
+        raise OSError('mount failed')
+    monkeypatch.setattr(checker, 'ensure', raise_error)
+    proc = create_job(['true', '--user', 'foo', '--target', 'bar', '--no_mount'], pool)
+    released = []
+    monkeypatch.setattr(proc, 'release_lock', lambda: released.append(proc.job_id))
+    assert run_job(proc, pool) == 1
+    assert released == [proc.job_id]
+    assert pool.get(proc.job_id)['state'] == ProcessPool.ERROR
@@ -0,0 +1,46 @@
+import pytest
+import io
+import os
+
+import archive
+from archive import create_pack, extract_member, archive_generation, pack_paths
+
+@pytest.fixture()
+def generation(tmp_path, monkeypatch):
+    # チャンク分割を確認するため小さくする
+    monkeypatch.setattr(archive, 'CHUNK_SIZE', 1024)
+    gen = tmp_path / 'hogehoge_20190101'
+    (gen / 'sub').mkdir(parents=True)
+    (gen / 'foo.txt').write_text('foo')
+    (gen / 'sub' / 'big.bin').write_bytes(os.urandom(5000))
+    (gen / 'empty').write_bytes(b'')
+    os.symlink('foo.txt', str(gen / 'link'))
+    return gen
+
+@pytest.mark.parametrize('compression, workers', [('gzip', 2), ('xz', 2), ('gzip', 0)])
+def test_create_and_extract(compression, workers, generation, tmp_path):
+    pack, index = str(tmp_path / 'test.pack'), str(tmp_path / 'test.pack.idx')
+    counts = create_pack(str(generation), pack, index, compression, workers=workers)
+    assert counts['members'] == 5
+    assert counts['bytes'] == 5003
+    for relpath in ['foo.txt', 'sub/big.bin', 'empty']:
+        out = io.BytesIO()
+        extract_member(pack, index, relpath, out)
+        assert out.getvalue() == (generation / relpath).read_bytes()
+
+def test_extract_not_found(generation, tmp_path):
+    pack, index = str(tmp_path / 'test.pack'), str(tmp_path / 'test.pack.idx')
+    create_pack(str(generation), pack, index)
+    with pytest.raises(FileNotFoundError):
+        extract_member(pack, index, 'not_exist', io.BytesIO())
+    with pytest.raises(IsADirectoryError):
+        extract_member(pack, index, 'sub', io.BytesIO())
+
+def test_archive_generation(generation):
+    assert archive_generation(str(generation) + '/') == 0
+    pack, index = pack_paths(str(generation) + '/')
+    assert not os.path.exists(str(generation))
+    assert os.path.exists(pack) and os.path.exists(index)
+    out = io.BytesIO()
+    extract_member(pack, index, 'foo.txt', out)
+    assert out.getvalue() == b'foo'
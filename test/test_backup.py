@@ -7,7 +7,7 @@ import copy
 import logging
 logger = logging.getLogger(__name__)
 
-from backup import get_dates_to_remove, exec_cp, exec_rsync, exec_rm_dir, exec_rm_log
+from backup import get_dates_to_remove, exec_cp, exec_rsync, exec_rm_dir, exec_rm_log, exec_manifest, get_rsync_options
 from settings import Settings
 
 # テスト用設定
@@ -91,6 +91,17 @@ def test_get_dates_to_remove(keep_count, is_log, rmdates, stub_setting):
 def test_exec_cp(stub_setting):
     assert exec_cp(stub_setting) ==  0
 
+# hardlinkは前世代を --link-dest に渡す
+def test_get_rsync_options(stub_setting, tmp_path):
+    setting = copy.deepcopy(stub_setting)
+    setting.CPDEST = str(tmp_path / 'dest_20200118')
+    setting.SNAPSHOT = 'copy'
+    assert not any(opt.startswith('--link-dest=') for opt in get_rsync_options(setting))
+    setting.SNAPSHOT = 'hardlink'
+    assert not any(opt.startswith('--link-dest=') for opt in get_rsync_options(setting))
+    (tmp_path / 'dest_20200118').mkdir()
+    assert '--link-dest=' + setting.CPDEST in get_rsync_options(setting)
+
 # rsyncのtest
 def test_exec_rsync(stub_setting):
     assert exec_rsync(stub_setting) == 0
@@ -107,4 +118,16 @@ def test_exec_rm_dir(keep_count, stub_setting):
 def test_exec_rm_log(keep_count, stub_setting):
     setting = copy.deepcopy(stub_setting)
     setting.KEEP_COUNT = keep_count
-    assert exec_rm_log(get_dates_to_remove(setting), setting) == 0
\ No newline at end of file
+    assert exec_rm_log(get_dates_to_remove(setting), setting) == 0
+
+# manifestのtest
+def test_exec_manifest(stub_setting):
+    assert exec_manifest([], stub_setting) == 0
+    assert os.path.exists(os.path.join(stub_setting.STATE_DIR, TYPENAME + '_manifest.sqlite'))
+
+def test_exec_manifest_failed(stub_setting, tmp_path):
+    setting = copy.deepcopy(stub_setting)
+    # 記録できなくてもバックアップは失敗扱いにしない
+    (tmp_path / 'file').write_text('')
+    setting.STATE_DIR = str(tmp_path / 'file')
+    assert exec_manifest([], setting) == 0
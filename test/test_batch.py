@@ -0,0 +1,45 @@
+import pytest
+
+from batch import *
+
+def test_match_sections():
+    sections = ['foo_bar', 'foo_hoge', 'baz_bar']
+    assert match_sections(sections, ['baz_bar', 'nothing', 'baz_bar']) == (['baz_bar'], ['nothing'])
+    assert match_sections(sections, pattern='foo_*') == (['foo_bar', 'foo_hoge'], [])
+    assert match_sections(sections, ['foo_hoge'], 'foo_*') == (['foo_hoge', 'foo_bar'], [])
+
+def test_split_section():
+    assert split_section('foo_bar') == ('foo', 'bar')
+    assert split_section('foo_bar_baz') is None
+    assert split_section('foobar') is None
+    assert split_section('foo_') is None
+
+def item(section, devices, duration, priority=0):
+    return {'section': section, 'devices': devices, 'priority': priority, 'duration': duration}
+
+def test_plan():
+    ordered = plan([item('a', ['sda'], 10), item('b', ['sda'], 100), item('c', ['sdb'], 50),
+                    item('d', ['sda', 'sdb'], 30), item('e', [], 5, priority=1)])
+    # 優先度が先、次に空いているデバイスで長いもの
+    assert [job['section'] for job in ordered] == ['e', 'b', 'c', 'd', 'a']
+    assert [(job['start'], job['finish']) for job in ordered] == [(0, 5), (0, 100), (0, 50), (100, 130), (130, 140)]
+
+def test_progress():
+    job_batch = Batch(1, [{'section': 'a', 'job_id': 1, 'finish': 10.0},
+                          {'section': 'b', 'job_id': 2, 'finish': 20.0},
+                          {'section': 'c', 'job_id': 3, 'finish': 5.0}])
+    states = {1: 'finished', 2: 'running', 3: 'unknown'}
+    progress = job_batch.progress(states.get)
+    assert progress['counts'] == {'finished': 1, 'running': 1, 'unknown': 1}
+    assert progress['progress'] == 0.667
+    assert not progress['done']
+    assert progress['estimated_makespan'] == 20.0
+    states[2] = 'error'
+    assert job_batch.progress(states.get)['done']
+
+def test_registry():
+    registry = BatchRegistry(max_batches=2)
+    ids = [registry.add([]).id for _ in range(3)]
+    assert ids == [1, 2, 3]
+    assert registry.get(1) is None
+    assert registry.get(3).jobs == []
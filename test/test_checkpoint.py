@@ -0,0 +1,26 @@
+import pytest
+
+from checkpoint import Checkpoint
+
+@pytest.mark.parametrize('date_last, date_current, expected', [
+    ('20190101', '20190110', {'cp': 'done', 'rsync': 'started'}),
+    ('20190101', '20190111', {'cp': 'done'}),
+    ('20190110', '20190111', {})
+], ids=['same run', 'next day', 'next generation'])
+def test_resume(date_last, date_current, expected, tmp_path):
+    path = str(tmp_path / '.state' / 'hogehoge_checkpoint.json')
+    ckpt = Checkpoint(path, '20190101', '20190110')
+    ckpt.start('cp')
+    ckpt.done('cp')
+    ckpt.start('rsync')
+    ckpt.set('rm_dates', ['20181220'])
+    resumed = Checkpoint(path, date_last, date_current)
+    assert resumed.state['phases'] == expected
+    assert resumed.get('rm_dates') == (['20181220'] if len(expected) == 2 else None)
+
+def test_clear(tmp_path):
+    path = str(tmp_path / 'hogehoge_checkpoint.json')
+    ckpt = Checkpoint(path, '20190101', '20190110')
+    ckpt.done('cp')
+    ckpt.clear()
+    assert not Checkpoint(path, '20190101', '20190110').is_done('cp')
@@ -0,0 +1,55 @@
+import pytest
+import itertools
+
+import coalesce
+from coalesce import Coalescer
+
+@pytest.fixture()
+def coalescer():
+    return Coalescer()
+
+@pytest.fixture()
+def create():
+    ids = itertools.count(1)
+    return lambda: next(ids)
+
+def test_attach_pending(coalescer, create):
+    assert coalescer.submit('foo', create) == (1, Coalescer.SUBMITTED)
+    # 実行待ちの間はまとめる
+    assert coalescer.submit('foo', create) == (1, Coalescer.ATTACHED)
+    assert coalescer.submit('bar', create) == (2, Coalescer.SUBMITTED)
+    # 実行が始まった後は新しく登録する
+    coalescer.started('foo', 1)
+    assert coalescer.submit('foo', create) == (3, Coalescer.SUBMITTED)
+    # 古いジョブの終了は新しいジョブの実行待ちに影響しない
+    coalescer.finished('foo', 1, 0)
+    assert coalescer.submit('foo', create) == (3, Coalescer.ATTACHED)
+
+def test_min_interval(coalescer, create, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(coalesce.time, 'monotonic', lambda: now[0])
+    job_id, _ = coalescer.submit('foo', create, min_interval=60)
+    coalescer.finished('foo', job_id, 1)
+    # 失敗した後は登録する
+    job_id, how = coalescer.submit('foo', create, min_interval=60)
+    assert how == Coalescer.SUBMITTED
+    coalescer.finished('foo', job_id, 0)
+    now[0] += 30
+    assert coalescer.submit('foo', create, min_interval=60) == (job_id, Coalescer.SKIPPED)
+    assert coalescer.submit('foo', create) == (3, Coalescer.SUBMITTED)
+    now[0] += 31
+    assert coalescer.submit('bar', create, min_interval=60) == (4, Coalescer.SUBMITTED)
+
+def test_prune_last(create, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(coalesce.time, 'monotonic', lambda: now[0])
+    coalescer = Coalescer(max_last=2)
+    for key in ['foo', 'bar', 'baz']:
+        job_id, _ = coalescer.submit(key, create, min_interval=60)
+        coalescer.finished(key, job_id, 0)
+    # 件数を超えたら古いものから捨てる
+    assert list(coalescer._last) == ['bar', 'baz']
+    # 最大の min_interval より古いものは捨てる
+    now[0] += 61
+    coalescer.submit('qux', create)
+    assert len(coalescer._last) == 0
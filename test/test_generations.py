@@ -0,0 +1,31 @@
+import pytest
+
+from generations import select_to_remove, GenerationCatalog, DIRS, LOGS
+
+@pytest.mark.parametrize('keep, expected', [
+    ((2, 0, 0), ['20181220', '20190101', '20190106', '20190107', '20190130', '20190131']),
+    ((1, 2, 0), ['20181220', '20190101', '20190106', '20190130', '20190131', '20190201']),
+    ((1, 0, 3), ['20190101', '20190106', '20190107', '20190130', '20190201']),
+    ((0, 0, 0), ['20181220', '20190101', '20190106', '20190107', '20190130', '20190131', '20190201', '20190202'])
+], ids=['daily', 'weekly', 'monthly', 'none'])
+def test_select_to_remove(keep, expected):
+    dates = ['20181220', '20190101', '20190106', '20190107', '20190130', '20190131', '20190201', '20190202']
+    assert select_to_remove(dates, *keep) == expected
+
+def test_catalog(tmp_path):
+    dest = tmp_path / 'hogehoge'
+    (tmp_path / 'hogehoge_20190101').mkdir()
+    (tmp_path / 'hogehoge_20190110.pack').write_bytes(b'')
+    (tmp_path / 'hogehoge_20190110.pack.idx').write_bytes(b'')
+    (tmp_path / 'hogehoge_old').mkdir()
+    (tmp_path / 'log').mkdir()
+    (tmp_path / 'log' / 'hogehoge_20190110.log').write_text('')
+    path = str(tmp_path / '.state' / 'hogehoge_generations.json')
+    catalog = GenerationCatalog(path, str(dest) + '/', str(tmp_path / 'log' / 'hogehoge'))
+    assert catalog.get(DIRS) == ['20190101', '20190110']
+    assert catalog.get(LOGS) == ['20190110']
+    catalog.add(DIRS, '20190105')
+    catalog.remove(DIRS, ['20190101'])
+    # 作成後はディレクトリを検索しない
+    (tmp_path / 'hogehoge_20190120').mkdir()
+    assert GenerationCatalog(path, str(dest) + '/', '').get(DIRS) == ['20190105', '20190110']
@@ -0,0 +1,57 @@
+import pytest
+import sys
+import time
+import threading
+import os
+from subprocess import Popen, PIPE
+
+import joblock
+from joblock import ResourceLock, resource_key
+
+def test_resource_key():
+    assert resource_key('foo_hoge', '/mnt/backup/foo/hoge/', 'section') == 'foo_hoge'
+    assert resource_key('foo_hoge', '/', 'device') == 'dev_'
+
+def test_wait_in_process(tmp_path):
+    first = ResourceLock('hogehoge', str(tmp_path))
+    first.acquire()
+    acquired_at = []
+
+    def wait():
+        with ResourceLock('hogehoge', str(tmp_path)):
+            acquired_at.append(time.monotonic())
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    time.sleep(0.2)
+    assert acquired_at == []
+    released_at = time.monotonic()
+    first.release()
+    thread.join(5)
+    # 解放されたらすぐに起きる
+    assert acquired_at[0] - released_at < 0.5
+    # 別のキーは待たない
+    assert ResourceLock('foobar', str(tmp_path)).acquire(timeout=0)
+
+def test_wait_other_process(tmp_path):
+    code = ('import fcntl, os, time\n'
+            'fd = os.open(%r, os.O_RDWR | os.O_CREAT)\n'
+            'fcntl.flock(fd, fcntl.LOCK_EX)\n'
+            'print("locked", flush=True)\n'
+            'time.sleep(0.5)\n') % str(tmp_path / 'hogehoge.lock')
+    proc = Popen([sys.executable, '-c', code], stdout=PIPE, universal_newlines=True)
+    try:
+        assert proc.stdout.readline().strip() == 'locked'
+        lock = ResourceLock('hogehoge', str(tmp_path))
+        assert not lock.acquire(timeout=0.1)
+        assert lock.acquire(timeout=5)
+        lock.release()
+    finally:
+        proc.wait()
+
+def test_lock_dir(tmp_path, monkeypatch):
+    # 既定のディレクトリは実行時に LOCK_DIR から決める
+    monkeypatch.setattr(joblock, 'LOCK_DIR', str(tmp_path))
+    with ResourceLock('hogehoge') as lock:
+        assert lock.path == str(tmp_path / 'hogehoge.lock')
+        assert os.path.exists(lock.path)
@@ -0,0 +1,63 @@
+import pytest
+
+import jobstats
+from jobstats import PhaseTimer, Window, SectionStats, HistoryStore, JobStats, percentile
+
+def make_entry(section='foo_hoge', duration=10.0, returncode=0, nbytes=1000, phases=None, kind='backup'):
+    return {'section': section, 'kind': kind, 'finished_at': '2026-01-01T00:00:00', 'duration': duration,
+            'returncode': returncode, 'bytes': nbytes, 'phases': {} if phases is None else phases}
+
+def test_phase_timer(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(jobstats.time, 'monotonic', lambda: now[0])
+    phases = {}
+    timer = PhaseTimer(phases)
+    assert not timer('[INFO] 2026-01-01 00:00:00,000 : backup(33) Start - exec rsync')
+    now[0] += 5
+    timer('[INFO] 2026-01-01 00:00:05,000 : backup(35) End - exec rsync')
+    timer('End - exec cp')
+    timer('sent 1,234 bytes')
+    assert phases == {'exec rsync': 5.0}
+
+@pytest.mark.parametrize('values, q, expected', [
+    ([], 50, None), ([1], 95, 1), ([1, 2, 3, 4], 50, 2), (list(range(1, 101)), 95, 95)
+], ids=['empty', 'single', 'median', 'p95'])
+def test_percentile(values, q, expected):
+    assert percentile(values, q) == expected
+
+def test_window():
+    window = Window(3)
+    for value in [5, 1, 9, 3]:
+        window.add(value)
+    # 古い 5 は捨てられる
+    assert window.summary() == {'p50': 3, 'p95': 9, 'max': 9, 'last': 3}
+
+def test_section_stats():
+    stats = SectionStats()
+    for duration in [10.0, 10.0, 10.0]:
+        stats.add(make_entry(duration=duration, nbytes=1000, phases={'exec rsync': duration - 1}))
+    stats.add(make_entry(duration=1.0, returncode=1))
+    stats.add(make_entry(duration=30.0, nbytes=1500))
+    result = stats.to_dict()
+    assert result['count'] == 5
+    assert result['failures'] == 1
+    assert result['duration'] == {'p50': 10.0, 'p95': 30.0, 'max': 30.0, 'last': 30.0}
+    assert result['slowdown'] == 3.0
+    assert result['phases'] == {'exec rsync': {'p50': 9.0, 'p95': 9.0, 'max': 9.0, 'last': 9.0}}
+    assert result['throughput']['last'] == 50.0
+    assert result['throughput']['trend'] < 1
+
+def test_history_store(tmp_path):
+    path = str(tmp_path / 'state' / 'history.sqlite')
+    store = HistoryStore(path, max_history=2)
+    for duration in [1.0, 2.0, 3.0]:
+        store.add(make_entry(duration=duration))
+    store.add(make_entry(duration=4.0, kind='verify'))
+    assert [(e['kind'], e['duration']) for e in store.load()] == [('backup', 2.0), ('backup', 3.0), ('verify', 4.0)]
+    store.close()
+    # 再起動後はストアの履歴から統計を作る
+    stats = JobStats(HistoryStore(path))
+    result = stats.get()
+    assert result['foo_hoge']['backup']['count'] == 2
+    assert result['foo_hoge']['verify']['duration']['last'] == 4.0
+    assert stats.get('bar_hoge') == {'bar_hoge': {}}
@@ -0,0 +1,66 @@
+import pytest
+import sqlite3
+import subprocess
+
+import jobstore
+from jobstore import JobStore
+
+@pytest.fixture()
+def store(tmp_path):
+    store = JobStore(str(tmp_path / 'state' / 'jobs.sqlite'))
+    yield store
+    store.close()
+
+def make_row(job_id, state='finished'):
+    return {'id': job_id, 'cmd': ['python3', 'backup.py'], 'state': state,
+            'updated_at': '2026-01-01T00:00:00', 'updated_ts': 1.0, 'pid': None, 'create_time': None,
+            'returncode': 0, 'metrics': {'files': 1}, 'resources': {}}
+
+def test_wal(store):
+    assert store._conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+def test_save_load_delete(store, tmp_path):
+    store.save(make_row(2))
+    store.save(make_row(1, 'running'))
+    # 同じIDは上書き
+    store.save(make_row(1, 'error'))
+    assert [(row['id'], row['state']) for row in store.load()] == [(1, 'error'), (2, 'finished')]
+    assert store.load()[0]['metrics'] == {'files': 1}
+    store.delete([1])
+    # 開き直しても残っている
+    reopened = JobStore(store.path)
+    assert [row['id'] for row in reopened.load()] == [2]
+    reopened.close()
+
+def test_create_time_of():
+    proc = subprocess.Popen(['sleep', '5'])
+    try:
+        assert jobstore.create_time_of(proc.pid) is not None
+    finally:
+        proc.kill()
+        proc.wait()
+    assert jobstore.create_time_of(proc.pid) is None
+
+def test_log_file(store):
+    row = make_row(1)
+    row['log_file'] = {'path': '/backup/log/bar_20260101.log', 'start': 10, 'end': 20}
+    store.save(row)
+    store.save(make_row(2))
+    loaded = store.load()
+    assert loaded[0]['log_file'] == row['log_file']
+    assert loaded[1]['log_file'] is None
+
+def test_migrate(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite')
+    # log_file 列がない以前のDB
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE jobs (id INTEGER PRIMARY KEY, cmd TEXT NOT NULL, state TEXT NOT NULL, '
+                 'updated_at TEXT NOT NULL, updated_ts REAL NOT NULL, pid INTEGER, create_time REAL, '
+                 'returncode INTEGER, metrics TEXT NOT NULL, resources TEXT NOT NULL)')
+    conn.execute("INSERT INTO jobs VALUES (1, '[\"true\"]', 'finished', '2026-01-01T00:00:00', 1.0, "
+                 "NULL, NULL, 0, '{}', '{}')")
+    conn.commit()
+    conn.close()
+    store = JobStore(path)
+    assert store.load()[0]['log_file'] is None
+    store.close()
@@ -0,0 +1,59 @@
+import pytest
+import threading
+
+from logbuffer import *
+
+def test_append_read():
+    buf = LogBuffer()
+    buf('foo')
+    buf.append('bar')
+    assert buf.read(0, 100) == (0, b'foo\nbar\n')
+    assert buf.read(4, 100) == (4, b'bar\n')
+    assert buf.read(4, 2) == (4, b'ba')
+    assert buf.read(100, 100) == (8, b'')
+
+def test_trim():
+    buf = LogBuffer(max_bytes=8)
+    for i in range(10):
+        buf.append('%03d' % i)
+    # 先頭が捨てられても位置は変わらない
+    assert buf.end == 40
+    assert 0 < buf.start <= 40 - 8
+    start, data = buf.read(0, 100)
+    assert start == buf.start
+    assert start + len(data) == 40
+    assert data.endswith(b'009\n')
+
+def test_wait():
+    buf = LogBuffer()
+    assert not buf.wait(0, 0.01)
+    threading.Timer(0.05, buf.append, args=('foo',)).start()
+    assert buf.wait(0, 5)
+    threading.Timer(0.05, buf.close).start()
+    assert not buf.wait(buf.end, 5)
+    assert buf.closed
+
+def test_read_file(tmp_path):
+    path = str(tmp_path / 'backup.log')
+    assert file_size(path) == 0
+    assert read_file(path, 0, 0, 100) == b''
+    with open(path, 'w') as f:
+        f.write('before\nfoo\nbar\nafter\n')
+    assert read_file(path, 7, 0, 100) == b'foo\nbar\nafter\n'
+    assert read_file(path, 7, 4, 100, end=15) == b'bar\n'
+    assert read_file(path, 7, 0, 2, end=15) == b'fo'
+
+def test_spool(tmp_path):
+    path = str(tmp_path / '1.log')
+    buf = LogBuffer(max_bytes=8)
+    buf.spool(path)
+    for i in range(10):
+        buf.append('%03d' % i)
+    buf.close()
+    assert buf.spooled
+    # 捨てたところもファイルの同じ位置にある
+    assert file_size(path) == buf.end
+    assert read_file(path, 0, buf.start, 100) == buf.read(buf.start, 100)[1]
+    assert read_file(path, 0, 0, 8) == b'000\n001\n'
+    with pytest.raises(ValueError):
+        buf.spool(path)
@@ -2,7 +2,7 @@ import pytest
 import logging
 logger = logging.getLogger(__name__)
 
-from logutil import set_logger_format
+from logutil import set_logger_format, RawAwareFormatter
 
 @pytest.mark.parametrize('handlers, fmt', [
     (logging.getLogger().handlers, '[%(levelname)s] %(asctime)s : %(name)s(%(lineno)s) %(message)s'),
@@ -11,4 +11,11 @@ from logutil import set_logger_format
 def test_set_logger_format(handlers, fmt):
     set_logger_format(handlers, fmt)
     for handler in handlers:
-        assert handler.formatter._fmt == fmt
\ No newline at end of file
+        assert handler.formatter._fmt == fmt
+
+def test_raw_aware_formatter():
+    formatter = RawAwareFormatter(fmt='[%(levelname)s] %(message)s')
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'hoge %s', ('fuga',), None)
+    assert formatter.format(record) == '[INFO] hoge fuga'
+    record.raw = True
+    assert formatter.format(record) == 'hoge fuga'
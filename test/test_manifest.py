@@ -0,0 +1,46 @@
+import pytest
+import os
+import hashlib
+
+from manifest import Manifest, file_digest, walk_entries
+
+@pytest.fixture()
+def tree(tmp_path):
+    root = tmp_path / 'hogehoge'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'foo.txt').write_text('foo')
+    (root / 'sub' / 'bar.txt').write_text('bar')
+    return root
+
+@pytest.fixture()
+def catalog(tmp_path):
+    catalog = Manifest(str(tmp_path / '.state' / 'hogehoge_manifest.sqlite'))
+    yield catalog
+    catalog.close()
+
+def test_file_digest(tree):
+    assert file_digest(str(tree / 'foo.txt'), read_size=2) == hashlib.sha256(b'foo').hexdigest()
+
+def test_walk_entries(tree):
+    assert sorted(relpath for relpath, _ in walk_entries(str(tree))) == ['foo.txt', 'sub', 'sub/bar.txt']
+
+@pytest.mark.parametrize('with_hash, hashed', [(False, 0), (True, 2)], ids=['no hash', 'hash'])
+def test_record(with_hash, hashed, tree, catalog):
+    counts = catalog.record('20200118', str(tree), with_hash=with_hash)
+    assert counts == {'files': 3, 'reused': 0, 'hashed': hashed, 'bytes': counts['bytes']}
+    assert catalog.get_dates() == ['20200118']
+
+def test_record_incremental(tree, catalog):
+    catalog.record('20200118', str(tree), with_hash=True)
+    os.remove(str(tree / 'foo.txt'))
+    (tree / 'foo.txt').write_text('new foo')
+    counts = catalog.record('20200125', str(tree), with_hash=True)
+    assert counts['reused'] == 2
+    assert counts['hashed'] == 1
+    assert catalog.get_previous_date('20200125') == '20200118'
+
+def test_remove(tree, catalog):
+    catalog.record('20200118', str(tree))
+    catalog.record('20200125', str(tree))
+    catalog.remove(['20200118'])
+    assert catalog.get_dates() == ['20200125']
@@ -0,0 +1,77 @@
+import pytest
+
+import os
+
+from mountutil import read_mountinfo, read_fstab, required_mounts, physical_device, devices_of, MountChecker
+
+MOUNTINFO = '''22 1 179:2 / / rw,noatime shared:1 - ext4 /dev/mmcblk0p2 rw
+30 22 8:1 / /mnt/data rw,relatime shared:5 - ext4 /dev/sda1 rw
+31 22 8:17 / /mnt/my\\040disk rw,relatime - vfat /dev/sdb1 rw
+'''
+
+FSTAB = '''# comment
+/dev/mmcblk0p2  /               ext4    defaults,noatime  0  1
+/dev/sda1       /mnt/data       ext4    defaults          0  2
+/dev/sdc1       /mnt/backup     ext4    defaults          0  2
+/dev/sdd1       /mnt/manual     ext4    noauto            0  2
+/dev/sde1       none            swap    sw                0  0
+'''
+
+@pytest.fixture()
+def files(tmp_path):
+    mountinfo = tmp_path / 'mountinfo'
+    mountinfo.write_text(MOUNTINFO)
+    fstab = tmp_path / 'fstab'
+    fstab.write_text(FSTAB)
+    return str(mountinfo), str(fstab)
+
+def test_read_mountinfo(files):
+    mounts = read_mountinfo(files[0])
+    assert [m['mount_point'] for m in mounts] == ['/', '/mnt/data', '/mnt/my disk']
+    assert mounts[1] == {'mount_point': '/mnt/data', 'dev': '8:1', 'fstype': 'ext4', 'source': '/dev/sda1'}
+
+def test_read_fstab(files):
+    assert read_fstab(files[1]) == ['/', '/mnt/data', '/mnt/backup']
+
+@pytest.mark.parametrize('paths, extra, expected', [
+    (['/mnt/data/foo/hoge/', '/mnt/backup/foo/hoge/'], [], {'/mnt/data', '/mnt/backup'}),
+    (['/home/pi/foo/', '/mnt/database/'], [], set()),
+    (['/home/pi/foo/'], ['/mnt/manual/'], {'/mnt/manual'})
+], ids=['source and dest', 'no mount', 'declared'])
+def test_required_mounts(paths, extra, expected):
+    assert required_mounts(paths, ['/', '/mnt/data', '/mnt/backup'], extra) == expected
+
+def test_get_missing(files):
+    checker = MountChecker(mountinfo_path=files[0], fstab_path=files[1])
+    assert checker.get_missing(['/mnt/data/foo/', '/mnt/backup/foo/']) == ['/mnt/backup']
+
+def test_ensure_mounted(files):
+    checker = MountChecker(mountinfo_path=files[0], fstab_path=files[1])
+    assert checker.ensure(['/mnt/data/foo/'], ['/mnt/my disk']) == 0
+
+@pytest.fixture()
+def sys_dev_block(tmp_path):
+    # sda(8:0) の sda1(8:1)、sdb(8:16)、sdb の上の dm-0(253:0)
+    devices = tmp_path / 'devices'
+    (devices / 'sda' / 'sda1').mkdir(parents=True)
+    (devices / 'sda' / 'sda1' / 'partition').write_text('1')
+    (devices / 'sdb').mkdir()
+    (devices / 'dm-0' / 'slaves').mkdir(parents=True)
+    os.symlink(str(devices / 'sdb'), str(devices / 'dm-0' / 'slaves' / 'sdb'))
+    block = tmp_path / 'block'
+    block.mkdir()
+    for dev, path in [('8:0', 'sda'), ('8:1', 'sda/sda1'), ('8:16', 'sdb'), ('253:0', 'dm-0')]:
+        os.symlink(str(devices / path), str(block / dev))
+    return str(block)
+
+@pytest.mark.parametrize('dev, expected', [
+    ('8:1', 'sda'), ('8:0', 'sda'), ('253:0', 'sdb'), ('8:32', 'dev8:32')
+], ids=['partition', 'disk', 'stacked', 'unknown'])
+def test_physical_device(dev, expected, sys_dev_block):
+    assert physical_device(dev, sys_dev_block) == expected
+
+def test_devices_of(files, sys_dev_block):
+    mounts = read_mountinfo(files[0]) + [{'mount_point': '/mnt/nas', 'dev': '0:50', 'fstype': 'nfs', 'source': 'nas:/share'}]
+    fstab = read_fstab(files[1])
+    assert devices_of(['/mnt/data/foo/', '/mnt/backup/foo/'], mounts, fstab, sys_dev_block) == {'sda', 'mnt:/mnt/backup'}
+    assert devices_of(['/mnt/nas/foo/', '/mnt/data/bar/'], mounts, fstab, sys_dev_block) == {'src:nas:/share', 'sda'}
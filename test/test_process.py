@@ -1,9 +1,9 @@
 import pytest
 import logging
-import psutil
 from subprocess import Popen, STDOUT, PIPE
 
-from process import Process
+from process import Process, split_lines
+from joblock import ResourceLock
 
 # ログ設定
 logger = logging.getLogger(__name__)
@@ -27,53 +27,52 @@ def test_execute(context):
     proc.execute(wait=wait)
     assert proc.returncode == 0
 
-@pytest.fixture(params=[0, 5], ids=['no timeout', 'set timeout'])
-def context_other_procs(request):
-    cmd = request.getfixturevalue('proc').cmd
-    if request.param == 0:
-        return (request.getfixturevalue('proc'), [cmd, cmd], None)
-    else:
-        return (request.getfixturevalue('proc'), [cmd, cmd], 3)
-def test_wait_other_process(context_other_procs):
-    proc, other_cmds, timeout = context_other_procs
-    for ocmd in other_cmds:
-        Popen(ocmd, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
-    rcode = proc.wait_other_process(timeout)
-    proc.wait_other_process()
-    if timeout is None:
-        assert rcode == 0
-    else:
-        assert rcode == 1
-
-@pytest.fixture(params=[0, 1, 2], ids=['no other proc', 'one other proc', 'some other proc'])
-def context_pids(request):
-    if request.param == 0:
-        return (request.getfixturevalue('proc'), [])
-    else:
-        cmd = request.getfixturevalue('proc').cmd
-        return (request.getfixturevalue('proc'), [cmd for _ in range(request.param)])
+@pytest.mark.parametrize('held, timeout, expected', [
+    (False, None, 0),
+    (True, 0.5, 1)
+], ids=['free', 'timeout'])
+def test_wait_other_process(held, timeout, expected, proc, tmp_path):
+    other = ResourceLock('hogehoge', str(tmp_path))
+    if held:
+        other.acquire()
+    proc.lock = ResourceLock('hogehoge', str(tmp_path))
+    try:
+        assert proc.wait_other_process(timeout) == expected
+    finally:
+        proc.release_lock()
+        other.release()
 
-@pytest.mark.parametrize('func, expected', [
-    (lambda: True, True),
-    (lambda: False, False),
-    (lambda: (_ for _ in ()).throw(psutil.NoSuchProcess(0)), False)
-], ids=['True', 'False', 'Exception'])
-def test__process_if(proc, func, expected):
-    assert proc._process_if(func) == expected
+@pytest.mark.parametrize('text, expected', [
+    ('foo\nbar', (['foo'], 'bar')),
+    ('foo\r\nbar\n', (['foo', 'bar'], '')),
+    ('  10%\r  20%\r', (['  10%', '  20%'], ''))
+], ids=['lf', 'crlf', 'cr'])
+def test_split_lines(text, expected):
+    assert split_lines(text) == expected
 
-def test_get_other_process_pids(context_pids):
-    proc, other_cmds = context_pids
-    if len(other_cmds) == 0:
-        pids = proc.get_other_process_pids()
-        assert pids == []
-    else:
-        other_procs = [Popen(ocmd, stdout=PIPE, stderr=STDOUT, universal_newlines=True) for ocmd in other_cmds]
-        pids = proc.get_other_process_pids()
+def test_execute_stream(caplog):
+    lines = []
+    script = 'import sys; sys.stdout.write("a b\\r\\n" + "x" * 100000 + "\\n50%\\rlast")'
+    proc = Process(cmd=['python3', '-c', script], out_to_log=True,
+                   handlers=[lambda line: lines.append(line) or line == '50%'])
+    with caplog.at_level(logging.INFO):
+        proc.execute(wait=True)
+    assert proc.returncode == 0
+    # シェルを介さないので引数の空白もそのまま渡る
+    assert [len(line) for line in lines] == [3, 100000, 3, 4]
+    raw = [record.getMessage() for record in caplog.records if getattr(record, 'raw', False)]
+    assert raw == ['a b', 'x' * 100000, 'last']
 
-        for oproc in other_procs:
-            oproc.wait()
+def test_execute_concurrent():
+    procs = [Process(cmd=['sleep', '1']) for _ in range(5)]
+    for proc in procs:
+        proc.execute()
+    assert [proc.returncode for proc in procs] == [0] * 5
 
-        assert pids == [oproc.pid for oproc in other_procs]
+def test_execute_not_found():
+    proc = Process(cmd=['not_exist_command'])
+    proc.execute(wait=True)
+    assert proc.returncode == 127
 
 if __name__ == '__main__':
-    test_wait_other_process(Process(cmd=['sleep', '5']))
\ No newline at end of file
+    test_execute((Process(cmd=['sleep', '5']), True))
\ No newline at end of file
@@ -1,8 +1,10 @@
 import pytest
-import datetime
+import threading
 
 from process import Process
+import processpool
 from processpool import ProcessPool
+from jobstore import JobStore
 
 @pytest.fixture()
 def pool():
@@ -25,7 +27,7 @@ def test_is_in_keys(key, expected, pool):
 ], ids=['exist', 'not exist'])
 def test_register(key, testkey, expected, pool, sleep_proc):
     pool.register(sleep_proc, key)
-    assert (sleep_proc in [item['proc'] for item in pool.map[testkey]]) == expected
+    assert (len(pool.get_section(to_section_name_stub)[testkey]) == 1) == expected
 
 def to_section_name_stub(proc):
     return proc.cmd[0]
@@ -43,21 +45,15 @@ def to_section_name_stub(proc):
 def context_get_section(request, pool, sleep_proc):
     expected = {ProcessPool.ERROR: [], ProcessPool.FINISHED: [], ProcessPool.RUNNING: [], ProcessPool.PENDING: []}
 
-    if len(request.param) > 0:
-        now = datetime.datetime.now().isoformat()
-        if 'e' in request.param:
-            pool.map[ProcessPool.ERROR].append({'proc':sleep_proc, 'updated_at': now})
-            expected[ProcessPool.ERROR].append({'name': 'sleep', 'updated_at': now})
-        if 'f' in request.param:
-            pool.map[ProcessPool.FINISHED].append({'proc':sleep_proc, 'updated_at': now})
-            expected[ProcessPool.FINISHED].append({'name': 'sleep', 'updated_at': now})
-        if 'r' in request.param:
-            for _ in range(2):
-                pool.map[ProcessPool.RUNNING].append({'proc':sleep_proc, 'updated_at': now})
-                expected[ProcessPool.RUNNING].append({'name': 'sleep', 'updated_at': now})
-        if 'p' in request.param:
-            pool.map[ProcessPool.PENDING].append({'proc':sleep_proc, 'updated_at': now})
-            expected[ProcessPool.PENDING].append({'name': 'sleep', 'updated_at': now})
+    for key, flag, count in [(ProcessPool.ERROR, 'e', 1), (ProcessPool.FINISHED, 'f', 1),
+                             (ProcessPool.RUNNING, 'r', 2), (ProcessPool.PENDING, 'p', 1)]:
+        if flag not in request.param:
+            continue
+        for _ in range(count):
+            proc = Process(['sleep', '5'])
+            job_id = pool.register(proc, key)
+            expected[key].append({'id': job_id, 'name': 'sleep', 'updated_at': pool.get(job_id)['updated_at'],
+                                  'metrics': {}, 'resources': {}})
 
     yield pool, expected
 
@@ -67,14 +63,13 @@ def test_get_section(context_get_section):
 
 @pytest.fixture(params=[0, 1, 2], ids=['valid', 'invalid key', 'value not exists'])
 def context_move_proc(request, pool, sleep_proc):
-    now = datetime.datetime.now().isoformat()
     if request.param == 0:
         # 正常
-        pool.map[ProcessPool.PENDING].append({'proc': sleep_proc, 'updated_at': now})
+        pool.register(sleep_proc, ProcessPool.PENDING)
         return pool, sleep_proc, ProcessPool.PENDING, ProcessPool.RUNNING, 0
     elif request.param == 1:
         # キー違反
-        pool.map[ProcessPool.PENDING].append({'proc': sleep_proc, 'updated_at': now})
+        pool.register(sleep_proc, ProcessPool.PENDING)
         return pool, sleep_proc, ProcessPool.PENDING, 'foobar', 1
     else:
         # 値がない
@@ -84,19 +79,158 @@ def test_move_proc(context_move_proc):
     pool, proc, current, target, expected = context_move_proc
     assert pool.move_proc(proc, target) == expected
     if expected == 0:
-        assert proc in [item['proc'] for item in pool.map[target]]
-        assert proc not in [item['proc'] for item in pool.map[current]]
+        assert pool.get(proc.job_id)['state'] == target
+        sections = pool.get_section(to_section_name_stub)
+        assert len(sections[target]) == 1
+        assert len(sections[current]) == 0
 
 @pytest.fixture(params=[(ProcessPool.FINISHED,), (ProcessPool.ERROR, ProcessPool.RUNNING)],
                 ids=['single target', 'multi target'])
 def context_clear_procs(request, pool):
     for key in request.param:
-        pool.map[key] = [1,2,3]
+        for _ in range(3):
+            pool.register(Process(['sleep', '5']), key)
 
     yield pool, request.param
 
 def test_clear_procs(context_clear_procs):
     pool, keys = context_clear_procs
     pool.clear_procs(keys)
+    sections = pool.get_section(to_section_name_stub)
     for key in keys:
-        assert len(pool.map[key]) == 0
+        assert len(sections[key]) == 0
+
+def test_history_size():
+    pool = ProcessPool(history_size=2)
+    procs = [Process(['sleep', str(i)]) for i in range(3)]
+    for proc in procs:
+        pool.register(proc, ProcessPool.RUNNING)
+        pool.move_proc(proc, ProcessPool.FINISHED)
+    # 古いものから捨てる
+    assert [v['name'] for v in pool.get_section(lambda p: p.cmd[1])[ProcessPool.FINISHED]] == ['1', '2']
+    assert pool.get(procs[0].job_id) is None
+
+def test_history_age(monkeypatch):
+    pool = ProcessPool(history_age=60)
+    now = [1000.0]
+    monkeypatch.setattr(processpool.time, 'monotonic', lambda: now[0])
+    old, new, running = Process(['sleep', '1']), Process(['sleep', '2']), Process(['sleep', '3'])
+    pool.register(old, ProcessPool.ERROR)
+    now[0] += 30
+    pool.register(new, ProcessPool.ERROR)
+    pool.register(running, ProcessPool.RUNNING)
+    now[0] += 40
+    sections = pool.get_section(to_section_name_stub)
+    assert len(sections[ProcessPool.ERROR]) == 1
+    # 実行中は経過時間で消さない
+    assert len(sections[ProcessPool.RUNNING]) == 1
+
+def test_get_section_snapshot(pool, sleep_proc):
+    pool.register(sleep_proc, ProcessPool.RUNNING)
+    pool.move_proc(sleep_proc, ProcessPool.FINISHED)
+    version = pool.version
+    first = pool.get_section(to_section_name_stub)
+    # 変化がなければ同じ項目を返し、返した辞書を変えてもプールには影響しない
+    first['journal'] = {}
+    second = pool.get_section(to_section_name_stub)
+    assert pool.version == version
+    assert 'journal' not in second
+    assert second[ProcessPool.FINISHED][0] is first[ProcessPool.FINISHED][0]
+    other = Process(['sleep', '1'])
+    pool.register(other, ProcessPool.PENDING)
+    assert pool.version > version
+
+def test_concurrent_moves(pool):
+    procs = [Process(['sleep', '5']) for _ in range(200)]
+    def work(chunk):
+        for proc in chunk:
+            pool.register(proc, ProcessPool.PENDING)
+            pool.move_proc(proc, ProcessPool.RUNNING)
+            pool.get_section(to_section_name_stub)
+            pool.move_proc(proc, ProcessPool.FINISHED)
+    threads = [threading.Thread(target=work, args=(procs[i::4],)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sections = pool.get_section(to_section_name_stub)
+    assert len(sections[ProcessPool.FINISHED]) == 100
+    assert len(sections[ProcessPool.RUNNING]) == 0
+
+def test_restore(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite')
+    pool = ProcessPool(store=JobStore(path))
+    finished, running, pending = Process(['true']), Process(['sleep', '5']), Process(['sleep', '1'])
+    for proc, key in [(finished, ProcessPool.RUNNING), (running, ProcessPool.RUNNING), (pending, ProcessPool.PENDING)]:
+        pool.register(proc, key)
+    finished.execute(wait=True)
+    finished.metrics['files'] = 3
+    pool.move_proc(finished, ProcessPool.FINISHED)
+    running.execute()
+    pool.update_proc(running)
+    try:
+        # 再起動
+        restored = ProcessPool(store=JobStore(path))
+        unfinished = restored.restore()
+        sections = restored.get_section(to_section_name_stub)
+        assert sections[ProcessPool.FINISHED][0]['metrics'] == {'files': 3}
+        assert [p.cmd for p in unfinished] == [['sleep', '5'], ['sleep', '1']]
+        assert [p.is_alive() for p in unfinished] == [True, False]
+        # 新しいジョブのIDは続きから
+        assert restored.register(Process(['true']), ProcessPool.PENDING) == 4
+    finally:
+        running._proc.kill()
+    assert running.returncode != 0
+    assert not unfinished[0].is_alive()
+
+def test_persist_outside_lock(tmp_path):
+    # SQLiteへの書き込み中はプールのロックを持たない
+    class CheckedStore(JobStore):
+        def save(self, job):
+            assert not pool._lock.locked()
+            super().save(job)
+
+        def delete(self, job_ids):
+            assert not pool._lock.locked()
+            super().delete(job_ids)
+
+    store = CheckedStore(str(tmp_path / 'jobs.sqlite'))
+    pool = ProcessPool(history_size=1, store=store)
+    procs = [Process(['true']) for _ in range(3)]
+    for proc in procs:
+        pool.register(proc, ProcessPool.RUNNING)
+        pool.move_proc(proc, ProcessPool.FINISHED)
+    assert [(row['id'], row['state']) for row in store.load()] == [(3, ProcessPool.FINISHED)]
+
+def test_wait(pool, sleep_proc):
+    job_id = pool.register(sleep_proc, ProcessPool.RUNNING)
+    # 時間切れならその時点の状態
+    assert pool.wait(job_id, 0.05)['state'] == ProcessPool.RUNNING
+    threading.Timer(0.1, pool.move_proc, args=(sleep_proc, ProcessPool.ERROR)).start()
+    assert pool.wait(job_id, 5)['state'] == ProcessPool.ERROR
+    assert pool.wait(999, 0) is None
+
+def test_touch(pool, sleep_proc):
+    other = Process(['sleep', '1'])
+    pool.register(sleep_proc, ProcessPool.RUNNING)
+    pool.register(other, ProcessPool.RUNNING)
+    version, first = pool.snapshot(to_section_name_stub)
+    sleep_proc.metrics['bytes'] = 10
+    pool.touch(sleep_proc)
+    # 変わったジョブだけ作り直す
+    latest_version, latest = pool.snapshot(to_section_name_stub)
+    assert latest_version == version + 1
+    assert latest[ProcessPool.RUNNING][0]['metrics'] == {'bytes': 10}
+    assert latest[ProcessPool.RUNNING][1] is first[ProcessPool.RUNNING][1]
+    # 間隔内の更新では版数を上げない
+    sleep_proc.metrics['bytes'] = 20
+    pool.touch(sleep_proc)
+    assert pool.version == latest_version
+    pool.touch(other)
+    assert pool.version == latest_version + 1
+
+def test_wait_change(pool, sleep_proc):
+    version = pool.version
+    assert pool.wait_change(version, 0.05) == version
+    threading.Timer(0.1, pool.register, args=(sleep_proc, ProcessPool.PENDING)).start()
+    assert pool.wait_change(version, 5) == version + 1
@@ -0,0 +1,57 @@
+import pytest
+
+from promexport import *
+
+def test_counter():
+    counter = Counter('foo_total', 'Foo.', ('section',))
+    counter.inc(section='a')
+    counter.inc(2, section='a')
+    counter.inc(section='b"c')
+    assert counter.get(section='a') == 3
+    assert counter.expose() == ['# HELP foo_total Foo.', '# TYPE foo_total counter',
+                                'foo_total{section="a"} 3', 'foo_total{section="b\\"c"} 1']
+    with pytest.raises(ValueError):
+        counter.inc(-1, section='a')
+    with pytest.raises(ValueError):
+        counter.inc(user='a')
+
+def test_gauge_function():
+    gauge = Gauge('jobs', 'Jobs.', ('state',))
+    gauge.set_function(lambda: {('running',): 2})
+    assert gauge.expose()[2:] == ['jobs{state="running"} 2']
+
+def test_histogram():
+    histogram = Histogram('wait_seconds', 'Wait.', buckets=(1, 10))
+    for value in (0.5, 1, 5, 100):
+        histogram.observe(value)
+    assert histogram.get() == {'count': 4, 'sum': 106.5}
+    assert histogram.expose()[2:] == ['wait_seconds_bucket{le="1.0"} 2', 'wait_seconds_bucket{le="10.0"} 3',
+                                      'wait_seconds_bucket{le="+Inf"} 4',
+                                      'wait_seconds_sum 106.5', 'wait_seconds_count 4']
+
+def test_job_metrics():
+    metrics = JobMetrics()
+    entry = {'section': 'foo_bar', 'kind': 'backup', 'finished_at': '2026-01-01T00:00:00',
+             'duration': 120.0, 'returncode': 0, 'bytes': 100, 'phases': {}}
+    metrics.job_finished(entry)
+    metrics.job_finished(dict(entry, returncode=1, finished_at='2026-01-02T00:00:00'))
+    assert metrics.completed.get(section='foo_bar', kind='backup', result='success') == 1
+    assert metrics.completed.get(section='foo_bar', kind='backup', result='failure') == 1
+    assert metrics.duration.get(section='foo_bar', kind='backup') == {'count': 1, 'sum': 120.0}
+    assert metrics.bytes.get(section='foo_bar') == 100
+    # 失敗では最終成功日時は変わらない
+    last_success = metrics.last_success.get(section='foo_bar', kind='backup')
+    assert last_success == datetime.datetime(2026, 1, 1).timestamp()
+
+    # 再起動前の統計から引き継ぐ
+    restarted = JobMetrics()
+    restarted.load_stats({'foo_bar': {'backup': {'last_success_at': '2026-01-01T00:00:00'},
+                                      'verify': {'last_success_at': None}}})
+    assert restarted.last_success.get(section='foo_bar', kind='backup') == last_success
+    assert restarted.last_success.get(section='foo_bar', kind='verify') is None
+
+    metrics.retention_removed('foo_bar', 'dirs', 2)
+    metrics.queue_waited('foo_bar', 3.0)
+    text = metrics.expose()
+    assert 'backup_retention_removed_total{section="foo_bar",kind="dirs"} 2' in text
+    assert 'backup_queue_wait_seconds_count{section="foo_bar"} 1' in text
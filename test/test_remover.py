@@ -0,0 +1,55 @@
+import pytest
+import os
+
+from remover import remove_trees, move_to_trash, format_removed, parse_removed, TRASH_DIRNAME
+
+def make_tree(root, depth=3, width=3):
+    os.makedirs(str(root))
+    count = 0
+    for i in range(width):
+        with open(os.path.join(str(root), 'file%d.txt' % i), 'w') as f:
+            f.write('x' * 4096)
+        count += 1
+    if depth > 1:
+        for i in range(width):
+            count += make_tree(root / ('dir%d' % i), depth-1, width)
+    return count
+
+@pytest.mark.parametrize('workers', [1, 4], ids=['single', 'parallel'])
+def test_remove_trees(workers, tmp_path):
+    roots = [tmp_path / 'hogehoge_20190101', tmp_path / 'hogehoge_20190110']
+    count = sum(make_tree(root) for root in roots)
+    stats = remove_trees([str(root) + '/' for root in roots], workers)
+    assert stats.files == count
+    assert stats.dirs == 2 * (1 + 3 + 9)
+    assert stats.bytes_freed >= count * 4096
+    assert stats.errors == 0
+    assert os.listdir(str(tmp_path)) == []
+
+def test_remove_trees_hardlinked(tmp_path):
+    make_tree(tmp_path / 'hogehoge', depth=1)
+    os.makedirs(str(tmp_path / 'hogehoge_20190101'))
+    os.link(str(tmp_path / 'hogehoge' / 'file0.txt'), str(tmp_path / 'hogehoge_20190101' / 'file0.txt'))
+    stats = remove_trees([str(tmp_path / 'hogehoge_20190101')])
+    assert stats.files == 1
+    assert stats.bytes_freed == 0
+    assert os.path.exists(str(tmp_path / 'hogehoge' / 'file0.txt'))
+
+def test_remove_trees_file_and_missing(tmp_path):
+    logpath = tmp_path / 'hogehoge_20190101.log'
+    logpath.write_text('log')
+    stats = remove_trees([str(logpath), str(tmp_path / 'not_exist')])
+    assert stats.files == 1
+    assert stats.errors == 0
+
+def test_move_to_trash(tmp_path):
+    make_tree(tmp_path / 'hogehoge_20190101', depth=1)
+    trash_dirs = move_to_trash([str(tmp_path / 'hogehoge_20190101') + '/', str(tmp_path / 'not_exist')])
+    assert trash_dirs == [str(tmp_path / TRASH_DIRNAME)]
+    assert os.listdir(str(tmp_path)) == [TRASH_DIRNAME]
+    assert len(os.listdir(trash_dirs[0])) == 1
+
+def test_format_parse_removed():
+    line = format_removed('dirs', 3)
+    assert parse_removed('2026-01-01 00:00:00 [INFO] backup: ' + line) == ('dirs', 3)
+    assert parse_removed('removed 1 files, 0 dirs') is None
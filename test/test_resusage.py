@@ -0,0 +1,27 @@
+import pytest
+import sys
+
+from process import Process
+from resusage import ResourceSampler
+
+def test_sample_tree():
+    # 子プロセスを起動して、子がCPUとメモリを使う
+    code = ('import subprocess, sys\n'
+            'subprocess.run([sys.executable, "-c", "x = bytearray(32 * 1024 * 1024); sum(range(3 * 10 ** 7))"])\n')
+    proc = Process(cmd=[sys.executable, '-c', code])
+    proc.execute()
+    sampler = ResourceSampler(proc, interval=0.1)
+    sampler.start()
+    assert proc.returncode == 0
+    sampler.stop()
+    res = proc.resources
+    assert res['samples'] > 0
+    assert res['procs_peak'] == 2
+    assert res['rss_peak'] > 32 * 1024 * 1024
+    assert res['cpu_seconds'] > 0
+
+def test_not_started():
+    proc = Process(cmd=['true'])
+    sampler = ResourceSampler(proc)
+    sampler.sample()
+    assert proc.resources['samples'] == 0
@@ -0,0 +1,35 @@
+import pytest
+import os
+
+from rsyncshard import list_units, plan_units, load_weights, save_weights, FILES_UNIT
+
+@pytest.fixture()
+def srcdir(tmp_path):
+    src = tmp_path / 'srcdir'
+    for name in ['foo', 'bar']:
+        (src / name).mkdir(parents=True)
+        (src / name / 'a.txt').write_text(name)
+    (src / 'hoge.txt').write_text('hoge')
+    (src / 'fuga.txt').write_text('fuga')
+    return str(src) + '/'
+
+def test_list_units(srcdir):
+    units = list_units(srcdir)
+    assert units == {'bar': [os.path.join(srcdir, 'bar')],
+                     'foo': [os.path.join(srcdir, 'foo')],
+                     FILES_UNIT: [os.path.join(srcdir, 'fuga.txt'), os.path.join(srcdir, 'hoge.txt')]}
+
+@pytest.mark.parametrize('weights, expected', [
+    ({}, ['a', 'b', 'c']),
+    ({'a': 1.0, 'b': 10.0, 'c': 5.0}, ['b', 'c', 'a']),
+    ({'a': 1.0, 'b': 9.0}, ['b', 'c', 'a'])
+], ids=['no history', 'full history', 'new unit uses average'])
+def test_plan_units(weights, expected):
+    units = {'a': ['a'], 'b': ['b'], 'c': ['c']}
+    assert plan_units(units, weights) == expected
+
+def test_weights(tmp_path):
+    path = str(tmp_path / '.state' / 'hogehoge_shards.json')
+    assert load_weights(path) == {}
+    save_weights(path, {'foo': 1.5})
+    assert load_weights(path) == {'foo': 1.5}
@@ -0,0 +1,46 @@
+import pytest
+
+from rsyncstat import parse_progress, parse_stats, parse_metrics, RsyncProgress, MetricsCollector
+
+@pytest.mark.parametrize('line, expected', [
+    ('      1,238,099  10%  102.09MB/s    0:01:05 (xfr#1, to-chk=97/99)',
+     {'bytes': 1238099, 'percent': 10, 'rate': 102.09*1024**2, 'eta': 65, 'files': 1}),
+    ('        524,288  50%    1.00kB/s    0:00:10',
+     {'bytes': 524288, 'percent': 50, 'rate': 1024.0, 'eta': 10}),
+    ('     10,485,760 100%   20.00MB/s    0:00:01 (xfr#12, ir-chk=0/30)',
+     {'bytes': 10485760, 'percent': 100, 'rate': 20.0*1024**2, 'eta': 0, 'files': 12}),
+    ('sending incremental file list', None),
+    ('hogehoge.txt', None)
+], ids=['to-chk', 'no xfr', 'done', 'header', 'file name'])
+def test_parse_progress(line, expected):
+    assert parse_progress(line) == expected
+
+@pytest.mark.parametrize('line, expected', [
+    ('Number of regular files transferred: 1,234', ('files', 1234)),
+    ('Total transferred file size: 5,678 bytes', ('bytes', 5678)),
+    ('Total file size: 5,678 bytes', None)
+], ids=['files', 'bytes', 'not target'])
+def test_parse_stats(line, expected):
+    assert parse_stats(line) == expected
+
+def test_progress_aggregate():
+    progress = RsyncProgress(interval=3600)
+    assert progress.update('foo', '  100  50%  1.00kB/s  0:00:10 (xfr#1, to-chk=1/2)')
+    assert progress.update('bar', '  300  25%  2.00kB/s  0:00:30 (xfr#2, to-chk=5/8)')
+    assert not progress.update('bar', 'bar/hoge.txt')
+    assert progress.snapshot() == {'bytes': 400, 'files': 3, 'rate': 3072.0, 'eta': 30, 'percent': 28}
+    progress.finish('foo')
+    assert progress.snapshot()['rate'] == 2048.0
+
+def test_metrics_roundtrip(caplog):
+    progress = RsyncProgress(interval=0)
+    with caplog.at_level('INFO'):
+        progress.update('', '  100  50%  1.00kB/s  0:00:10 (xfr#1, to-chk=1/2)')
+    metrics = {}
+    updates = []
+    collector = MetricsCollector(metrics, on_update=lambda: updates.append(1))
+    assert collector('[INFO] 2020-01-18 00:00:00,000 : rsyncstat(198) ' + caplog.records[-1].getMessage()) is False
+    assert metrics.pop('updated_at') is not None
+    assert metrics == {'bytes': 100, 'files': 1, 'rate': 1024.0, 'eta': 10, 'percent': 50}
+    assert updates == [1]
+    assert parse_metrics('hogehoge') is None
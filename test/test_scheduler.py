@@ -0,0 +1,139 @@
+import pytest
+import time
+import threading
+
+from joblock import ResourceLock
+from scheduler import Scheduler
+
+@pytest.fixture()
+def scheduler():
+    return Scheduler()
+
+def test_parallel_devices(scheduler):
+    first = scheduler.ticket('foo_hoge', ['sda', 'sdb'])
+    assert first.acquire(timeout=0)
+    # 別のディスクは並列に実行できる
+    other = scheduler.ticket('bar_hoge', ['sdc', 'sdd'])
+    assert other.acquire(timeout=0)
+    # 同じディスクは待つ
+    same = scheduler.ticket('baz_hoge', ['sdb', 'sde'])
+    assert not same.acquire(timeout=0.1)
+    first.release()
+    assert same.acquire(timeout=0)
+    assert scheduler.status() == {'running': {'sdb': 1, 'sdc': 1, 'sdd': 1, 'sde': 1}, 'waiting': []}
+
+def test_limit(scheduler):
+    tickets = [scheduler.ticket('foo_%d' % i, ['sda'], limit=2) for i in range(3)]
+    assert tickets[0].acquire(timeout=0)
+    assert tickets[1].acquire(timeout=0)
+    assert not tickets[2].acquire(timeout=0.1)
+
+def test_priority(scheduler):
+    running = scheduler.ticket('running', ['sda'])
+    running.acquire()
+    order = []
+
+    def wait(ticket):
+        with ticket:
+            order.append(ticket.key)
+
+    threads = []
+    for key, priority in [('low', 0), ('high', 10), ('middle', 5)]:
+        thread = threading.Thread(target=wait, args=(scheduler.ticket(key, ['sda'], priority=priority),))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.05)
+    assert scheduler.status()['waiting'] == ['high', 'middle', 'low']
+    running.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['high', 'middle', 'low']
+
+def test_no_overtaking(scheduler):
+    running = scheduler.ticket('a', ['sda'])
+    running.acquire()
+    # sda, sdb を待つ優先度の高いジョブがいる間は、sdb だけのジョブも後回しにする
+    high = scheduler.ticket('high', ['sda', 'sdb'], priority=10)
+    thread = threading.Thread(target=high.acquire)
+    thread.start()
+    time.sleep(0.05)
+    assert not scheduler.ticket('low', ['sdb']).acquire(timeout=0.1)
+    # 諦めたジョブは待ちから外れる
+    assert scheduler.status()['waiting'] == ['high']
+    running.release()
+    thread.join(5)
+    assert high.locked
+    high.release()
+
+def test_locks(scheduler, tmp_path):
+    section = ResourceLock('foo_hoge', str(tmp_path))
+    device = ResourceLock('dev_mnt_backup', str(tmp_path))
+    ticket = scheduler.ticket('foo_hoge', ['sda'], lock=section, device_lock=device)
+    assert ticket.acquire(timeout=0)
+    assert section.locked and device.locked
+    ticket.release()
+    assert not section.locked and not device.locked
+    assert scheduler.status()['running'] == {}
+    # デバイスのロックが取れなければ実行権も返す
+    held = ResourceLock('dev_mnt_backup', str(tmp_path))
+    held.acquire()
+    other = ResourceLock('dev_mnt_backup', str(tmp_path))
+    ticket = scheduler.ticket('foo_hoge', ['sda'], lock=ResourceLock('foo_hoge', str(tmp_path)), device_lock=other)
+    assert not ticket.acquire(timeout=0.1)
+    assert scheduler.status()['running'] == {}
+    assert ResourceLock('foo_hoge', str(tmp_path)).acquire(timeout=0)
+    held.release()
+
+def test_enqueue_order(scheduler):
+    running = scheduler.ticket('running', ['sda'])
+    running.acquire()
+    # 順番だけ取ったジョブは、後から acquire したジョブに追い越されない
+    first = scheduler.ticket('first', ['sda', 'sdb'])
+    first.enqueue()
+    second = scheduler.ticket('second', ['sdb'])
+    assert not second.acquire(timeout=0.1)
+    assert scheduler.status()['waiting'] == ['first']
+    running.release()
+    assert first.acquire(timeout=0)
+    first.release()
+    assert second.acquire(timeout=0)
+    second.release()
+
+def test_enqueue_same_key(scheduler, tmp_path):
+    # 順番を取ったジョブがキーのロックを待つ間、ロックを持つ同じキーのジョブは待たせない
+    enqueued = scheduler.ticket('qux_hoge', ['sda'], lock=ResourceLock('qux_hoge', str(tmp_path)))
+    enqueued.enqueue()
+    holder = scheduler.ticket('qux_hoge', ['sda'], lock=ResourceLock('qux_hoge', str(tmp_path)))
+    assert holder.acquire(timeout=0)
+    # キーのロックを取れずに諦めたら順番も返す
+    assert not enqueued.acquire(timeout=0.1)
+    assert scheduler.status()['waiting'] == []
+    holder.release()
+    assert enqueued.acquire(timeout=0)
+    enqueued.release()
+
+def test_acquire_error(scheduler, tmp_path):
+    class BrokenLock(ResourceLock):
+        def acquire(self, timeout=None):
+            raise OSError('broken')
+
+    # ロックが例外を出したら順番を返し、同じデバイスの後続のジョブを待たせない
+    broken = scheduler.ticket('broken', ['sda'], lock=BrokenLock('broken_hoge', str(tmp_path)))
+    broken.enqueue()
+    with pytest.raises(OSError):
+        broken.acquire()
+    assert scheduler.status()['waiting'] == []
+    other = scheduler.ticket('other', ['sda'])
+    assert other.acquire(timeout=0.1)
+    other.release()
+    # 実行権を得た後のデバイスのロックの例外では実行権も返す
+    broken = scheduler.ticket('broken', ['sda'], device_lock=BrokenLock('broken_dev', str(tmp_path)))
+    with pytest.raises(OSError):
+        broken.acquire()
+    assert scheduler.status()['running'] == {}
+    # 順番だけ取って acquire しなかったものは cancel で返す
+    dropped = scheduler.ticket('dropped', ['sda'])
+    dropped.enqueue()
+    dropped.cancel()
+    assert other.acquire(timeout=0.1)
+    other.release()
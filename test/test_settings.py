@@ -5,7 +5,7 @@ import configparser
 import datetime
 from pathlib import Path
 
-from settings import Settings
+from settings import Settings, ConfigCache
 
 # テスト用設定
 PRJDIR = os.path.dirname(os.path.abspath(__file__))
@@ -53,6 +53,10 @@ def fixture_testconfig():
                  str(Path(PRJDIR, CONFIG_PATH).resolve()))
     # config_example.ini削除
     os.remove(str(Path(PRJDIR, CONFIG_BACKUP_PATH).resolve()))
+    # export_config のロックファイル削除
+    lockpath = str(Path(PRJDIR, CONFIG_PATH).resolve()) + '.lock'
+    if os.path.exists(lockpath):
+        os.remove(lockpath)
 
 @pytest.fixture()
 def cmd_args():
@@ -69,3 +73,19 @@ def test_export_config(cmd_args, fixture_testconfig):
     config = configparser.ConfigParser()
     config.read(str(Path(PRJDIR, CONFIG_PATH).resolve()), 'UTF-8')
     assert config[USERNAME+'_'+TYPENAME]['date_last'] == datetime.date.today().strftime('%Y%m%d')
+
+def test_config_cache(tmp_path):
+    cache = ConfigCache()
+    path = str(tmp_path / 'config.ini')
+    assert cache.get(path) is None
+    with open(path, 'w') as f:
+        f.write('[foo_bar]\ndate_last = 20260101\n')
+    first = cache.get(path)
+    assert cache.get(path) is first
+    # mtime が同じでも os.replace で置き換えたら読み直す
+    mtime_ns = os.stat(path).st_mtime_ns
+    with open(path + '.tmp', 'w') as f:
+        f.write('[foo_bar]\ndate_last = 20260102\n')
+    os.utime(path + '.tmp', ns=(mtime_ns, mtime_ns))
+    os.replace(path + '.tmp', path)
+    assert cache.get(path)['foo_bar']['date_last'] == '20260102'
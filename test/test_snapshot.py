@@ -0,0 +1,31 @@
+import pytest
+import os
+
+from snapshot import rotate
+
+@pytest.fixture()
+def desttree(tmp_path):
+    dest = tmp_path / 'hogehoge'
+    (dest / 'sub').mkdir(parents=True)
+    (dest / 'foo.txt').write_text('foo')
+    (dest / 'sub' / 'bar.txt').write_text('bar')
+    return dest
+
+def test_rotate(desttree, tmp_path):
+    cpdest = tmp_path / 'hogehoge_20200118'
+    assert rotate(str(desttree) + '/', str(cpdest) + '/')
+    assert (cpdest / 'sub' / 'bar.txt').read_text() == 'bar'
+    assert os.listdir(str(desttree)) == []
+
+def test_rotate_rerun(desttree, tmp_path):
+    cpdest = tmp_path / 'hogehoge_20200118'
+    rotate(str(desttree), str(cpdest))
+    # 改名後に中断しても続きから行える
+    os.rmdir(str(desttree))
+    assert not rotate(str(desttree), str(cpdest))
+    assert not rotate(str(desttree), str(cpdest))
+    assert desttree.is_dir()
+    # 同期済みの最新ディレクトリがあるときは上書きしない
+    (desttree / 'foo.txt').write_text('foo')
+    with pytest.raises(FileExistsError):
+        rotate(str(desttree), str(cpdest))
@@ -0,0 +1,59 @@
+import pytest
+import os
+
+from verify import DigestStore, Verifier
+
+@pytest.fixture()
+def trees(tmp_path):
+    src, dest = tmp_path / 'src', tmp_path / 'dest'
+    for root in [src, dest]:
+        (root / 'sub').mkdir(parents=True)
+        (root / 'foo.txt').write_text('foo')
+        (root / 'sub' / 'bar.txt').write_text('bar')
+    # rsync -a と同じくmtimeを揃える
+    for relpath in ['foo.txt', 'sub/bar.txt']:
+        st = os.stat(str(src / relpath))
+        os.utime(str(dest / relpath), ns=(st.st_atime_ns, st.st_mtime_ns))
+    return src, dest
+
+def run(tmp_path, dest, src, max_age=3600):
+    store = DigestStore(str(tmp_path / '.state' / 'verify.sqlite'))
+    try:
+        verifier = Verifier(store, workers=2, max_age=max_age)
+        verifier.verify_tree('', str(dest), str(src))
+    finally:
+        store.close()
+    return verifier.report
+
+def test_incremental(trees, tmp_path):
+    src, dest = trees
+    report = run(tmp_path, dest, src)
+    assert (report.files, report.hashed, report.skipped, report.mismatches) == (2, 2, 0, [])
+    # 変更のないファイルは期限内なら読まない
+    report = run(tmp_path, dest, src)
+    assert (report.hashed, report.skipped, report.bytes) == (0, 2, 0)
+    # 期限切れなら読み直す
+    report = run(tmp_path, dest, src, max_age=0)
+    assert (report.hashed, report.mismatches) == (2, [])
+
+def test_mismatch(trees, tmp_path):
+    src, dest = trees
+    run(tmp_path, dest, src)
+    # statを変えずに中身だけ壊す
+    path = str(dest / 'foo.txt')
+    st = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.write(b'F')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    report = run(tmp_path, dest, src, max_age=0)
+    assert report.mismatches == [{'generation': '', 'path': 'foo.txt', 'reason': 'content changed without stat change'}]
+
+def test_differs_from_source(trees, tmp_path):
+    src, dest = trees
+    path = str(dest / 'sub' / 'bar.txt')
+    st = os.stat(path)
+    with open(path, 'wb') as f:
+        f.write(b'BAR')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    report = run(tmp_path, dest, src)
+    assert [m['reason'] for m in report.mismatches] == ['differs from source']
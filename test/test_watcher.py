@@ -0,0 +1,76 @@
+import pytest
+import os
+import time
+
+from watcher import Journal, Watcher
+
+SECTION = 'foobar_hogehoge'
+
+@pytest.fixture()
+def journal(tmp_path):
+    journal = Journal(str(tmp_path / '.state'), SECTION)
+    journal.start(os.getpid())
+    # 開始時のあふれを消化しておく
+    assert journal.take() is None
+    journal.commit(full_scan=True)
+    return journal
+
+def test_take_not_watching(tmp_path):
+    journal = Journal(str(tmp_path / '.state'), SECTION)
+    journal.append(['foo.txt'])
+    assert journal.take() is None
+
+def test_take_commit(journal):
+    journal.append(['foo.txt', 'sub/bar.txt'])
+    journal.append(['foo.txt'])
+    assert journal.take() == ['foo.txt', 'sub/bar.txt']
+    journal.commit()
+    assert journal.take() == []
+    assert journal.status()['last_full_scan'] is not None
+
+def test_take_rollback(journal):
+    journal.append(['foo.txt'])
+    assert journal.take() == ['foo.txt']
+    journal.rollback()
+    journal.append(['bar.txt'])
+    assert journal.take() == ['bar.txt', 'foo.txt']
+
+@pytest.mark.parametrize('max_bytes, expected', [
+    (1024, ['foo.txt']),
+    (4, None)
+], ids=['within limit', 'overflow'])
+def test_max_bytes(max_bytes, expected, journal):
+    journal.max_bytes = max_bytes
+    journal.append(['foo.txt'])
+    assert journal.take() == expected
+
+def wait_for(journal, expected, timeout=5.0):
+    end = time.monotonic() + timeout
+    relpaths = []
+    while time.monotonic() < end:
+        relpaths += journal.take()
+        journal.commit()
+        if set(expected) <= set(relpaths):
+            break
+        time.sleep(0.1)
+    return relpaths
+
+def test_watcher(tmp_path):
+    src = tmp_path / 'srcdir'
+    (src / 'sub').mkdir(parents=True)
+    journal = Journal(str(tmp_path / '.state'), SECTION)
+    w = Watcher(str(src), journal, flush_interval=0.1)
+    w.start()
+    try:
+        time.sleep(0.3)
+        assert journal.take() is None
+        journal.commit(full_scan=True)
+        (src / 'sub' / 'foo.txt').write_text('foo')
+        (src / 'new').mkdir()
+        time.sleep(0.3)
+        (src / 'new' / 'bar.txt').write_text('bar')
+        relpaths = wait_for(journal, ['sub/foo.txt', 'new', 'new/bar.txt'])
+    finally:
+        w.stop()
+        w.join()
+    assert {'sub/foo.txt', 'new', 'new/bar.txt'} <= set(relpaths)
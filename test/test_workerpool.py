@@ -0,0 +1,52 @@
+import pytest
+import os
+import logging
+
+import workerpool
+from workerpool import WorkerPool, WorkerProcess
+
+def fake_run_job(args, config_cache):
+    if args[0] == 'crash':
+        os._exit(3)
+    if args[0] == 'exit':
+        raise SystemExit(2)
+    logging.getLogger('backup').info('hello %s', args[0])
+    logging.getLogger('process').info('raw output', extra={'raw': True})
+    return 0
+
+@pytest.fixture()
+def pool(monkeypatch):
+    # fork前に差し替えるとワーカーにも反映される
+    monkeypatch.setattr(workerpool, 'run_job', fake_run_job)
+    pool = WorkerPool(size=1)
+    yield pool
+    pool.close()
+
+def test_worker_process(pool):
+    lines = []
+    proc = WorkerProcess(['python3', 'backup.py', 'foo'], pool, handlers=[lines.append])
+    proc.execute(wait=True)
+    assert proc.returncode == 0
+    assert lines[0].startswith('[INFO]') and lines[0].endswith('hello foo')
+    assert lines[1] == 'raw output'
+    # 同じワーカーで続けて実行する
+    pid = proc.pid
+    proc = WorkerProcess(['python3', 'backup.py', 'exit'], pool)
+    proc.execute(wait=True)
+    assert proc.returncode == 2
+    assert proc.pid == pid
+
+def test_worker_crash(monkeypatch):
+    monkeypatch.setattr(workerpool, 'run_job', fake_run_job)
+    pool = WorkerPool(size=2)
+    try:
+        # 異常終了したワーカーは作り直さずに外す
+        assert pool.submit(['crash']).result(timeout=10) == 3
+        assert pool.submit(['bar']).result(timeout=10) == 0
+        assert pool.alive == 1
+        assert not pool.degraded
+        assert pool.submit(['crash']).result(timeout=10) == 3
+        assert pool.degraded
+        assert pool.submit(['bar']).result(timeout=10) == 1
+    finally:
+        pool.close()
@@ -0,0 +1,300 @@
+import os
+import json
+import stat
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger = logging.getLogger(__name__)
+
+from manifest import file_digest, walk_entries, BATCH_SIZE
+
+# 検証時の読み込みサイズ(大きめに順次読む)
+READ_SIZE = 4 * 1024 * 1024
+
+class VerifyReport:
+    """
+    検証結果を集計するクラス
+
+    Attributes
+    ----------
+    files : int
+        対象の通常ファイル数
+    hashed : int
+        ハッシュを計算したファイル数
+    skipped : int
+        検証済みで変更がなく、期限内のため飛ばしたファイル数
+    bytes : int
+        ハッシュを計算したバイト数
+    elapsed : float
+        処理時間(s)
+    mismatches : list of dict
+        不一致(generation, path, reason)
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.hashed = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.mismatches = []
+
+    @property
+    def throughput(self):
+        if self.elapsed <= 0:
+            return float(self.bytes)
+        return self.bytes / self.elapsed
+
+    def to_dict(self):
+        return {'files': self.files, 'hashed': self.hashed, 'skipped': self.skipped, 'bytes': self.bytes,
+                'elapsed': round(self.elapsed, 1), 'throughput': round(self.throughput, 1),
+                'mismatches': self.mismatches}
+
+    def __str__(self):
+        return 'verified %d files (%d hashed, %d skipped), %d bytes in %.1fs (%.1f MB/s), %d mismatches' % (
+            self.files, self.hashed, self.skipped, self.bytes, self.elapsed,
+            self.throughput / 1024**2, len(self.mismatches))
+
+class DigestStore:
+    """
+    検証済みダイジェストを保持するSQLiteカタログ
+
+    Attributes
+    ----------
+    path : str
+        カタログファイルのパス
+    _conn : sqlite3.Connection
+        カタログへの接続
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS digests (
+                generation TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                verified_at REAL NOT NULL,
+                PRIMARY KEY (generation, path)
+            ) WITHOUT ROWID;
+        """)
+
+    def close(self):
+        self._conn.close()
+
+    def load(self, generation):
+        """
+        世代の検証済みダイジェストを取得する
+
+        Parameters
+        ----------
+        generation : str
+            世代(最新は空文字、過去世代は日付)
+
+        Returns
+        -------
+        dict of {str: tuple}
+            相対パスと (size, mtime_ns, inode, hash, verified_at)
+        """
+        return {row[0]: row[1:] for row in self._conn.execute(
+            'SELECT path, size, mtime_ns, inode, hash, verified_at FROM digests WHERE generation = ?', (generation,))}
+
+    def update(self, generation, rows, removed):
+        """
+        ダイジェストを書き込み、なくなったファイルの行を消す
+
+        Parameters
+        ----------
+        generation : str
+            世代
+        rows : list of tuple
+            (path, size, mtime_ns, inode, hash, verified_at)
+        removed : iterable of str
+            なくなったファイルの相対パス
+        """
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [(generation,) + tuple(row) for row in rows])
+            self._conn.executemany('DELETE FROM digests WHERE generation = ? AND path = ?',
+                                   [(generation, relpath) for relpath in removed])
+
+    def prune(self, generations):
+        """
+        指定以外の世代の行を消す
+
+        Parameters
+        ----------
+        generations : list of str
+            残す世代
+        """
+        with self._conn:
+            known = [row[0] for row in self._conn.execute('SELECT DISTINCT generation FROM digests')]
+            for generation in set(known) - set(generations):
+                self._conn.execute('DELETE FROM digests WHERE generation = ?', (generation,))
+
+class Verifier:
+    """
+    世代ディレクトリのファイルをハッシュして検証するクラス
+
+    statが前回検証時と同じで、検証から max_age 秒以内のファイルは飛ばす。
+    statが同じなのにダイジェストが変わっていれば破損とみなす。
+    新しい・変更されたファイルは、バックアップ元のsize, mtimeが同じならバックアップ元とも比較する。
+    同じinode(ハードリンクの過去世代)は1回の実行で1度だけ読む。
+
+    Attributes
+    ----------
+    store : DigestStore
+        ダイジェストの保存先
+    workers : int, default 2
+        ハッシュ計算スレッド数
+    max_age : float, default 30日
+        再検証までの秒数
+    """
+
+    def __init__(self, store, workers=2, max_age=30*24*3600):
+        self.store = store
+        self.workers = workers
+        self.max_age = max_age
+        self.report = VerifyReport()
+        self._inode_digests = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, path, st):
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._inode_digests.get(key)
+        if digest is not None:
+            return digest, 0
+        digest = file_digest(path, READ_SIZE)
+        with self._lock:
+            self._inode_digests[key] = digest
+        return digest, st.st_size
+
+    def _check(self, root, source, relpath, st, known):
+        """
+        1ファイルを検証する
+
+        Returns
+        -------
+        row : tuple or None
+            保存する行(不一致・読み込み失敗ならNone)
+        nbytes : int
+            読んだバイト数
+        reason : str or None
+            不一致の理由
+        """
+        nbytes = 0
+        try:
+            digest, nbytes = self._digest(os.path.join(root, relpath), st)
+        except OSError as e:
+            return None, nbytes, 'unreadable: %s' % e
+        if known is not None:
+            if known[3] != digest:
+                return None, nbytes, 'content changed without stat change'
+        elif source is not None:
+            try:
+                src_st = os.stat(os.path.join(source, relpath))
+                if (src_st.st_size, src_st.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                    src_digest, src_bytes = self._digest(os.path.join(source, relpath), src_st)
+                    nbytes += src_bytes
+                    if src_digest != digest:
+                        return None, nbytes, 'differs from source'
+            except OSError:
+                # バックアップ元で消えた・読めないものは比較しない
+                pass
+        return (relpath, st.st_size, st.st_mtime_ns, st.st_ino, digest, time.time()), nbytes, None
+
+    def verify_tree(self, generation, root, source=None):
+        """
+        1世代を検証する
+
+        Parameters
+        ----------
+        generation : str
+            世代(最新は空文字、過去世代は日付)
+        root : str
+            世代ディレクトリ
+        source : str, default None
+            比較するバックアップ元(最新世代のみ)
+        """
+        start = time.monotonic()
+        known = self.store.load(generation)
+        seen = set()
+        candidates = []
+        now = time.time()
+        for relpath, st in walk_entries(root):
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            seen.add(relpath)
+            self.report.files += 1
+            row = known.get(relpath)
+            if row is not None and row[:3] != (st.st_size, st.st_mtime_ns, st.st_ino):
+                row = None
+            if row is not None and now - row[4] < self.max_age:
+                self.report.skipped += 1
+                continue
+            candidates.append((relpath, st, row))
+
+        rows = []
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            results = executor.map(lambda c: self._check(root, source, *c), candidates)
+            for (relpath, st, row), (new_row, nbytes, reason) in zip(candidates, results):
+                self.report.hashed += 1
+                self.report.bytes += nbytes
+                if reason is not None:
+                    logger.error('verify mismatch %s/%s: %s', generation or 'latest', relpath, reason)
+                    self.report.mismatches.append({'generation': generation, 'path': relpath, 'reason': reason})
+                    continue
+                rows.append(new_row)
+                if len(rows) >= BATCH_SIZE:
+                    self.store.update(generation, rows, [])
+                    rows = []
+        self.store.update(generation, rows, set(known) - seen)
+        self.report.elapsed += time.monotonic() - start
+
+def save_report(path, section, report):
+    """
+    検証結果をJSONで保存する
+
+    Parameters
+    ----------
+    path : str
+        保存先
+    section : str
+        セクション名
+    report : VerifyReport
+        検証結果
+    """
+    result = report.to_dict()
+    result['section'] = section
+    result['verified_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w', encoding='UTF-8') as f:
+        json.dump(result, f)
+    os.replace(tmppath, path)
+
+def load_report(path):
+    """
+    保存された検証結果を読む
+
+    Parameters
+    ----------
+    path : str
+        保存先
+
+    Returns
+    -------
+    dict or None
+    """
+    try:
+        with open(path, encoding='UTF-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
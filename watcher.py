@@ -0,0 +1,420 @@
+import os
+import json
+import time
+import errno
+import fcntl
+import select
+import struct
+import ctypes
+import ctypes.util
+import datetime
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+# inotify のイベントマスク(linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify:
+    """
+    inotify のラッパークラス
+
+    Attributes
+    ----------
+    fd : int
+        inotify インスタンスのファイルディスクリプタ
+    """
+    _libc = None
+
+    def __init__(self):
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = Inotify._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        監視を追加する
+
+        Parameters
+        ----------
+        path : str
+            監視するディレクトリ
+        mask : int, default WATCH_MASK
+            監視するイベント
+
+        Returns
+        -------
+        wd : int
+            ウォッチディスクリプタ
+        """
+        wd = Inotify._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        """
+        溜まっているイベントを読み出す
+
+        Returns
+        -------
+        events : list of tuple of (int, int, str)
+            ウォッチディスクリプタ、イベントマスク、名前
+        """
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset+length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Journal:
+    """
+    セクションごとの変更ジャーナル
+
+    ウォッチャーが変更されたパスを追記し、backup.py が取り出して rsync の --files-from に渡す。
+    ファイルは dest と同じ階層の .state ディレクトリに置き、ロックファイルで排他する。
+
+    Attributes
+    ----------
+    base : str
+        ジャーナル関連ファイルのパス(拡張子なし)
+    max_bytes : int
+        ジャーナルの上限サイズ(超えたらあふれとして全走査にする)
+    """
+
+    def __init__(self, state_dir, section, max_bytes=16*1024*1024):
+        self.base = os.path.join(state_dir, section + '_journal')
+        self.max_bytes = max_bytes
+
+    @property
+    def journal_path(self):
+        return self.base + '.list'
+
+    @property
+    def overflow_path(self):
+        return self.base + '.overflow'
+
+    @property
+    def pid_path(self):
+        return self.base + '.pid'
+
+    @property
+    def state_path(self):
+        return self.base + '.json'
+
+    def _lock(self):
+        """
+        ジャーナルのロックを取る
+
+        Returns
+        -------
+        fd : int
+            ロックファイルのディスクリプタ(閉じるとロックが外れる)
+        """
+        os.makedirs(os.path.dirname(self.base), exist_ok=True)
+        fd = os.open(self.base + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def start(self, pid):
+        """
+        ウォッチャー開始を記録する
+
+        開始前の変更は分からないため、あふれとして次回は全走査させる。
+
+        Parameters
+        ----------
+        pid : int
+            ウォッチャーのプロセスID
+        """
+        fd = self._lock()
+        try:
+            with open(self.pid_path, 'w') as f:
+                f.write(str(pid))
+            open(self.overflow_path, 'w').close()
+        finally:
+            os.close(fd)
+
+    def append(self, relpaths):
+        """
+        変更されたパスを追記する
+
+        Parameters
+        ----------
+        relpaths : iterable of str
+            バックアップ元からの相対パス
+        """
+        data = b''.join(os.fsencode(relpath) + b'\0' for relpath in relpaths)
+        if len(data) == 0:
+            return
+        fd = self._lock()
+        try:
+            with open(self.journal_path, 'ab') as f:
+                f.write(data)
+                size = f.tell()
+            if size > self.max_bytes:
+                logger.warning('journal exceeds %d bytes. mark as overflow: %s', self.max_bytes, self.journal_path)
+                open(self.overflow_path, 'w').close()
+                os.truncate(self.journal_path, 0)
+        finally:
+            os.close(fd)
+
+    def mark_overflow(self):
+        """
+        あふれを記録する(次回は全走査する)
+        """
+        fd = self._lock()
+        try:
+            open(self.overflow_path, 'w').close()
+        finally:
+            os.close(fd)
+
+    def _is_watching(self):
+        """
+        ウォッチャーが動いているか？
+        """
+        try:
+            with open(self.pid_path) as f:
+                pid = int(f.read())
+            os.kill(pid, 0)
+        except PermissionError:
+            return True
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def take(self):
+        """
+        ジャーナルを取り出す
+
+        取り出した内容は commit するまで .processing として残す。
+
+        Returns
+        -------
+        relpaths : list of str or None
+            変更されたパス(重複なし)。全走査が必要ならNone
+        """
+        fd = self._lock()
+        try:
+            # 前回取り出したまま終わっていない分は引き継ぐ
+            for path in [self.journal_path, self.overflow_path]:
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'rb') as src, open(path + '.processing', 'ab') as dst:
+                    dst.write(src.read())
+                os.remove(path)
+            watching = self._is_watching()
+        finally:
+            os.close(fd)
+
+        if not watching:
+            logger.info('journal watcher is not running. full scan is required.')
+            return None
+        if os.path.exists(self.overflow_path + '.processing'):
+            logger.info('journal overflowed. full scan is required.')
+            return None
+        try:
+            with open(self.journal_path + '.processing', 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        return sorted(set(os.fsdecode(relpath) for relpath in data.split(b'\0') if len(relpath) > 0))
+
+    def commit(self, full_scan=False):
+        """
+        取り出したジャーナルを処理済みにする
+
+        Parameters
+        ----------
+        full_scan : bool, default False
+            全走査を行ったか？
+        """
+        for path in [self.journal_path, self.overflow_path]:
+            if os.path.exists(path + '.processing'):
+                os.remove(path + '.processing')
+        if full_scan:
+            with open(self.state_path, 'w') as f:
+                json.dump({'last_full_scan': datetime.datetime.now().isoformat()}, f)
+
+    def rollback(self):
+        """
+        取り出したジャーナルを戻す
+        """
+        fd = self._lock()
+        try:
+            for path in [self.journal_path, self.overflow_path]:
+                if not os.path.exists(path + '.processing'):
+                    continue
+                with open(path + '.processing', 'rb') as src, open(path, 'ab') as dst:
+                    dst.write(src.read())
+                os.remove(path + '.processing')
+        finally:
+            os.close(fd)
+
+    def status(self):
+        """
+        ジャーナルの状態を取得する
+
+        Returns
+        -------
+        dict of {bytes: int, overflow: bool, last_full_scan: str or None}
+        """
+        try:
+            size = os.stat(self.journal_path).st_size
+        except FileNotFoundError:
+            size = 0
+        try:
+            with open(self.state_path) as f:
+                last_full_scan = json.load(f).get('last_full_scan')
+        except (OSError, ValueError):
+            last_full_scan = None
+        return {'bytes': size,
+                'overflow': os.path.exists(self.overflow_path),
+                'last_full_scan': last_full_scan}
+
+class Watcher(threading.Thread):
+    """
+    バックアップ元の変更を監視してジャーナルに記録するスレッド
+
+    Attributes
+    ----------
+    source : str
+        監視するバックアップ元ディレクトリ
+    journal : Journal
+        記録先ジャーナル
+    flush_interval : float, default 1.0
+        ジャーナルへ書き出す間隔(s)
+    """
+
+    def __init__(self, source, journal, flush_interval=1.0):
+        super().__init__(daemon=True)
+        self.source = source
+        self.journal = journal
+        self.flush_interval = flush_interval
+        self._stop_event = threading.Event()
+        self._inotify = None
+        self._wds = {}
+        self._changed = set()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _add_tree(self, reldir):
+        """
+        ディレクトリ以下に監視を追加する
+
+        Parameters
+        ----------
+        reldir : str
+            バックアップ元からの相対パス
+
+        Returns
+        -------
+        bool
+            全て追加できたか？
+        """
+        stack = [reldir]
+        while len(stack) > 0:
+            current = stack.pop()
+            path = os.path.join(self.source, current)
+            try:
+                wd = self._inotify.add_watch(path)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                # ENOSPC(max_user_watches超過)などは監視しきれない
+                logger.error('Could not watch %s: %s', path, e)
+                return False
+            self._wds[wd] = current
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(os.path.join(current, entry.name) if current else entry.name)
+            except OSError:
+                continue
+        return True
+
+    def _handle(self, wd, mask, name):
+        """
+        1イベントを処理する
+        """
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('inotify queue overflowed: %s', self.source)
+            self.journal.mark_overflow()
+            return
+        if mask & IN_IGNORED:
+            self._wds.pop(wd, None)
+            return
+        reldir = self._wds.get(wd)
+        if reldir is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if reldir == '':
+                logger.warning('watched source is gone: %s', self.source)
+                self.journal.mark_overflow()
+            return
+        relpath = os.path.join(reldir, name) if reldir else name
+        self._changed.add(relpath)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            if not self._add_tree(relpath):
+                self.journal.mark_overflow()
+
+    def run(self):
+        self._inotify = Inotify()
+        try:
+            self.journal.start(os.getpid())
+            if not self._add_tree(''):
+                self.journal.mark_overflow()
+            logger.info('watching %s (%d directories)', self.source, len(self._wds))
+            last_flush = time.monotonic()
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select([self._inotify.fd], [], [], self.flush_interval)
+                if len(readable) > 0:
+                    for wd, mask, name in self._inotify.read_events():
+                        self._handle(wd, mask, name)
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    self.journal.append(sorted(self._changed))
+                    self._changed.clear()
+                    last_flush = time.monotonic()
+            self.journal.append(sorted(self._changed))
+        except Exception as e:
+            logger.error('watcher for %s stopped: %s', self.source, e)
+            self.journal.mark_overflow()
+        finally:
+            self._inotify.close()
@@ -0,0 +1,346 @@
+import signal
+import threading
+import collections
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+from concurrent.futures import Future
+import logging
+logger = logging.getLogger(__name__)
+
+import logutil
+import joblock
+import mountutil
+# ワーカーで使うモジュールはfork前に読み込んで共有する
+import backup
+from process import Process, EventLoopThread
+from settings import Settings, ConfigCache
+
+LOG_FORMAT = '[%(levelname)s] %(asctime)s : %(name)s(%(lineno)s) %(message)s'
+
+class _PipeHandler(logging.Handler):
+    """
+    ワーカー内のログを1行ずつ親プロセスに送るハンドラ
+    """
+
+    def __init__(self, conn):
+        super().__init__()
+        self.conn = conn
+        self.job_id = None
+        self.setFormatter(logutil.RawAwareFormatter(fmt=LOG_FORMAT))
+
+    def emit(self, record):
+        try:
+            for line in self.format(record).splitlines():
+                self.conn.send(('line', self.job_id, line))
+        except Exception:
+            self.handleError(record)
+
+def _reset_after_fork():
+    """
+    fork前の親プロセスのスレッドに依存する状態を初期化する
+    """
+    EventLoopThread._lock = threading.Lock()
+    EventLoopThread._loop = None
+    joblock.ResourceLock._registry_lock = threading.Lock()
+    joblock.ResourceLock._thread_locks = {}
+    mountutil.checker = mountutil.MountChecker()
+
+def run_job(args, config_cache):
+    """
+    ワーカー内でバックアップを1件実行する
+
+    Parameters
+    ----------
+    args : list
+        backup.py に渡す引数
+    config_cache : settings.ConfigCache
+        パース済みconfigのキャッシュ
+
+    Returns
+    -------
+    returncode : int
+        終了コード
+    """
+    setting = None
+    try:
+        setting = Settings(args=args, config_cache=config_cache)
+        rcode = backup.main(setting)
+        return 0 if rcode is None else rcode
+    except SystemExit as e:
+        # forceexit_when_error などによる終了はジョブの終了コードにする
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        logger.exception('backup worker job failed')
+        return 1
+    finally:
+        if setting is not None:
+            setting.close()
+
+def _worker_main(conn):
+    """
+    ワーカープロセスのメインループ
+
+    Parameters
+    ----------
+    conn : multiprocessing.connection.Connection
+        親プロセスとの接続
+    """
+    _reset_after_fork()
+    # 親から引き継いだハンドラ(app.pyのログ)には書かず、全て親に送る
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    pipe_handler = _PipeHandler(conn)
+    root.addHandler(pipe_handler)
+    root.setLevel(logging.INFO)
+
+    config_cache = ConfigCache()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        job_id, args = task
+        pipe_handler.job_id = job_id
+        rcode = run_job(args, config_cache)
+        conn.send(('end', job_id, rcode))
+        pipe_handler.job_id = None
+
+class _Worker:
+    """
+    親プロセス側から見たワーカー
+    """
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job_id = None
+
+class WorkerPool:
+    """
+    backup.main を常駐ワーカープロセスで実行するプール
+
+    ワーカーは起動時(スレッドを起動する前)にforkしておき、ジョブはキューから空いたワーカーに渡す。
+    ジョブごとにインタプリタを起動しないが、ワーカーが異常終了しても そのジョブだけが失敗する。
+    スレッドが動いている親からforkすると他のスレッドが持っていたロックを引き継ぐので、
+    異常終了したワーカーは作り直さずにプールから外す(全て外れたら degraded になる)。
+
+    Attributes
+    ----------
+    size : int
+        起動時のワーカー数
+    """
+
+    def __init__(self, size=2):
+        self.size = size
+        self._context = multiprocessing.get_context('fork')
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._jobs = {}
+        self._next_id = 0
+        self._wakeup_r, self._wakeup_w = self._context.Pipe(duplex=False)
+        self._workers = [_Worker(self._context) for _ in range(size)]
+        self._closed = False
+        self._thread = threading.Thread(target=self._dispatch, name='worker-pool', daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self):
+        """
+        残っているワーカー数
+        """
+        with self._lock:
+            return len(self._workers)
+
+    @property
+    def degraded(self):
+        """
+        全てのワーカーが異常終了したか？(ジョブは backup.py を起動して実行する)
+        """
+        return self.alive == 0
+
+    def submit(self, args, on_line=None, on_start=None):
+        """
+        ジョブを投入する
+
+        Parameters
+        ----------
+        args : list
+            backup.py に渡す引数
+        on_line : function, default None
+            出力1行ごとに呼ばれる関数
+        on_start : function, default None
+            ワーカーで開始したときにワーカーのPIDを受け取る関数
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            終了コードを返す
+        """
+        future = Future()
+        with self._lock:
+            if len(self._workers) == 0:
+                logger.error('no backup worker is alive')
+                future.set_result(1)
+                return future
+            job_id = self._next_id
+            self._next_id += 1
+            self._jobs[job_id] = (future, on_line, on_start)
+            self._queue.append((job_id, list(args)))
+            self._wakeup_w.send(None)
+        return future
+
+    def _assign(self):
+        """
+        空いているワーカーにキューのジョブを渡す
+        """
+        for worker in list(self._workers):
+            if worker.job_id is not None:
+                continue
+            with self._lock:
+                if len(self._queue) == 0:
+                    return
+                job_id, args = self._queue.popleft()
+                on_start = self._jobs[job_id][2]
+            worker.job_id = job_id
+            worker.conn.send((job_id, args))
+            if on_start is not None:
+                on_start(worker.process.pid)
+
+    def _finish(self, job_id, rcode):
+        with self._lock:
+            future, _, _ = self._jobs.pop(job_id)
+        future.set_result(rcode)
+
+    def _dispatch(self):
+        """
+        ワーカーからの出力・終了と、ワーカーの異常終了を待って処理する
+        """
+        while not self._closed:
+            self._assign()
+            conns = {worker.conn: worker for worker in self._workers}
+            sentinels = {worker.process.sentinel: worker for worker in self._workers}
+            ready = wait_connections([self._wakeup_r] + list(conns) + list(sentinels))
+            for obj in ready:
+                if obj is self._wakeup_r:
+                    self._wakeup_r.recv()
+                elif obj in conns:
+                    worker = conns[obj]
+                    try:
+                        kind, job_id, value = worker.conn.recv()
+                    except (EOFError, OSError):
+                        continue
+                    if kind == 'line':
+                        on_line = self._jobs.get(job_id, (None, None, None))[1]
+                        if on_line is not None:
+                            on_line(value)
+                    elif kind == 'end':
+                        worker.job_id = None
+                        self._finish(job_id, value)
+            for sentinel, worker in sentinels.items():
+                if sentinel in ready or not worker.process.is_alive():
+                    self._remove(worker)
+
+    def _remove(self, worker):
+        """
+        異常終了したワーカーのジョブを失敗にして、ワーカーをプールから外す
+        """
+        # 終了前に送られた出力を読み切る
+        try:
+            while worker.conn.poll():
+                kind, job_id, value = worker.conn.recv()
+                if kind == 'line' and job_id in self._jobs and self._jobs[job_id][1] is not None:
+                    self._jobs[job_id][1](value)
+                elif kind == 'end':
+                    worker.job_id = None
+                    self._finish(job_id, value)
+        except (EOFError, OSError):
+            pass
+        worker.process.join()
+        worker.conn.close()
+        # ジョブを失敗にする前に外しておく(終了を待っていた側から見てプールの状態が確定している)
+        with self._lock:
+            self._workers.remove(worker)
+            failed = []
+            if worker.job_id is not None:
+                logger.error('backup worker (pid %d) died with exit code %s', worker.process.pid,
+                             worker.process.exitcode)
+                failed.append((worker.job_id, 1 if not worker.process.exitcode else abs(worker.process.exitcode)))
+            if not self._closed:
+                logger.error('backup worker pool is degraded: %d of %d workers are alive',
+                             len(self._workers), self.size)
+            # 残ったワーカーがなければ実行待ちのジョブも失敗にする
+            if len(self._workers) == 0:
+                failed += [(job_id, 1) for job_id, _ in self._queue]
+                self._queue.clear()
+        for job_id, rcode in failed:
+            self._finish(job_id, rcode)
+
+    def close(self):
+        """
+        ワーカーを終了する
+        """
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        with self._lock:
+            self._wakeup_w.send(None)
+        for worker in workers:
+            worker.process.join(5)
+
+class WorkerProcess(Process):
+    """
+    WorkerPool で backup.main を実行する Process
+
+    Process と同じく cmd(python3 backup.py ...) を持ち、cmd[2:] を backup.py の引数として渡す。
+
+    Attributes
+    ----------
+    pool : WorkerPool
+        実行するワーカープール
+    """
+
+    def __init__(self, cmd, pool, out_to_log=False, handlers=None):
+        super().__init__(cmd, out_to_log=out_to_log, handlers=handlers)
+        self.pool = pool
+        self._pid = None
+
+    @property
+    def returncode(self):
+        if self._future is None:
+            return self._returncode
+        self._returncode = self._future.result()
+        return self._returncode
+
+    @property
+    def pid(self):
+        return self._pid
+
+    def _set_pid(self, pid):
+        self._pid = pid
+
+    def execute(self, wait=False, detach=False):
+        """
+        ワーカーで実行する
+
+        Parameters
+        ----------
+        wait : bool, default False
+            終了を待つか？
+        detach : bool, default False
+            使用しない(常にワーカーで実行する)
+        """
+        logger.info('execute in worker (%s)', ' '.join(self.cmd))
+        self._future = self.pool.submit(self.cmd[2:], on_line=self._handle_line, on_start=self._set_pid)
+        if wait:
+            self._returncode = self._future.result()